@@ -0,0 +1,753 @@
+import os
+import sys
+import json
+import shutil
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+import statistics
+from datetime import datetime
+
+# Benchmarks for LANChatServer. Each one starts the server in a subprocess
+# with the chosen async mode on localhost and writes its results as JSON,
+# including the server's CPU time and RSS, so runs can be compared across
+# async modes and commits.
+#
+#   scale      Ramps up connected Socket.IO clients. At each step some of
+#              them send a burst of chat messages and every client records
+#              how long each broadcast took to arrive, optionally with
+#              parallel downloads running. The ramp stops once p99 latency
+#              or delivery falls past the limits.
+#   transfer   Parallel uploads, then downloads, of files of several sizes.
+#   listing    /files latency with thousands of files in the shared folder.
+#   reconnect  Every client drops and reconnects at once, a few times over.
+#   suite      All of the above for each async mode, in one JSON document.
+#
+# Needs requests and python-socketio[client]:
+#     python benchmark.py --async-mode eventlet --steps 10,50,100,200 --transfers 4
+#     python benchmark.py --async-mode eventlet --workers 4
+#     python benchmark.py transfer --sizes 64K,4M,64M --parallel 8
+#     python benchmark.py suite --async-modes threading,eventlet,gevent --output results.json
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def latency_summary(samples):
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 50) * 1000, 2) if samples else None,
+        'p95_ms': round(percentile(samples, 95) * 1000, 2) if samples else None,
+        'p99_ms': round(percentile(samples, 99) * 1000, 2) if samples else None,
+        'max_ms': round(max(samples) * 1000, 2) if samples else None,
+        'mean_ms': round(statistics.mean(samples) * 1000, 2) if samples else None
+    }
+
+
+def throughput_summary(nbytes, elapsed):
+    return round(nbytes / max(elapsed, 1e-9) / (1024 * 1024), 2)
+
+
+def usage_delta(before, after):
+    return {
+        'server_rss_bytes': after['rss_bytes'],
+        'server_cpu_seconds': (round(after['cpu_seconds'] - before['cpu_seconds'], 2)
+                               if after['cpu_seconds'] is not None and before['cpu_seconds'] is not None else None)
+    }
+
+
+def parse_size(value):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip().upper()
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def parse_sizes(value):
+    return [parse_size(v) for v in value.split(',') if v.strip()]
+
+
+def format_size(size):
+    for unit, scale in (('G', 1024 ** 3), ('M', 1024 ** 2), ('K', 1024)):
+        if size >= scale and size % scale == 0:
+            return f'{size // scale}{unit}'
+    return str(size)
+
+
+def process_usage(pid):
+    # CPU seconds and resident memory of the server process, from /proc
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        ticks = os.sysconf('SC_CLK_TCK')
+        cpu = (int(fields[11]) + int(fields[12])) / ticks
+        with open(f'/proc/{pid}/status') as f:
+            rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+        return {'cpu_seconds': cpu, 'rss_bytes': rss}
+    except (OSError, ValueError, StopIteration):
+        return {'cpu_seconds': None, 'rss_bytes': None}
+
+
+def process_tree_usage(pid):
+    # The server plus its worker processes in multi-worker mode
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            pids = [pid] + [int(child) for child in f.read().split()]
+    except (OSError, ValueError):
+        pids = [pid]
+    usages = [process_usage(p) for p in pids]
+    if any(u['cpu_seconds'] is None for u in usages):
+        return process_usage(pid)
+    return {'cpu_seconds': sum(u['cpu_seconds'] for u in usages),
+            'rss_bytes': sum(u['rss_bytes'] for u in usages)}
+
+
+def serve(args):
+    # Runs inside the benchmark's server subprocess
+    sys.path.insert(0, REPO_DIR)
+    import file2
+    if args.workers > 1:
+        file2.run_cluster(args.workers, '127.0.0.1', args.port, args.async_mode)
+        return
+    async_mode = file2.prepare_async_mode(args.async_mode)
+    server = file2.LANChatServer(async_mode=async_mode)
+    server.serve('127.0.0.1', args.port)
+
+
+class ServerProcess:
+    def __init__(self, async_mode, port, workdir, extra_args=()):
+        self.url = f'http://127.0.0.1:{port}'
+        command = [sys.executable, os.path.abspath(__file__), 'serve', '--async-mode', async_mode,
+                   '--port', str(port)] + list(extra_args)
+        self.started = time.time()
+        self.process = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def wait_ready(self, timeout=30):
+        import requests
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError('Server process exited during startup')
+            try:
+                requests.get(self.url + '/login', timeout=1)
+                return
+            except requests.RequestException:
+                time.sleep(0.1)
+        raise RuntimeError('Server did not start in time')
+
+    def usage(self):
+        return process_tree_usage(self.process.pid)
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class ChatClient:
+    def __init__(self, url, username):
+        import requests
+        import socketio
+        self.url = url
+        self.http = requests.Session()
+        self.http.post(url + '/login', data={'username': username}, allow_redirects=False)
+        self.sio = socketio.Client(reconnection=False)
+        self.latencies = []
+        self.received = 0
+        self.lock = threading.Lock()
+        self.sio.on('new_message', self.on_message)
+        self.sio.on('batch', self.on_batch)
+
+    def on_message(self, data):
+        now = time.time()
+        try:
+            sent = json.loads(data['message'])['t']
+        except (ValueError, KeyError, TypeError):
+            return
+        with self.lock:
+            self.latencies.append(now - sent)
+            self.received += 1
+
+    def on_batch(self, runs):
+        # Broadcasts coalesced by the server: [[event, [data, ...]], ...]
+        for event, items in runs:
+            if event == 'new_message':
+                for data in items:
+                    self.on_message(data)
+
+    def connect(self):
+        cookie = '; '.join(f'{k}={v}' for k, v in self.http.cookies.items())
+        started = time.time()
+        self.sio.connect(self.url, headers={'Cookie': cookie}, transports=['websocket'], wait_timeout=30)
+        return time.time() - started
+
+    def send(self, seq):
+        self.sio.emit('send_message', {'message': json.dumps({'t': time.time(), 'seq': seq})})
+
+    def reset(self):
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+            self.received = 0
+        return latencies
+
+    def close(self):
+        try:
+            self.sio.disconnect()
+        except Exception:
+            pass
+
+
+def connect_clients(url, start_index, count, concurrency=32):
+    clients = [None] * count
+    errors = []
+    next_index = [0]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                i = next_index[0]
+                next_index[0] += 1
+            if i >= count:
+                return
+            try:
+                client = ChatClient(url, f'bench{start_index + i}')
+                client.connect()
+                clients[i] = client
+            except Exception as e:
+                errors.append(str(e))
+
+    threads = [threading.Thread(target=worker) for _ in range(min(concurrency, count))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return [c for c in clients if c is not None], errors
+
+
+def close_clients(clients, concurrency=32):
+    # In parallel, since each close can wait seconds for the server's close frame
+    run_parallel(len(clients), concurrency, lambda slot, i: clients[i].close())
+
+
+class DownloadLoad:
+    # Keeps a number of parallel downloads of one file running
+    def __init__(self, url, filename, workers):
+        self.url = f'{url}/download/{filename}'
+        self.workers = workers
+        self.stop_event = threading.Event()
+        self.bytes = 0
+        self.completed = 0
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def run(self):
+        import requests
+        http = requests.Session()
+        while not self.stop_event.is_set():
+            try:
+                with http.get(self.url, stream=True, timeout=60) as response:
+                    for block in response.iter_content(256 * 1024):
+                        with self.lock:
+                            self.bytes += len(block)
+                        if self.stop_event.is_set():
+                            break
+                with self.lock:
+                    self.completed += 1
+            except Exception:
+                time.sleep(0.1)
+
+    def start(self):
+        self.started = time.time()
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(self.workers)]
+        for t in self.threads:
+            t.start()
+
+    def stop(self):
+        self.stop_event.set()
+        for t in self.threads:
+            t.join(timeout=10)
+        elapsed = max(time.time() - self.started, 1e-9)
+        return {
+            'workers': self.workers,
+            'bytes': self.bytes,
+            'completed': self.completed,
+            'throughput_mb_s': round(self.bytes / elapsed / (1024 * 1024), 2)
+        }
+
+
+def run_scaling(args):
+    workdir = tempfile.mkdtemp(prefix='lanshare-bench-')
+    os.makedirs(os.path.join(workdir, 'shared_files'), exist_ok=True)
+    transfer_file = None
+    if args.transfers:
+        transfer_file = 'bench_transfer.bin'
+        with open(os.path.join(workdir, 'shared_files', transfer_file), 'wb') as f:
+            for _ in range(args.transfer_size_mb):
+                f.write(os.urandom(1024 * 1024))
+
+    server = ServerProcess(args.async_mode, args.port, workdir, ['--workers', str(args.workers)])
+    results = {
+        'benchmark': 'connection_scaling',
+        'async_mode': args.async_mode,
+        'workers': args.workers,
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'messages_per_step': args.messages,
+        'message_rate': args.rate,
+        'senders': args.senders,
+        'p99_limit_ms': args.p99_limit_ms,
+        'steps': []
+    }
+    clients = []
+    try:
+        server.wait_ready()
+        for target in args.steps:
+            connect_started = time.time()
+            new_clients, errors = connect_clients(server.url, len(clients), target - len(clients))
+            clients.extend(new_clients)
+            connect_time = time.time() - connect_started
+            time.sleep(1)
+            for client in clients:
+                client.reset()
+
+            load = DownloadLoad(server.url, transfer_file, args.transfers) if args.transfers else None
+            if load:
+                load.start()
+            usage_before = server.usage()
+            senders = clients[:max(1, min(args.senders, len(clients)))]
+            for seq in range(args.messages):
+                senders[seq % len(senders)].send(seq)
+                time.sleep(1.0 / args.rate)
+            time.sleep(args.drain)
+            usage_after = server.usage()
+            transfers = load.stop() if load else None
+
+            latencies = []
+            for client in clients:
+                latencies.extend(client.reset())
+            expected = args.messages * len(clients)
+            step = {
+                'clients': len(clients),
+                'senders': len(senders),
+                'connect_errors': len(errors),
+                'connect_seconds': round(connect_time, 2),
+                'delivered': len(latencies),
+                'expected': expected,
+                'delivery_ratio': round(len(latencies) / expected, 4) if expected else None,
+                'latency': latency_summary(latencies),
+                'transfers': transfers
+            }
+            step.update(usage_delta(usage_before, usage_after))
+            results['steps'].append(step)
+            print(json.dumps(step), file=sys.stderr)
+
+            p99 = step['latency']['p99_ms']
+            if errors or p99 is None or p99 > args.p99_limit_ms or step['delivery_ratio'] < args.min_delivery:
+                results['degraded_at_clients'] = len(clients)
+                break
+        else:
+            results['degraded_at_clients'] = None
+    finally:
+        close_clients(clients)
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def run_parallel(count, parallel, task):
+    # Runs task(i) for i in range(count) on `parallel` threads. Returns the
+    # per-task durations of the tasks that succeeded, the errors and the
+    # wall time.
+    durations = []
+    errors = []
+    next_index = [0]
+    lock = threading.Lock()
+
+    def worker(slot):
+        while True:
+            with lock:
+                i = next_index[0]
+                next_index[0] += 1
+            if i >= count:
+                return
+            started = time.time()
+            try:
+                task(slot, i)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                durations.append(time.time() - started)
+
+    started = time.time()
+    threads = [threading.Thread(target=worker, args=(slot,)) for slot in range(min(parallel, count))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return durations, errors, time.time() - started
+
+
+def login_sessions(url, count, prefix):
+    import requests
+    sessions = []
+    for i in range(count):
+        http = requests.Session()
+        http.post(url + '/login', data={'username': f'{prefix}{i}'}, allow_redirects=False)
+        sessions.append(http)
+    return sessions
+
+
+class MultipartUpload:
+    # A multipart/form-data body for /upload, generated as it is read so big
+    # parallel uploads don't sit in memory. requests sends it with a
+    # Content-Length since it has a len(). The random block is shared; a
+    # random header per file keeps uploads from being deduplicated.
+    def __init__(self, filename, size, block):
+        boundary = os.urandom(16).hex()
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        self.parts = [
+            (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+             f'Content-Type: application/octet-stream\r\n\r\n').encode() + os.urandom(min(size, 32)),
+            f'\r\n--{boundary}--\r\n'.encode()
+        ]
+        self.block = block
+        self.payload_left = max(0, size - 32)
+        self.length = len(self.parts[0]) + self.payload_left + len(self.parts[1])
+
+    def __len__(self):
+        return self.length
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.length
+        out = []
+        while n > 0:
+            if self.parts[0]:
+                data, self.parts[0] = self.parts[0][:n], self.parts[0][n:]
+            elif self.payload_left:
+                data = self.block[:min(n, self.payload_left)]
+                self.payload_left -= len(data)
+            elif self.parts[1]:
+                data, self.parts[1] = self.parts[1][:n], self.parts[1][n:]
+            else:
+                break
+            out.append(data)
+            n -= len(data)
+        return b''.join(out)
+
+
+def run_transfers(args):
+    # Each size gets its own round of uploads and then downloads of what was
+    # uploaded. Payloads are random so neither dedup nor compression helps,
+    # and every upload is unique for the same reason.
+    workdir = tempfile.mkdtemp(prefix='lanshare-bench-')
+    os.makedirs(os.path.join(workdir, 'shared_files'), exist_ok=True)
+    server = ServerProcess(args.async_mode, args.port, workdir, ['--workers', str(args.workers)])
+    results = {
+        'benchmark': 'transfer',
+        'async_mode': args.async_mode,
+        'workers': args.workers,
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'parallel': args.parallel,
+        'sizes': []
+    }
+    try:
+        server.wait_ready()
+        sessions = login_sessions(server.url, args.parallel, 'xfer')
+        for size in args.sizes:
+            count = max(args.parallel, args.files_per_size)
+            block = os.urandom(min(size, 1024 * 1024))
+            uploaded = [None] * count
+
+            def upload(slot, i):
+                body = MultipartUpload(f'bench_{format_size(size)}_{i}.bin', size, block)
+                response = sessions[slot].post(server.url + '/upload', data=body, timeout=600,
+                                               headers={'Content-Type': body.content_type})
+                body = response.json()
+                if response.status_code != 200 or not body.get('success'):
+                    raise RuntimeError(f'Upload failed: {response.status_code} {body}')
+                uploaded[i] = body['filename']
+
+            def download(slot, i):
+                received = 0
+                with sessions[slot].get(f'{server.url}/download/{uploaded[i]}', stream=True, timeout=600,
+                                        headers={'Accept-Encoding': 'identity'}) as response:
+                    response.raise_for_status()
+                    for data in response.iter_content(256 * 1024):
+                        received += len(data)
+                if received != size:
+                    raise RuntimeError(f'Short download: {received} of {size} bytes')
+
+            entry = {'size': size, 'files': count}
+            for direction, task in (('upload', upload), ('download', download)):
+                usage_before = server.usage()
+                durations, errors, elapsed = run_parallel(count, args.parallel, task)
+                usage_after = server.usage()
+                entry[direction] = {
+                    'completed': len(durations),
+                    'errors': len(errors),
+                    'first_error': errors[0] if errors else None,
+                    'seconds': round(elapsed, 2),
+                    'throughput_mb_s': throughput_summary(size * len(durations), elapsed),
+                    'latency': latency_summary(durations)
+                }
+                entry[direction].update(usage_delta(usage_before, usage_after))
+                if direction == 'upload' and errors:
+                    break
+            results['sizes'].append(entry)
+            print(json.dumps(entry), file=sys.stderr)
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def run_listing(args):
+    # A fresh server per directory size, so startup includes the catalog scan
+    results = {
+        'benchmark': 'listing',
+        'async_mode': args.async_mode,
+        'workers': args.workers,
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'requests': args.requests,
+        'steps': []
+    }
+    for count in args.file_counts:
+        workdir = tempfile.mkdtemp(prefix='lanshare-bench-')
+        folder = os.path.join(workdir, 'shared_files')
+        os.makedirs(folder, exist_ok=True)
+        for i in range(count):
+            with open(os.path.join(folder, f'bench_{i:07d}.bin'), 'wb') as f:
+                f.write(b'x' * (i % 4096))
+
+        server = ServerProcess(args.async_mode, args.port, workdir, ['--workers', str(args.workers)])
+        try:
+            server.wait_ready(timeout=300)
+            step = {'files': count, 'startup_seconds': round(time.time() - server.started, 2), 'queries': {}}
+            http = login_sessions(server.url, 1, 'list')[0]
+            queries = {
+                'full': '/files',
+                'page': '/files?limit=100',
+                'page_by_mtime': '/files?limit=100&sort=mtime&order=desc',
+                'filter': '/files?limit=100&q=bench_00012',
+                'prefix': '/files?limit=100&prefix=bench_0001'
+            }
+            for label, path in queries.items():
+                sizes = []
+
+                def fetch(slot, i):
+                    response = http.get(server.url + path, timeout=120)
+                    response.raise_for_status()
+                    sizes.append(len(response.content))
+
+                usage_before = server.usage()
+                durations, errors, elapsed = run_parallel(args.requests, 1, fetch)
+                usage_after = server.usage()
+                step['queries'][label] = {
+                    'errors': len(errors),
+                    'response_bytes': sizes[0] if sizes else None,
+                    'requests_per_second': round(len(durations) / max(elapsed, 1e-9), 1),
+                    'latency': latency_summary(durations)
+                }
+                step['queries'][label].update(usage_delta(usage_before, usage_after))
+
+            # Walking every page with the cursor
+            started = time.time()
+            pages = 0
+            url = server.url + '/files?limit=1000'
+            cursor = None
+            while True:
+                response = http.get(url + (f'&cursor={cursor}' if cursor else ''), timeout=120).json()
+                pages += 1
+                cursor = response.get('next_cursor')
+                if not cursor:
+                    break
+            step['paginate_all'] = {'pages': pages, 'seconds': round(time.time() - started, 3)}
+            step['server_rss_bytes'] = server.usage()['rss_bytes']
+            results['steps'].append(step)
+            print(json.dumps(step), file=sys.stderr)
+        finally:
+            server.stop()
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def run_reconnect(args):
+    # Connects the clients, then drops and reconnects all of them at once,
+    # as after a Wi-Fi blip or a server restart. Measures how long each
+    # reconnect takes and whether chat still reaches everyone afterwards.
+    workdir = tempfile.mkdtemp(prefix='lanshare-bench-')
+    os.makedirs(os.path.join(workdir, 'shared_files'), exist_ok=True)
+    server = ServerProcess(args.async_mode, args.port, workdir, ['--workers', str(args.workers)])
+    results = {
+        'benchmark': 'reconnect',
+        'async_mode': args.async_mode,
+        'workers': args.workers,
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'clients': args.clients,
+        'rounds': []
+    }
+    clients = []
+    try:
+        server.wait_ready()
+        clients, errors = connect_clients(server.url, 0, args.clients)
+        results['initial_connect_errors'] = len(errors)
+        for round_index in range(args.rounds):
+            close_clients(clients, args.concurrency)
+            time.sleep(args.pause)
+
+            usage_before = server.usage()
+            durations, errors, elapsed = run_parallel(
+                len(clients), args.concurrency, lambda slot, i: clients[i].connect())
+            time.sleep(1)
+            for client in clients:
+                client.reset()
+            for seq in range(args.messages):
+                clients[seq % len(clients)].send(seq)
+            time.sleep(args.drain)
+            usage_after = server.usage()
+
+            delivered = sum(len(client.reset()) for client in clients if client.sio.connected)
+            expected = args.messages * len(durations)
+            entry = {
+                'round': round_index + 1,
+                'reconnected': len(durations),
+                'errors': len(errors),
+                'first_error': errors[0] if errors else None,
+                'storm_seconds': round(elapsed, 2),
+                'connect_latency': latency_summary(durations),
+                'delivery_ratio': round(delivered / expected, 4) if expected else None
+            }
+            entry.update(usage_delta(usage_before, usage_after))
+            results['rounds'].append(entry)
+            print(json.dumps(entry), file=sys.stderr)
+            clients = [client for client in clients if client.sio.connected]
+            if not clients:
+                break
+    finally:
+        close_clients(clients)
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+BENCHMARKS = {
+    'scale': run_scaling,
+    'transfer': run_transfers,
+    'listing': run_listing,
+    'reconnect': run_reconnect
+}
+
+
+def run_suite(args):
+    results = {
+        'benchmark': 'suite',
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'cpu_count': os.cpu_count(),
+        'runs': []
+    }
+    for async_mode in args.async_modes:
+        for name in args.benchmarks:
+            run_args = argparse.Namespace(**vars(args))
+            run_args.async_mode = async_mode
+            print(f'== {name} ({async_mode})', file=sys.stderr)
+            try:
+                results['runs'].append(BENCHMARKS[name](run_args))
+            except Exception as e:
+                results['runs'].append({'benchmark': name, 'async_mode': async_mode, 'error': str(e)})
+    return results
+
+
+def parse_steps(value):
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+def parse_names(value):
+    return [v.strip() for v in value.split(',') if v.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='LAN Chat & File Share benchmarks')
+    sub = parser.add_subparsers(dest='command')
+
+    serve_parser = sub.add_parser('serve', help=argparse.SUPPRESS)
+    serve_parser.add_argument('--async-mode', default='threading')
+    serve_parser.add_argument('--port', type=int, default=5055)
+    serve_parser.add_argument('--workers', type=int, default=1)
+
+    scale_parser = sub.add_parser('scale', help='Socket.IO connection scaling (default)')
+    transfer_parser = sub.add_parser('transfer', help='Parallel upload and download throughput')
+    listing_parser = sub.add_parser('listing', help='/files on large directories')
+    reconnect_parser = sub.add_parser('reconnect', help='Reconnect storms')
+    suite_parser = sub.add_parser('suite', help='Every benchmark for each async mode')
+    everything = (parser, scale_parser, transfer_parser, listing_parser, reconnect_parser, suite_parser)
+    for p in everything:
+        p.add_argument('--async-mode', default='threading', choices=['threading', 'eventlet', 'gevent'])
+        p.add_argument('--port', type=int, default=5055)
+        p.add_argument('--workers', type=int, default=1, help='Server worker processes')
+        p.add_argument('--output', help='Write JSON results here instead of stdout')
+    for p in (parser, scale_parser, reconnect_parser, suite_parser):
+        p.add_argument('--messages', type=int, default=50, help='Messages broadcast per step or round')
+        p.add_argument('--drain', type=float, default=2.0, help='Seconds to wait for stragglers')
+    for p in (parser, scale_parser, suite_parser):
+        p.add_argument('--steps', type=parse_steps, default=[10, 50, 100, 200, 400])
+        p.add_argument('--senders', type=int, default=1, help='Clients taking turns to send')
+        p.add_argument('--rate', type=float, default=20.0, help='Messages per second')
+        p.add_argument('--transfers', type=int, default=0, help='Parallel downloads during each step')
+        p.add_argument('--transfer-size-mb', type=int, default=64)
+        p.add_argument('--p99-limit-ms', type=float, default=250.0)
+        p.add_argument('--min-delivery', type=float, default=0.99)
+    for p in (transfer_parser, suite_parser):
+        p.add_argument('--sizes', type=parse_sizes, default=[64 * 1024, 4 * 1024 ** 2, 64 * 1024 ** 2],
+                       help='File sizes, e.g. 64K,4M,64M')
+        p.add_argument('--parallel', type=int, default=8, help='Transfers in flight')
+        p.add_argument('--files-per-size', type=int, default=16)
+    for p in (listing_parser, suite_parser):
+        p.add_argument('--file-counts', type=parse_steps, default=[1000, 10000, 50000])
+        p.add_argument('--requests', type=int, default=50, help='Requests per query')
+    for p in (reconnect_parser, suite_parser):
+        p.add_argument('--clients', type=int, default=200)
+        p.add_argument('--rounds', type=int, default=3)
+        p.add_argument('--concurrency', type=int, default=64, help='Reconnects in flight')
+        p.add_argument('--pause', type=float, default=1.0, help='Seconds between the drop and the storm')
+    suite_parser.add_argument('--async-modes', type=parse_names, default=['threading', 'eventlet', 'gevent'])
+    suite_parser.add_argument('--benchmarks', type=parse_names, default=list(BENCHMARKS))
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        serve(args)
+        return
+
+    if args.command == 'suite':
+        unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+        if unknown:
+            parser.error(f"Unknown benchmark: {', '.join(unknown)}")
+        results = run_suite(args)
+    else:
+        results = BENCHMARKS[args.command or 'scale'](args)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
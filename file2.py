@@ -1,41 +1,2778 @@
 import os
+import sys
 import socket
+import errno
+import struct
+import signal
+import secrets
+import sqlite3
 import threading
+import multiprocessing
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, redirect, url_for, send_file, session
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, session, g
 from flask_socketio import SocketIO, emit, join_room, leave_room
+import socketio
 from werkzeug.utils import secure_filename
-import tkinter as tk
-from tkinter import ttk, scrolledtext, filedialog, messagebox
+from werkzeug.security import safe_join
+from werkzeug.http import http_date, quote_etag
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, File, Field, Data, Epilogue
+from jinja2 import DictLoader
 import json
 import uuid
+import time
+import hashlib
+import re
+import mimetypes
+import base64
+import bisect
+import io
+import zlib
+import gzip
+import zipfile
+import argparse
+from html import unescape as unescape_html
+from collections import deque, OrderedDict
+from functools import wraps
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor
+from urllib.parse import quote, urlparse
 
-class LANChatServer:
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+try:
+    import fitz  # PyMuPDF, for PDF previews
+except ImportError:
+    fitz = None
+
+class StreamingFileWriter:
+    # Writes an upload block by block into a part file on the same disk as its
+    # final location, hashing and enforcing the size limit on the way through.
+    def __init__(self, part_path, max_size):
+        self.part_path = part_path
+        self.max_size = max_size
+        self.size = 0
+        self.hasher = hashlib.sha256()
+        self.file = open(part_path, 'wb')
+    
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise RequestEntityTooLarge()
+        self.hasher.update(data)
+        self.file.write(data)
+    
+    def close(self):
+        self.file.close()
+        return self.hasher.hexdigest()
+    
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.part_path)
+        except OSError:
+            pass
+
+class FileRange:
+    # File-like view of [start, end) of a file. It keeps a real fileno() and
+    # file position so servers whose wsgi.file_wrapper uses os.sendfile
+    # (gunicorn and friends) can transmit it zero-copy.
+    def __init__(self, path, start, end):
+        self.file = open(path, 'rb')
+        self.file.seek(start)
+        self.remaining = end - start
+        self.on_close = None
+    
+    def fileno(self):
+        return self.file.fileno()
+    
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+    
+    def close(self):
+        self.file.close()
+        on_close, self.on_close = self.on_close, None
+        if on_close:
+            on_close()
+
+class TransferCancelled(ConnectionResetError):
+    # Raised from a transfer loop when stop() gives up on it at the deadline.
+    # The servers treat it as a dropped connection; the client resumes later.
+    def __init__(self):
+        super().__init__(errno.ECONNRESET, 'Transfer cancelled by server shutdown')
+
+class CountingBody:
+    # Response body that counts the bytes going out and calls on_close(sent)
+    # once the server closes it, whether or not it was read to the end
+    def __init__(self, body, on_close):
+        self.body = body
+        self.on_close = on_close
+        self.sent = 0
+    
+    def __iter__(self):
+        for data in self.body:
+            self.sent += len(data)
+            yield data
+    
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            on_close, self.on_close = self.on_close, None
+            if on_close:
+                on_close(self.sent)
+
+def parse_byte_ranges(header, length, max_ranges=64):
+    # Returns a sorted, merged list of [start, end) ranges, [] when nothing is
+    # satisfiable, or None when the header should be ignored.
+    if not header or not header.startswith('bytes='):
+        return None
+    ranges = []
+    for spec in header[6:].split(','):
+        spec = spec.strip()
+        if '-' not in spec:
+            return None
+        first, last = spec.split('-', 1)
+        try:
+            if first == '':
+                suffix = int(last)
+                if suffix <= 0:
+                    continue
+                start, end = max(0, length - suffix), length
+            else:
+                start = int(first)
+                end = length
+                if last != '':
+                    end = int(last) + 1
+                    if end <= start:
+                        return None
+                    end = min(end, length)
+        except ValueError:
+            return None
+        if start < length:
+            ranges.append([start, end])
+    if len(ranges) > max_ranges:
+        return None
+    
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def content_disposition(disposition, filename):
+    try:
+        filename.encode('latin-1')
+        return '%s; filename="%s"' % (disposition, filename.replace('"', ''))
+    except UnicodeEncodeError:
+        return "%s; filename*=UTF-8''%s" % (disposition, quote(filename))
+
+class ZipStream:
+    # Write-only sink for zipfile that hands back what was written since the
+    # last take(). It can't seek, so zipfile writes each entry's sizes in a
+    # data descriptor after its data and the archive is never staged anywhere.
     def __init__(self):
+        self.parts = []
+        self.offset = 0
+    
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+    
+    def tell(self):
+        return self.offset
+    
+    def flush(self):
+        pass
+    
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+def zip_date_time(mtime):
+    # ZIP timestamps start in 1980
+    date_time = time.localtime(mtime)[:6]
+    return date_time if date_time[0] >= 1980 else (1980, 1, 1, 0, 0, 0)
+
+def encode_cursor(sort, order, key):
+    raw = json.dumps([sort, order, list(key)]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, sort, order):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, cursor_order, key = json.loads(raw.decode('utf-8'))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    if cursor_sort != sort or cursor_order != order or not isinstance(key, list):
+        raise ValueError('Cursor does not match sort order')
+    return tuple(key)
+
+DEFAULT_ROOM = 'general'
+MAX_ROOM_ID_LENGTH = 32  # Channel names; DM ids are shorter
+MAX_USERNAME_LENGTH = 20
+
+def channel_id(name):
+    # Channel ids double as folder names for their chat logs
+    room_id = str(name).strip().lower().lstrip('#')
+    if not re.fullmatch('[a-z0-9][a-z0-9_-]{0,31}', room_id) or room_id.startswith('dm-'):
+        return None
+    return room_id
+
+def dm_room_id(username, other):
+    return 'dm-' + hashlib.sha1('\0'.join(sorted([username, other])).encode('utf-8')).hexdigest()[:16]
+
+class CatalogEventHandler(FileSystemEventHandler):
+    def __init__(self, catalog):
+        self.catalog = catalog
+    
+    def on_any_event(self, event):
+        self.catalog.changed.set()
+
+class FileCatalog:
+    # In-memory index of the shared folder: name, size, mtime, uploader,
+    # hash and the room whose file area holds the file. Upload/delete hooks
+    # update it incrementally, and a watcher thread (inotify through watchdog
+    # when installed, polling otherwise) picks up out-of-band changes. Every
+    # change bumps the version and is kept in a short change log so clients
+    # can sync deltas; the /files payload and sorted views are cached per
+    # version. Each change also carries the version of the previous change in
+    # the same room, so a client following one room can tell a missed delta
+    # from one that went to another room.
+    #
+    # With a journal (the shared state store of a multi-worker cluster) the
+    # versions come from the journal instead, only the leader scans the folder
+    # and writes the sidecar, and the other workers follow the journal.
+    SORT_KEYS = {
+        'name': lambda e: (e['name'],),
+        'size': lambda e: (e['size'], e['name']),
+        'mtime': lambda e: (e['mtime'], e['name']),
+        'uploader': lambda e: ((e['uploader'] or '').lower(), e['name'])
+    }
+    
+    def __init__(self, folder, poll_interval=2.0, full_scan_interval=30.0, journal=None, leader=True):
+        self.folder = folder
+        self.poll_interval = poll_interval
+        self.full_scan_interval = full_scan_interval
+        self.entries = {}
+        self.version = 0
+        self.changes = deque(maxlen=1000)
+        self.room_versions = {}
+        self.room_base = 0
+        self.pending = []
+        self.listeners = []
+        self.lock = threading.RLock()
+        self.changed = threading.Event()
+        self.metadata_dirty = False
+        self.payload = None
+        self.payload_version = -1
+        self.views = {}
+        self.views_version = -1
+        self.filter_counts = {}
+        self.watcher = None
+        self.observer = None
+        self.save_lock = threading.Lock()
+        self.journal = None
+        self.leader = leader
+        self.journal_written = False
+        self.on_journal_write = None
+        if journal is not None and not leader:
+            self.metadata = {}
+            self.journal = journal
+            self.reload()
+            return
+        self.load_metadata()
+        self.rescan()
+        if journal is not None:
+            # The leader's view of the folder is where every worker starts from
+            self.journal = journal
+            self.version = journal.reset_files(list(self.entries.values()))
+            self.changes.clear()
+            self.room_versions = {}
+            self.room_base = self.version
+    
+    def get_metadata_path(self):
+        return os.path.join(self.folder, '.catalog.json')
+    
+    def load_metadata(self):
+        # Uploader and hash can't be recovered from the filesystem, so they are
+        # kept in a small sidecar file. It is also the name-to-blob mapping for
+        # files held in the content-addressed store.
+        try:
+            with open(self.get_metadata_path(), 'r', encoding='utf-8') as f:
+                self.metadata = json.load(f)
+        except (OSError, ValueError):
+            self.metadata = {}
+        for name, meta in self.metadata.items():
+            if meta.get('blob'):
+                self.entries[name] = self.make_entry(name, meta['size'], meta['mtime_ns'], meta.get('uploader'),
+                                                     meta['blob'], meta['blob'], meta.get('room'))
+    
+    def save_metadata(self):
+        if self.journal is not None and not self.leader:
+            return
+        with self.save_lock:
+            with self.lock:
+                if not self.metadata_dirty:
+                    return
+                metadata = {}
+                for name, entry in self.entries.items():
+                    meta = {'uploader': entry['uploader'], 'sha256': entry['sha256']}
+                    if entry['blob']:
+                        meta.update(blob=entry['blob'], size=entry['size'], mtime_ns=entry['mtime_ns'])
+                    if entry['room'] != DEFAULT_ROOM:
+                        meta['room'] = entry['room']
+                    metadata[name] = meta
+                self.metadata_dirty = False
+            path = self.get_metadata_path()
+            try:
+                with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                    json.dump(metadata, f)
+                os.replace(path + '.tmp', path)
+            except OSError:
+                with self.lock:
+                    self.metadata_dirty = True
+    
+    def make_entry(self, name, size, mtime_ns, uploader=None, sha256=None, blob=None, room=None):
+        mtime = mtime_ns / 1e9
+        return {
+            'name': name,
+            'size': size,
+            'mtime': mtime,
+            'mtime_ns': mtime_ns,
+            'modified': datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S'),
+            'uploader': uploader,
+            'sha256': sha256,
+            'blob': blob,
+            'room': room or DEFAULT_ROOM
+        }
+    
+    def record(self, op, entry):
+        # Caller holds the lock; listeners are called later from notify()
+        if self.journal is None:
+            self.log_change(self.version + 1, op, entry)
+        else:
+            # Changes other workers journaled first are applied along the way
+            self.apply_journal(self.journal.append_file_change(op, entry, self.version))
+            self.journal_written = True
+    
+    def log_change(self, version, op, entry):
+        self.version = version
+        self.metadata_dirty = True
+        room = entry['room']
+        change = {
+            'version': version,
+            'prev': self.room_versions.get(room, self.room_base),
+            'op': op,
+            'file': {'name': entry['name'], 'room': room} if op == 'removed' else self.public_entry(entry)
+        }
+        self.room_versions[room] = version
+        self.changes.append(change)
+        self.pending.append(change)
+    
+    def apply_journal(self, changes):
+        # Caller holds the lock. A gap means the journal was trimmed past our
+        # version, so start over from its snapshot.
+        if changes and changes[0][0] > self.version + 1:
+            self.reload()
+            return
+        for version, op, entry in changes:
+            if version <= self.version:
+                continue
+            if op == 'reset':
+                self.reload()
+                continue
+            if op == 'removed':
+                self.entries.pop(entry['name'], None)
+            else:
+                self.entries[entry['name']] = entry
+            self.log_change(version, op, entry)
+    
+    def reload(self):
+        # Caller holds the lock
+        entries, version = self.journal.get_files()
+        self.entries = {entry['name']: entry for entry in entries}
+        self.version = version
+        self.metadata_dirty = True
+        self.changes.clear()
+        self.room_versions = {}
+        self.room_base = version
+        self.pending.append({'version': version, 'op': 'reset', 'file': None})
+    
+    def follow(self):
+        # Picks up changes other workers wrote to the journal
+        if self.journal is None:
+            return
+        with self.lock:
+            self.apply_journal(self.journal.file_changes_since(self.version))
+        self.notify()
+    
+    def notify(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            written, self.journal_written = self.journal_written, False
+        for change in pending:
+            for listener in self.listeners:
+                listener(change)
+        if written and self.on_journal_write is not None:
+            self.on_journal_write()
+    
+    def changes_since(self, since, room=None):
+        # Returns (changes, version); changes is None when the client is too
+        # far behind the change log and has to reload the list
+        if self.journal is not None and isinstance(since, int) and since > self.version:
+            # The client already saw a newer version through another worker
+            self.follow()
+        with self.lock:
+            if not isinstance(since, int) or since > self.version:
+                return None, self.version
+            if since == self.version:
+                return [], self.version
+            if not self.changes or self.changes[0]['version'] > since + 1:
+                return None, self.version
+            return [c for c in self.changes if c['version'] > since and (room is None or c['file']['room'] == room)], \
+                self.version
+    
+    def rescan(self):
+        if self.journal is not None:
+            self.follow()
+            if not self.leader:
+                return
+        try:
+            scanned = {}
+            with os.scandir(self.folder) as it:
+                for item in it:
+                    if not item.name.startswith('.') and item.is_file():
+                        scanned[item.name] = item.stat()
+        except OSError:
+            return
+        
+        with self.lock:
+            for name, entry in list(self.entries.items()):
+                if not entry['blob'] and name not in scanned:
+                    self.record('removed', self.entries.pop(name))
+            for name, stat in scanned.items():
+                entry = self.entries.get(name)
+                if entry is None:
+                    meta = self.metadata.get(name, {})
+                    entry = self.make_entry(name, stat.st_size, stat.st_mtime_ns, meta.get('uploader'), meta.get('sha256'),
+                                            room=meta.get('room'))
+                    self.entries[name] = entry
+                    self.record('added', entry)
+                elif entry['blob']:
+                    continue  # The blob mapping wins over a stray file of the same name
+                elif entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+                    # Modified in place: the recorded hash no longer applies
+                    entry = self.make_entry(name, stat.st_size, stat.st_mtime_ns, entry['uploader'], room=entry['room'])
+                    self.entries[name] = entry
+                    self.record('changed', entry)
+        self.notify()
+    
+    def add(self, name, uploader=None, sha256=None, room=None):
+        try:
+            stat = os.stat(os.path.join(self.folder, name))
+        except OSError:
+            return None
+        with self.lock:
+            entry = self.make_entry(name, stat.st_size, stat.st_mtime_ns, uploader, sha256, room=room)
+            self.record('changed' if name in self.entries else 'added', entry)
+            self.entries[name] = entry
+        self.notify()
+        return entry
+    
+    def add_blob(self, name, digest, size, uploader=None, room=None):
+        # Returns the entry the name pointed at before, if any; its blob may
+        # now be unused
+        with self.lock:
+            entry = self.make_entry(name, size, time.time_ns(), uploader, digest, digest, room)
+            previous = self.entries.get(name)
+            self.record('changed' if previous is not None else 'added', entry)
+            self.entries[name] = entry
+        # The mapping is the only record of this name, so persist it right away
+        self.save_metadata()
+        self.notify()
+        return previous
+    
+    def remove(self, name):
+        with self.lock:
+            entry = self.entries.pop(name, None)
+            if entry is not None:
+                self.record('removed', entry)
+        if entry is not None and entry['blob']:
+            self.save_metadata()
+        self.notify()
+        return entry
+    
+    def names(self):
+        with self.lock:
+            return list(self.entries)
+    
+    def blobs_with_size(self, size):
+        with self.lock:
+            return {entry['blob'] for entry in self.entries.values() if entry['blob'] and entry['size'] == size}
+    
+    def blob_in_use(self, digest):
+        with self.lock:
+            return any(entry['blob'] == digest for entry in self.entries.values())
+    
+    def blob_rooms(self, digest):
+        with self.lock:
+            return {entry['room'] for entry in self.entries.values() if entry['blob'] == digest}
+    
+    def get(self, name):
+        with self.lock:
+            return self.entries.get(name)
+    
+    def continue_from(self, version):
+        # Picks up after another folder's catalog. Deltas don't carry across
+        # folders; clients holding an older version are told to reload.
+        with self.lock:
+            self.version = max(self.version, version) + 1
+            self.changes.clear()
+            self.room_versions = {}
+            self.room_base = self.version
+            self.pending.append({'version': self.version, 'op': 'reset', 'file': None})
+    
+    def public_entry(self, entry):
+        return {
+            'name': entry['name'],
+            'size': entry['size'],
+            'modified': entry['modified'],
+            'uploader': entry['uploader'],
+            'room': entry['room'],
+            'preview': preview_kind(entry['name'])
+        }
+    
+    def json_payload(self):
+        # The default room's files; rebuilt at most once per catalog version,
+        # every other call is O(1)
+        with self.lock:
+            if self.payload_version != self.version:
+                keys, entries, version = self.sorted_view('name', DEFAULT_ROOM)
+                self.payload = json.dumps([self.public_entry(e) for e in entries]).encode('utf-8')
+                self.payload_version = self.version
+            return self.payload
+    
+    def sorted_view(self, sort, room=None):
+        # Views are per room, so a room's listing costs what its files do
+        with self.lock:
+            if self.views_version != self.version:
+                self.views = {}
+                self.filter_counts = {}
+                self.views_version = self.version
+            view = self.views.get((sort, room))
+            if view is None:
+                key = self.SORT_KEYS[sort]
+                items = sorted(((key(e), e) for e in self.entries.values() if room is None or e['room'] == room),
+                               key=lambda item: item[0])
+                view = ([k for k, e in items], [e for k, e in items], self.version)
+                self.views[(sort, room)] = view
+            return view
+    
+    def page(self, sort='name', descending=False, after=None, limit=100, query=None, prefix=None, room=None):
+        # Keyset pagination over a cached sorted view: the cursor is the sort
+        # key of the last entry returned, so pages stay stable under inserts
+        keys, entries, version = self.sorted_view(sort, room)
+        query = query.lower() if query else None
+        
+        def matches(entry):
+            if prefix and not entry['name'].startswith(prefix):
+                return False
+            return not query or query in entry['name'].lower()
+        
+        if descending:
+            start = bisect.bisect_left(keys, after) - 1 if after is not None else len(keys) - 1
+            indices = range(start, -1, -1)
+        else:
+            start = bisect.bisect_right(keys, after) if after is not None else 0
+            indices = range(start, len(keys))
+        
+        found = []
+        for i in indices:
+            if matches(entries[i]):
+                found.append(i)
+                if len(found) > limit:
+                    break
+        next_key = keys[found[limit - 1]] if len(found) > limit else None
+        
+        if query or prefix:
+            with self.lock:
+                total = self.filter_counts.get((version, room, query, prefix))
+                if total is None:
+                    total = sum(1 for e in entries if matches(e))
+                    self.filter_counts[(version, room, query, prefix)] = total
+        else:
+            total = len(entries)
+        
+        return [entries[i] for i in found[:limit]], next_key, total, version
+    
+    def start_watcher(self):
+        if self.watcher is not None:
+            return
+        stop = threading.Event()
+        if Observer is not None:
+            try:
+                self.observer = Observer()
+                self.observer.schedule(CatalogEventHandler(self), self.folder, recursive=False)
+                self.observer.start()
+            except Exception:
+                self.observer = None
+        self.watcher = (threading.Thread(target=self.watch, args=(stop,), daemon=True), stop)
+        self.watcher[0].start()
+    
+    def stop_watcher(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer = None
+        if self.watcher is not None:
+            thread, stop = self.watcher
+            stop.set()
+            self.changed.set()
+            thread.join(timeout=5)
+            self.watcher = None
+    
+    def watch(self, stop):
+        # Without inotify, a directory mtime change triggers a rescan, and a
+        # periodic full scan catches files modified in place
+        last_dir_mtime = None
+        last_full_scan = time.time()
+        while not stop.is_set():
+            self.changed.wait(self.poll_interval)
+            if stop.is_set():
+                break
+            rescan = self.changed.is_set()
+            self.changed.clear()
+            try:
+                dir_mtime = os.stat(self.folder).st_mtime_ns
+            except OSError:
+                dir_mtime = None
+            if dir_mtime != last_dir_mtime:
+                last_dir_mtime = dir_mtime
+                rescan = True
+            if time.time() - last_full_scan >= self.full_scan_interval:
+                last_full_scan = time.time()
+                rescan = True
+            if rescan:
+                self.rescan()
+            elif self.journal is not None:
+                self.follow()
+            self.save_metadata()
+        self.save_metadata()
+
+SAMPLE_BLOCK_SIZE = 64 * 1024
+
+def open_stored(path, encoding=None):
+    # Opens a file as kept on disk, decompressing it if it is stored gzipped
+    if encoding == 'gzip':
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def sample_fingerprint(path, size, encoding=None):
+    # SHA-256 over the first, middle and last 64KB (the whole file when it is
+    # small). The web client computes the same value before uploading.
+    if size <= 3 * SAMPLE_BLOCK_SIZE:
+        offsets = [(0, size)]
+    else:
+        middle = (size - SAMPLE_BLOCK_SIZE) // 2
+        offsets = [(0, SAMPLE_BLOCK_SIZE), (middle, SAMPLE_BLOCK_SIZE), (size - SAMPLE_BLOCK_SIZE, SAMPLE_BLOCK_SIZE)]
+    hasher = hashlib.sha256()
+    with open_stored(path, encoding) as f:
+        for offset, length in offsets:
+            f.seek(offset)
+            hasher.update(f.read(length))
+    return hasher.hexdigest()
+
+class BlobStore:
+    # Content-addressed storage: each distinct upload is kept once under
+    # <root>/<aa>/<bb>/<sha256>, and names point at blobs through the catalog.
+    # With compression at rest a blob may be kept as <sha256>.gz instead.
+    # Linking a name to a blob and dropping a blob's last name happen under
+    # locked(), so a blob is never removed between the in-use check and the
+    # unlink; shared stores (cluster workers) also take a lock file.
+    def __init__(self, root, shared=False):
+        self.root = root
+        self.shared = shared
+        self.samples = {}
+        self.lock = threading.RLock()
+    
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            lock_file = None
+            if self.shared and fcntl is not None:
+                os.makedirs(self.root, exist_ok=True)
+                lock_file = open(os.path.join(self.root, '.lock'), 'ab')
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if lock_file is not None:
+                    lock_file.close()
+    
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+    
+    def stored(self, digest):
+        # (path, content encoding) of the blob as it is on disk
+        path = self.path(digest)
+        if os.path.isfile(path):
+            return path, None
+        return path + '.gz', 'gzip'
+    
+    def has(self, digest):
+        path = self.path(digest)
+        return os.path.isfile(path) or os.path.isfile(path + '.gz')
+    
+    def size(self, digest):
+        path, encoding = self.stored(digest)
+        if encoding is None:
+            return os.path.getsize(path)
+        # gzip's trailer holds the size mod 4GB; bigger blobs aren't compressed
+        with open(path, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            return struct.unpack('<I', f.read(4))[0]
+    
+    def put(self, part_path, digest):
+        # Identical content is already stored: drop the new copy. Callers
+        # hold locked() until the name is in the catalog.
+        path = self.path(digest)
+        if self.has(digest):
+            os.remove(part_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(part_path, path)
+        return path
+    
+    def compress(self, digest, level=6):
+        # Replaces a raw blob with its gzipped copy; readers that already
+        # opened the raw file keep reading it
+        path = self.path(digest)
+        tmp_path = '%s.gz.%s.tmp' % (path, uuid.uuid4().hex)
+        try:
+            with open(path, 'rb') as src, gzip.open(tmp_path, 'wb', compresslevel=level) as dst:
+                while True:
+                    data = src.read(1024 * 1024)
+                    if not data:
+                        break
+                    dst.write(data)
+            with self.locked():
+                # Removed while we were compressing: don't bring it back
+                if not os.path.isfile(path):
+                    raise FileNotFoundError(path)
+                os.replace(tmp_path, path + '.gz')
+                os.remove(path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+    
+    def remove(self, digest):
+        self.samples.pop(digest, None)
+        for path in (self.path(digest), self.path(digest) + '.gz'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    
+    def sample(self, digest, size):
+        # Blobs never change, so their sampled fingerprint is cached for good
+        sample = self.samples.get(digest)
+        if sample is None:
+            path, encoding = self.stored(digest)
+            sample = sample_fingerprint(path, size, encoding)
+            self.samples[digest] = sample
+        return sample
+
+# Formats that are compressed already, so compressing them again only costs CPU
+INCOMPRESSIBLE_EXTENSIONS = {'.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar', '.jar', '.apk', '.jpg',
+                             '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif', '.mp3', '.m4a', '.aac', '.ogg',
+                             '.flac', '.opus', '.mp4', '.m4v', '.mkv', '.mov', '.avi', '.webm', '.pdf', '.docx',
+                             '.xlsx', '.pptx', '.odt', '.ods', '.epub', '.woff', '.woff2'}
+COMPRESS_PROBE_SIZE = 64 * 1024
+
+# Content encodings offered for downloads, most preferred first
+DOWNLOAD_ENCODINGS = (['zstd'] if zstandard is not None else []) + (['br'] if brotli is not None else []) + ['gzip']
+ENCODING_EXTENSIONS = {'zstd': 'zst', 'br': 'br', 'gzip': 'gz'}
+
+def compression_ratio(path, size):
+    # Compressed size over raw size for a sample from the start and middle of
+    # the file, at a fast level; close to 1 means not worth compressing
+    with open(path, 'rb') as f:
+        sample = f.read(COMPRESS_PROBE_SIZE)
+        if size > 2 * COMPRESS_PROBE_SIZE:
+            f.seek(size // 2)
+            sample += f.read(COMPRESS_PROBE_SIZE)
+    if not sample:
+        return 1.0
+    return len(zlib.compress(sample, 1)) / len(sample)
+
+class StreamCompressor:
+    # One interface over the zlib, zstandard and brotli streaming compressors
+    def __init__(self, encoding):
+        if encoding == 'zstd':
+            compressor = zstandard.ZstdCompressor(level=3).compressobj()
+            self.compress, self.finish = compressor.compress, compressor.flush
+        elif encoding == 'br':
+            compressor = brotli.Compressor(quality=5)
+            self.compress, self.finish = compressor.process, compressor.finish
+        else:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31: gzip container
+            self.compress, self.finish = compressor.compress, compressor.flush
+
+PREVIEW_TEXT_EXTENSIONS = {'.txt', '.md', '.csv', '.log', '.json', '.xml', '.yaml', '.yml', '.ini', '.cfg', '.conf',
+                           '.py', '.js', '.ts', '.html', '.css', '.sh', '.bat', '.c', '.h', '.cpp', '.java', '.go',
+                           '.rs', '.rb', '.php', '.sql'}
+PREVIEW_TYPES = {'jpg': 'image/jpeg', 'png': 'image/png', 'txt': 'text/plain; charset=utf-8'}
+
+def preview_kind(name):
+    # What kind of preview a file can have, if any
+    mimetype = mimetypes.guess_type(name)[0] or ''
+    if mimetype.startswith('image/') and Image is not None:
+        return 'image'
+    if mimetype == 'application/pdf' and fitz is not None:
+        return 'pdf'
+    if mimetype.startswith('text/') or os.path.splitext(name)[1].lower() in PREVIEW_TEXT_EXTENSIONS:
+        return 'text'
+    return None
+
+def render_preview(path, kind, size=256, text_bytes=4096, encoding=None):
+    # Runs in a preview worker process; returns (extension, data) or None
+    if kind == 'text':
+        with open_stored(path, encoding) as f:
+            data = f.read(text_bytes)
+        if b'\0' in data:
+            return None  # Binary after all
+        if len(data) == text_bytes and b'\n' in data:
+            data = data[:data.rindex(b'\n')]
+        return 'txt', data.decode('utf-8', errors='replace').encode('utf-8')
+    if kind == 'image':
+        with Image.open(path) as image:
+            image.draft('RGB', (size, size))  # JPEGs decode straight at a reduced scale
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((size, size))
+            output = io.BytesIO()
+            if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+                image.save(output, 'PNG', optimize=True)
+                return 'png', output.getvalue()
+            image.convert('RGB').save(output, 'JPEG', quality=80)
+            return 'jpg', output.getvalue()
+    if kind == 'pdf':
+        with fitz.open(path) as document:
+            page = document[0]
+            zoom = size / max(page.rect.width, page.rect.height)
+            pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            return 'png', pixmap.tobytes('png')
+    return None
+
+class DiskCache:
+    # Derived files (rendered previews, compressed variants) on disk as
+    # <key>.<ext>, least recently used first out once they take more than
+    # `max_bytes`. Hits bump the file's mtime, so the order survives restarts
+    # and is shared by the workers of a cluster; the in-memory index is
+    # rebuilt from the folder before evicting.
+    def __init__(self, folder, max_bytes=64 * 1024 * 1024, extensions=PREVIEW_TYPES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.extensions = extensions
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self.scan()
+    
+    def scan(self):
+        entries = []
+        with os.scandir(self.folder) as it:
+            for item in it:
+                key, ext = os.path.splitext(item.name)
+                if ext[1:] in self.extensions:
+                    stat = item.stat()
+                    entries.append((stat.st_mtime, key, ext[1:], stat.st_size))
+        entries.sort()
+        with self.lock:
+            self.index = OrderedDict((key, (ext, size)) for mtime, key, ext, size in entries)
+            self.total = sum(size for mtime, key, ext, size in entries)
+    
+    def path(self, key, ext):
+        return os.path.join(self.folder, key + '.' + ext)
+    
+    def get(self, key):
+        # Returns (path, extension) or None
+        with self.lock:
+            found = self.index.get(key)
+            if found is not None:
+                self.index.move_to_end(key)
+        if found is None:
+            # Maybe rendered by another worker
+            for ext in self.extensions:
+                if os.path.isfile(self.path(key, ext)):
+                    found = (ext, os.path.getsize(self.path(key, ext)))
+                    with self.lock:
+                        self.index[key] = found
+                    break
+            else:
+                return None
+        path = self.path(key, found[0])
+        try:
+            if time.time() - os.stat(path).st_mtime > 60:
+                os.utime(path)
+        except OSError:
+            with self.lock:
+                self.index.pop(key, None)
+            return None
+        return path, found[0]
+    
+    def put(self, key, ext, data):
+        tmp_path = self.temp_path(key, ext)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        self.put_file(key, ext, tmp_path)
+    
+    def temp_path(self, key, ext):
+        return '%s.%s.tmp' % (self.path(key, ext), uuid.uuid4().hex)
+    
+    def put_file(self, key, ext, tmp_path):
+        # Moves a finished temp_path() file into the cache
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, self.path(key, ext))
+        with self.lock:
+            previous = self.index.pop(key, None)
+            self.index[key] = (ext, size)
+            self.total += size - (previous[1] if previous else 0)
+            over = self.total > self.max_bytes
+        if over:
+            self.evict()
+    
+    def evict(self):
+        self.scan()
+        with self.lock:
+            while self.total > self.max_bytes and self.index:
+                key, (ext, size) = self.index.popitem(last=False)
+                self.total -= size
+                try:
+                    os.remove(self.path(key, ext))
+                except OSError:
+                    pass
+
+class GreenThreadPoolExecutor:
+    # Stand-in for the process pool under eventlet, whose patched threads never
+    # wake the pool's result handler. Runs each call on eventlet's pool of real
+    # OS threads and resolves the future from a green thread.
+    def submit(self, fn, *args):
+        import eventlet
+        from eventlet import tpool
+        future = Future()
+        def run():
+            try:
+                future.set_result(tpool.execute(fn, *args))
+            except Exception as e:
+                future.set_exception(e)
+        eventlet.spawn(run)
+        return future
+    
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+class PreviewPool:
+    # Renders previews in worker processes, since decoding images and PDFs is
+    # CPU-bound, and stores them in the cache. Asking for a preview that is
+    # already being rendered shares its future; files that fail to render
+    # are remembered so they aren't retried on every request.
+    def __init__(self, cache, workers=2, async_mode='threading'):
+        self.cache = cache
+        self.workers = workers
+        self.async_mode = async_mode
+        self.executor = None
+        self.pending = {}
+        self.failed = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def make_executor(self):
+        if self.async_mode == 'eventlet':
+            return GreenThreadPoolExecutor()
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+    
+    def submit(self, key, path, kind, size, text_bytes, encoding=None):
+        # Returns a future, or None when the preview can't be made
+        with self.lock:
+            if key in self.failed:
+                return None
+            future = self.pending.get(key)
+            if future is not None:
+                return future
+            if self.executor is None:
+                self.executor = self.make_executor()
+            future = self.executor.submit(render_preview, os.path.abspath(path), kind, size, text_bytes, encoding)
+            self.pending[key] = future
+        future.add_done_callback(lambda future: self.finish(key, future))
+        return future
+    
+    def finish(self, key, future):
+        failed = True
+        try:
+            result = future.result()
+        except FileNotFoundError:
+            # The source moved (compressed at rest, say) while queued; the
+            # next request tries again
+            result, failed = None, False
+        except Exception:
+            result = None
+        if result is not None:
+            try:
+                self.cache.put(key, *result)
+                failed = False
+            except OSError:
+                pass
+        with self.lock:
+            self.pending.pop(key, None)
+            if failed:
+                self.failed[key] = True
+                if len(self.failed) > 10000:
+                    self.failed.popitem(last=False)
+    
+    def run(self, fn, *args):
+        # Other CPU-bound work (text extraction for search) shares the workers
+        with self.lock:
+            if self.executor is None:
+                self.executor = self.make_executor()
+            return self.executor.submit(fn, *args)
+    
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+# Office formats are ZIPs of XML; these members hold their text
+SEARCH_DOCUMENT_PARTS = {
+    '.docx': 'word/document.xml',
+    '.pptx': 'ppt/slides/slide',
+    '.xlsx': 'xl/sharedStrings.xml',
+    '.odt': 'content.xml',
+    '.ods': 'content.xml',
+    '.odp': 'content.xml'
+}
+SEARCH_MARKS = ('\x02', '\x03')  # Around matched terms in snippets; the client turns them into <mark>
+
+def text_kind(name):
+    # How the searchable text of a file is extracted, if it has any
+    ext = os.path.splitext(name)[1].lower()
+    if ext in SEARCH_DOCUMENT_PARTS:
+        return 'document'
+    if ext == '.pdf':
+        return 'pdf' if fitz is not None else None
+    mimetype = mimetypes.guess_type(name)[0] or ''
+    if mimetype.startswith('text/') or ext in PREVIEW_TEXT_EXTENSIONS:
+        return 'markup' if mimetype in ('text/html', 'text/xml') or ext in ('.xml', '.htm', '.html') else 'text'
+    return None
+
+def extract_text(path, name, kind, encoding=None, max_chars=1024 * 1024):
+    # Runs in a preview worker process; the text of the shared file `name`
+    # kept at `path`, or None
+    if kind == 'pdf':
+        pages, total = [], 0
+        with fitz.open(path) as document:
+            for page in document:
+                pages.append(page.get_text())
+                total += len(pages[-1])
+                if total >= max_chars:
+                    break
+        return ''.join(pages)[:max_chars]
+    if kind == 'document':
+        prefix = SEARCH_DOCUMENT_PARTS[os.path.splitext(name)[1].lower()]
+        parts = []
+        with open_stored(path, encoding) as f, zipfile.ZipFile(f) as archive:
+            for member in sorted(archive.namelist()):
+                if member.startswith(prefix) and member.endswith('.xml'):
+                    with archive.open(member) as data:
+                        parts.append(data.read(4 * max_chars).decode('utf-8', errors='replace'))
+        text = ' '.join(parts)
+    else:
+        with open_stored(path, encoding) as f:
+            data = f.read(max_chars)
+        if b'\0' in data:
+            return None  # Binary after all
+        text = data.decode('utf-8', errors='replace')
+    if kind != 'text':
+        text = unescape_html(re.sub(r'<[^>]*>', ' ', text))
+    return re.sub(r'\s+', ' ', text).strip()[:max_chars]
+
+def fts_query(text):
+    # Every word of a search box query must appear, as a word or a prefix of
+    # one; FTS5 operators typed by the user are taken as plain words
+    words = re.findall(r'\w+', text)[:16]
+    return ' '.join('"%s"*' % word for word in words) or None
+
+class SearchIndex:
+    # Full-text index over chat messages and shared files: FTS5 tables in
+    # their own SQLite database, opened by every worker of a cluster. File
+    # rows carry the content version they were extracted from, so unchanged
+    # files are never extracted twice. Searches go through a connection of
+    # their own: in WAL mode they read the last commit instead of queueing
+    # behind the indexer's writes.
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS message_text USING fts5(body, username UNINDEXED, room UNINDEXED,
+                seq UNINDEXED, id UNINDEXED, posted UNINDEXED, tokenize='unicode61 remove_diacritics 2',
+                prefix='2 3');
+            CREATE TABLE IF NOT EXISTS indexed_files (id INTEGER PRIMARY KEY, name TEXT UNIQUE, version TEXT,
+                                                      room TEXT);
+            CREATE VIRTUAL TABLE IF NOT EXISTS file_text USING fts5(name, content,
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3');
+        ''')
+        self.read_lock = threading.Lock()
+        self.reader = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+    
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+    
+    def read(self, sql, params=()):
+        with self.read_lock:
+            return self.reader.execute(sql, params).fetchall()
+    
+    def transaction(self, work):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                result = work(self.db)
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+            return result
+    
+    def add_message(self, message):
+        with self.lock:
+            self.db.execute('INSERT INTO message_text VALUES (?, ?, ?, ?, ?, ?)',
+                            (message['message'], message['username'], message['room'], message.get('seq'),
+                             message['id'], time.time()))
+    
+    def clear_messages(self):
+        with self.lock:
+            self.db.execute('DELETE FROM message_text')
+    
+    def file_version(self, name):
+        rows = self.query('SELECT version FROM indexed_files WHERE name = ?', (name,))
+        return rows[0][0] if rows else None
+    
+    def file_names(self):
+        return {row[0] for row in self.query('SELECT name FROM indexed_files')}
+    
+    def add_file(self, name, version, room, content):
+        def work(db):
+            row = db.execute('SELECT id FROM indexed_files WHERE name = ?', (name,)).fetchone()
+            if row is not None:
+                db.execute('DELETE FROM file_text WHERE rowid = ?', row)
+                db.execute('UPDATE indexed_files SET version = ?, room = ? WHERE id = ?', (version, room, row[0]))
+                file_id = row[0]
+            else:
+                file_id = db.execute('INSERT INTO indexed_files (name, version, room) VALUES (?, ?, ?)',
+                                     (name, version, room)).lastrowid
+            db.execute('INSERT INTO file_text (rowid, name, content) VALUES (?, ?, ?)', (file_id, name, content))
+        self.transaction(work)
+    
+    def remove_file(self, name):
+        def work(db):
+            row = db.execute('SELECT id FROM indexed_files WHERE name = ?', (name,)).fetchone()
+            if row is not None:
+                db.execute('DELETE FROM file_text WHERE rowid = ?', row)
+                db.execute('DELETE FROM indexed_files WHERE id = ?', row)
+        self.transaction(work)
+    
+    def search_messages(self, query, rooms, limit=20):
+        # Best matches first (bm25), each with a snippet around the terms
+        rows = self.read('''
+            SELECT room, seq, id, username, posted, snippet(message_text, 0, ?, ?, '…', 24) FROM message_text
+            WHERE message_text MATCH ? AND room IN (%s) ORDER BY rank LIMIT ?
+        ''' % ','.join('?' * len(rooms)), SEARCH_MARKS + (query,) + tuple(rooms) + (limit,))
+        return [{'room': room, 'seq': seq, 'id': message_id, 'username': username, 'posted': posted,
+                 'snippet': snippet} for room, seq, message_id, username, posted, snippet in rows]
+    
+    def search_files(self, query, rooms, limit=20):
+        # A match in the name counts ten times one in the content
+        rows = self.read('''
+            SELECT f.name, f.room, highlight(file_text, 0, ?, ?), snippet(file_text, 1, ?, ?, '…', 24)
+            FROM file_text JOIN indexed_files f ON f.id = file_text.rowid
+            WHERE file_text MATCH ? AND f.room IN (%s) ORDER BY bm25(file_text, 10.0, 1.0) LIMIT ?
+        ''' % ','.join('?' * len(rooms)), SEARCH_MARKS * 2 + (query,) + tuple(rooms) + (limit,))
+        return [{'name': name, 'room': room, 'name_snippet': name_snippet, 'snippet': snippet}
+                for name, room, name_snippet, snippet in rows]
+    
+    def close(self):
+        with self.read_lock:
+            self.reader.close()
+        with self.lock:
+            self.db.close()
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DURATION_BUCKETS = (0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+THROUGHPUT_BUCKETS = (64e3, 256e3, 1e6, 4e6, 16e6, 32e6, 64e6, 128e6, 256e6, 512e6, 1e9)  # Bytes per second
+
+class CounterValue:
+    def __init__(self):
+        self.value = 0
+    
+    def inc(self, amount=1):
+        self.value += amount
+    
+    def dec(self, amount=1):
+        self.value -= amount
+    
+    def set(self, value):
+        self.value = value
+
+class HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+    
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+class Metric:
+    # One metric family and its labelled children. Updates are plain
+    # increments without a lock: under the GIL an integer or float += on an
+    # attribute doesn't interleave with another thread's in practice, and in
+    # the cooperative modes it can't at all. Children are created on first use.
+    def __init__(self, name, kind, help_text, labelnames=(), buckets=None):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.children = {}
+    
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = HistogramValue(self.buckets) if self.kind == 'histogram' else CounterValue()
+            child = self.children.setdefault(values, child)
+        return child
+    
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+    
+    def observe(self, value):
+        self.labels().observe(value)
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in pairs)
+
+class MetricsRegistry:
+    # Counters, gauges and histograms in the Prometheus text format. Gauges
+    # that mirror state kept elsewhere (queue depths, connected sessions) are
+    # callbacks read at scrape time, so they cost nothing on the hot paths.
+    def __init__(self, prefix='lanshare_', const_labels=()):
+        self.prefix = prefix
+        self.const_labels = tuple(const_labels)
+        self.metrics = []
+        self.callbacks = []
+    
+    def add(self, name, kind, help_text, labelnames=(), buckets=None):
+        metric = Metric(self.prefix + name, kind, help_text, tuple(labelnames), buckets)
+        self.metrics.append(metric)
+        return metric
+    
+    def counter(self, name, help_text, labelnames=()):
+        return self.add(name, 'counter', help_text, labelnames)
+    
+    def gauge(self, name, help_text, labelnames=()):
+        return self.add(name, 'gauge', help_text, labelnames)
+    
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.add(name, 'histogram', help_text, labelnames, tuple(buckets))
+    
+    def callback(self, name, kind, help_text, read, labelnames=()):
+        # read() returns a number, or {label values: number} with labelnames
+        self.callbacks.append((self.prefix + name, kind, help_text, tuple(labelnames), read))
+    
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help_text))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for values, child in list(metric.children.items()):
+                if metric.kind != 'histogram':
+                    labels = format_labels(metric.labelnames, values, self.const_labels)
+                    lines.append('%s%s %s' % (metric.name, labels, child.value))
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ('+Inf',), list(child.counts)):
+                    cumulative += count
+                    labels = format_labels(metric.labelnames, values, self.const_labels + (('le', bound),))
+                    lines.append('%s_bucket%s %d' % (metric.name, labels, cumulative))
+                labels = format_labels(metric.labelnames, values, self.const_labels)
+                lines.append('%s_sum%s %s' % (metric.name, labels, child.sum))
+                lines.append('%s_count%s %d' % (metric.name, labels, cumulative))
+        for name, kind, help_text, labelnames, read in self.callbacks:
+            try:
+                value = read()
+            except Exception:
+                continue  # A broken callback must not take the endpoint down
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for values, number in (value.items() if isinstance(value, dict) else [((), value)]):
+                lines.append('%s%s %s' % (name, format_labels(labelnames, values, self.const_labels), number))
+        return '\n'.join(lines) + '\n'
+
+class TokenBucket:
+    # Rate in bytes per second; 0 means unlimited. Consumers take tokens up
+    # front and sleep off any debt, so concurrent users share the rate.
+    def __init__(self, rate, burst_seconds=0.25):
+        self.rate = rate
+        self.burst_seconds = burst_seconds
+        self.tokens = rate * burst_seconds
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.tokens = min(self.tokens, rate * self.burst_seconds)
+    
+    def reserve(self, amount):
+        # Returns how long the caller has to wait before sending amount bytes
+        with self.lock:
+            if self.rate <= 0:
+                return 0
+            now = time.monotonic()
+            self.tokens = min(self.rate * self.burst_seconds, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+class BandwidthShaper:
+    # Token buckets shared by upload ingestion and download streaming:
+    # one global bucket plus one per client IP and one per login session.
+    def __init__(self, total=0, per_ip=0, per_session=0):
+        self.rates = {'total': total, 'ip': per_ip, 'session': per_session}
+        self.total_bucket = TokenBucket(total)
+        self.buckets = {}
+        self.lock = threading.Lock()
+    
+    def set_limits(self, total, per_ip, per_session):
+        with self.lock:
+            self.rates = {'total': total, 'ip': per_ip, 'session': per_session}
+            self.total_bucket.set_rate(total)
+            for (kind, key), bucket in self.buckets.items():
+                bucket.set_rate(self.rates[kind])
+    
+    def is_active(self):
+        return any(rate > 0 for rate in self.rates.values())
+    
+    def get_bucket(self, kind, key):
+        with self.lock:
+            bucket = self.buckets.get((kind, key))
+            if bucket is None:
+                if len(self.buckets) > 1024:
+                    # Forget buckets that have been idle long enough to refill
+                    cutoff = time.monotonic() - 60
+                    self.buckets = {k: b for k, b in self.buckets.items() if b.updated > cutoff}
+                bucket = TokenBucket(self.rates[kind])
+                self.buckets[(kind, key)] = bucket
+            return bucket
+    
+    def throttle(self, keys, amount):
+        if not self.is_active():
+            return
+        delay = self.total_bucket.reserve(amount)
+        for kind, key in keys:
+            if self.rates[kind] > 0:
+                delay = max(delay, self.get_bucket(kind, key).reserve(amount))
+        if delay > 0:
+            time.sleep(delay)
+
+class TransferLimiter:
+    # Caps concurrent transfer requests per user and across the server.
+    # Requests over budget are turned away (429) instead of queueing, and the
+    # client retries with backoff.
+    def __init__(self, per_user, total):
+        self.per_user = per_user
+        self.total = total
+        self.active = {}
+        self.active_total = 0
+        self.lock = threading.Lock()
+    
+    def acquire(self, key):
+        with self.lock:
+            if self.active_total >= self.total or self.active.get(key, 0) >= self.per_user:
+                return False
+            self.active[key] = self.active.get(key, 0) + 1
+            self.active_total += 1
+            return True
+    
+    def release(self, key):
+        with self.lock:
+            count = self.active.get(key, 0) - 1
+            if count > 0:
+                self.active[key] = count
+            else:
+                self.active.pop(key, None)
+            self.active_total = max(0, self.active_total - 1)
+
+def websocket_frame_size(payload_size):
+    return payload_size + (2 if payload_size < 126 else 4 if payload_size < 65536 else 10)
+
+class BroadcastQueue:
+    # Coalesces broadcasts: events published to a room within `window`
+    # seconds go out as one 'batch' frame, a lone event as itself. A batch
+    # groups runs of the same event: [[event, [data, ...]], ...]. Counts the
+    # frames and bytes sent per recipient, and what sending every event on
+    # its own would have cost on top.
+    def __init__(self, socketio, window=0.02):
+        self.socketio = socketio
+        self.window = window
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.scheduled = False
+        self.stats = {'events': 0, 'frames': 0, 'bytes': 0, 'frames_saved': 0, 'bytes_saved': 0}
+        self.emit_seconds = None  # Histogram of fan-out times, set by the server
+    
+    def publish(self, event, data, room=None, local=False):
+        # local=True skips the cluster message queue
+        with self.lock:
+            self.pending.setdefault((room, local), []).append((event, data))
+            self.stats['events'] += 1
+            if self.scheduled:
+                return
+            self.scheduled = True
+        if self.window > 0:
+            self.socketio.start_background_task(self.flush_later)
+        else:
+            self.flush()
+    
+    def flush_later(self):
+        self.socketio.sleep(self.window)
+        self.flush()
+    
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.scheduled = False
+        for (room, local), events in pending.items():
+            options = {'to': room, 'ignore_queue': True} if local else {'to': room}
+            if len(events) == 1:
+                packet = list(events[0])
+            else:
+                runs = []
+                for event, data in events:
+                    if runs and runs[-1][0] == event:
+                        runs[-1][1].append(data)
+                    else:
+                        runs.append([event, [data]])
+                packet = ['batch', runs]
+            started = time.perf_counter()
+            self.socketio.emit(packet[0], packet[1], **options)
+            if self.emit_seconds is not None:
+                self.emit_seconds.observe(time.perf_counter() - started)
+            self.count(room, events, packet)
+    
+    def count(self, room, events, packet):
+        # Socket.IO text packets ('42' + JSON) in websocket frames
+        dumps = lambda value: len(json.dumps(value, separators=(',', ':'))) + 2
+        frame_size = websocket_frame_size(dumps(packet))
+        separate_size = sum(websocket_frame_size(dumps([event, data])) for event, data in events) \
+            if len(events) > 1 else frame_size
+        recipients = sum(1 for _ in self.socketio.server.manager.get_participants('/', room))
+        with self.lock:
+            self.stats['frames'] += recipients
+            self.stats['bytes'] += frame_size * recipients
+            self.stats['frames_saved'] += (len(events) - 1) * recipients
+            self.stats['bytes_saved'] += (separate_size - frame_size) * recipients
+    
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+class PresenceTracker:
+    # Who is online, pushed to clients as versioned add/remove/status diffs
+    # instead of full user lists. Presence is tracked per socket, and a user
+    # only goes offline `grace` seconds after their last socket closes, so a
+    # reconnect is invisible to everyone else. Clients heartbeat whether the
+    # user is active; a user whose sockets are all idle, or stop heartbeating
+    # for `timeout` seconds, shows as idle.
+    def __init__(self, state, broadcasts, socketio, heartbeat=30, timeout=90, grace=5):
+        self.state = state
+        self.broadcasts = broadcasts
+        self.socketio = socketio
+        self.heartbeat_interval = heartbeat
+        self.timeout = timeout
+        self.grace = grace
+        self.running = False
+    
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.socketio.start_background_task(self.sweep)
+    
+    def stop(self):
+        self.running = False
+    
+    def connect(self, sid, username, info):
+        self.state.add_session(sid, username, info)
+        self.update(username)
+    
+    def disconnect(self, sid):
+        username = self.state.remove_session(sid)
+        if username:
+            self.socketio.start_background_task(self.update_later, username)
+    
+    def heartbeat(self, sid, active):
+        username = self.state.touch_session(sid, 'active' if active else 'idle')
+        if username:
+            self.update(username)
+    
+    def snapshot(self):
+        return self.state.get_presence()
+    
+    def update(self, username):
+        diff = self.state.reconcile_presence(username)
+        if diff:
+            diff['timestamp'] = datetime.now().strftime('%H:%M:%S')
+            self.broadcasts.publish('presence', diff, room='main_room')
+    
+    def update_later(self, username):
+        self.socketio.sleep(self.grace)
+        self.update(username)
+    
+    def sweep(self):
+        while self.running:
+            self.socketio.sleep(self.heartbeat_interval)
+            if not self.running:
+                break
+            try:
+                for username in self.state.expire_sessions(time.time() - self.timeout):
+                    self.update(username)
+            except Exception as e:
+                print(f"Presence sweep failed: {e}")
+
+class UploadSession:
+    # State of one resumable chunked upload. Chunks are written straight into
+    # a preallocated part file; received ranges are kept sorted and merged.
+    def __init__(self, upload_id, filename, original_name, size, uploader, part_path, meta_path):
+        self.upload_id = upload_id
+        self.filename = filename
+        self.original_name = original_name
+        self.size = size
+        self.uploader = uploader
+        self.part_path = part_path
+        self.meta_path = meta_path
+        self.received = []
+        self.last_activity = time.time()
+        self.lock = threading.Lock()
+        self.shared = False
+        self.room = DEFAULT_ROOM
+        self.hasher = hashlib.sha256()
+        self.hashed = 0
+        self.hash_lock = threading.Lock()
+    
+    @classmethod
+    def load(cls, meta_path):
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        upload = cls(meta['upload_id'], meta['filename'], meta['original_name'], meta['size'],
+                     meta['uploader'], meta['part_path'], meta_path)
+        upload.received = [list(r) for r in meta['received']]
+        upload.room = meta.get('room', DEFAULT_ROOM)
+        return upload
+    
+    def save(self):
+        meta = {
+            'upload_id': self.upload_id,
+            'filename': self.filename,
+            'original_name': self.original_name,
+            'size': self.size,
+            'uploader': self.uploader,
+            'part_path': self.part_path,
+            'received': self.received,
+            'room': self.room
+        }
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path)
+    
+    def refresh(self):
+        # Chunks of one upload can land on different workers; pick up the
+        # ranges they recorded
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                self.received = [list(r) for r in json.load(f)['received']]
+        except (OSError, ValueError, KeyError):
+            pass
+    
+    def lock_shared(self):
+        # Serializes metadata updates across processes through a lock on the
+        # part file, whose inode (unlike the metadata file's) never changes
+        if not self.shared or fcntl is None:
+            return None
+        lock_file = open(self.part_path, 'rb')
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        return lock_file
+    
+    def add_range(self, start, end):
+        with self.lock:
+            lock_file = self.lock_shared()
+            try:
+                if lock_file is not None:
+                    self.refresh()
+                ranges = []
+                for r_start, r_end in self.received:
+                    if r_end < start or r_start > end:
+                        ranges.append([r_start, r_end])
+                    else:
+                        start = min(start, r_start)
+                        end = max(end, r_end)
+                ranges.append([start, end])
+                ranges.sort()
+                self.received = ranges
+                self.last_activity = time.time()
+                self.save()
+            finally:
+                if lock_file is not None:
+                    lock_file.close()
+    
+    def advance_hash(self, block_size=1024 * 1024):
+        # Hash the contiguous prefix received so far. Chunks mostly arrive in
+        # order, so this reads back from the page cache and finalize only has
+        # to hash whatever is left.
+        with self.hash_lock:
+            with self.lock:
+                contiguous = self.received[0][1] if self.received and self.received[0][0] == 0 else 0
+            if contiguous <= self.hashed:
+                return
+            with open(self.part_path, 'rb') as f:
+                f.seek(self.hashed)
+                while self.hashed < contiguous:
+                    data = f.read(min(block_size, contiguous - self.hashed))
+                    if not data:
+                        break
+                    self.hasher.update(data)
+                    self.hashed += len(data)
+    
+    def hexdigest(self):
+        self.advance_hash()
+        return self.hasher.hexdigest()
+    
+    def received_bytes(self):
+        return sum(end - start for start, end in self.received)
+    
+    def is_complete(self):
+        return self.size == 0 or self.received == [[0, self.size]]
+    
+    def to_dict(self):
+        return {
+            'upload_id': self.upload_id,
+            'filename': self.filename,
+            'size': self.size,
+            'received': self.received,
+            'received_bytes': self.received_bytes()
+        }
+
+class ChatLog:
+    # Append-only chat history on disk: one JSON line per message in segment
+    # files named after their first sequence number, with the newest messages
+    # kept in a deque. append() only queues the write; a writer thread writes
+    # batches out with one fsync each. Whole segments are dropped once the
+    # newer ones hold `retain` messages.
+    def __init__(self, folder, tail_size=100, segment_size=4 * 1024 * 1024, retain=100000, flush_interval=0.2):
+        self.folder = folder
+        self.segment_size = segment_size
+        self.retain = retain
+        self.flush_interval = flush_interval
+        self.tail = deque(maxlen=tail_size)
+        self.pending = []
+        self.segments = []  # First sequence number of each segment, oldest first
+        self.first_seq = 1  # Oldest message kept
+        self.next_seq = 1
+        self.file = None
+        self.file_size = 0
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        os.makedirs(folder, exist_ok=True)
+        self.load()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+    
+    def segment_path(self, first_seq):
+        return os.path.join(self.folder, '%016d.log' % first_seq)
+    
+    def read_segment(self, first_seq):
+        # Returns (messages, bytes of whole lines); a torn last line from a
+        # crash is left out
+        messages = []
+        valid = 0
+        with open(self.segment_path(first_seq), 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    messages.append(json.loads(line))
+                except ValueError:
+                    break
+                valid += len(line)
+        return messages, valid
+    
+    def load(self):
+        self.segments = sorted(int(name[:-4]) for name in os.listdir(self.folder)
+                               if name.endswith('.log') and name[:-4].isdigit())
+        if not self.segments:
+            return
+        self.first_seq = self.segments[0]
+        messages = []
+        for index in range(len(self.segments) - 1, -1, -1):
+            segment_messages, valid = self.read_segment(self.segments[index])
+            if index == len(self.segments) - 1:
+                # Appends continue in the newest segment, after its last whole line
+                with open(self.segment_path(self.segments[index]), 'r+b') as f:
+                    f.truncate(valid)
+                self.file_size = valid
+                self.next_seq = segment_messages[-1]['seq'] + 1 if segment_messages else self.segments[index]
+            messages = segment_messages + messages
+            if len(messages) >= self.tail.maxlen:
+                break
+        self.tail.extend(messages)
+        self.file = open(self.segment_path(self.segments[-1]), 'ab')
+    
+    def append(self, message):
+        with self.lock:
+            message['seq'] = self.next_seq
+            self.next_seq += 1
+            self.tail.append(message)
+            self.pending.append(message)
+        self.wakeup.set()
+        return message['seq']
+    
+    def recent(self):
+        with self.lock:
+            return list(self.tail)
+    
+    def before(self, before, limit):
+        # Up to `limit` messages older than `before` (the newest ones when it
+        # is None), oldest first, and whether there are older ones still
+        with self.lock:
+            messages = [m for m in self.tail if before is None or m['seq'] < before]
+            in_tail = len(messages) > limit or not self.tail or self.tail[0]['seq'] <= self.first_seq
+        if in_tail:
+            return messages[-limit:], len(messages) > limit
+        
+        # Reach back into the segments, newest first
+        self.flush()
+        with self.write_lock:
+            messages = []
+            for first_seq in reversed(self.segments):
+                if before is not None and first_seq >= before:
+                    continue
+                try:
+                    segment_messages, valid = self.read_segment(first_seq)
+                except OSError:
+                    continue
+                messages = [m for m in segment_messages if before is None or m['seq'] < before] + messages
+                if len(messages) > limit:
+                    break
+        return messages[-limit:], len(messages) > limit
+    
+    def after(self, after, limit):
+        # Messages newer than `after` for a reconnecting client, or None when
+        # it missed more than the tail or than `limit`
+        with self.lock:
+            messages = [m for m in self.tail if m['seq'] > after]
+            if len(messages) > limit or after >= self.next_seq:
+                return None
+            if self.tail and self.tail[0]['seq'] > after + 1:
+                return None
+            return messages
+    
+    def write_loop(self):
+        while not self.closed:
+            self.wakeup.wait()
+            # Let a burst collect so it costs one write and one fsync
+            time.sleep(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except OSError:
+                pass  # The batch is retried on the next wakeup
+    
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                batch, self.pending = self.pending, []
+            if not batch:
+                return
+            try:
+                for message in batch:
+                    if self.file is None or self.file_size >= self.segment_size:
+                        self.start_segment(message['seq'])
+                    line = (json.dumps(message) + '\n').encode('utf-8')
+                    self.file.write(line)
+                    self.file_size += len(line)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except OSError:
+                with self.lock:
+                    self.pending = batch + self.pending
+                self.wakeup.set()
+                raise
+            self.compact()
+    
+    def start_segment(self, first_seq):
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.segment_path(first_seq), 'ab')
+        self.file_size = 0
+        self.segments.append(first_seq)
+    
+    def compact(self):
+        while len(self.segments) > 1 and self.next_seq - self.segments[1] >= self.retain:
+            try:
+                os.remove(self.segment_path(self.segments[0]))
+            except OSError:
+                pass
+            self.segments.pop(0)
+            self.first_seq = self.segments[0]
+    
+    def clear(self):
+        # Sequence numbers keep counting up so message ids stay unique
+        with self.write_lock:
+            with self.lock:
+                self.pending = []
+                self.tail.clear()
+                self.first_seq = self.next_seq
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            for first_seq in self.segments:
+                try:
+                    os.remove(self.segment_path(first_seq))
+                except OSError:
+                    pass
+            self.segments = []
+    
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.flush()
+        with self.write_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+def presence_op(current, status):
+    if status is None:
+        return 'remove'
+    return 'add' if current is None else 'status'
+
+def is_chat_seq(value):
+    # A message sequence number from a client; it must fit SQLite's INTEGER
+    return isinstance(value, int) and not isinstance(value, bool) and 0 <= value < 2 ** 63
+
+class LocalStateStore:
+    # Presence and counters of a single server process, plus the rooms and a
+    # chat log per room. The default room keeps the log folder it always had;
+    # the others get a folder under rooms/, and the room list with its
+    # members is kept in rooms.json.
+    def __init__(self, chat_folder, tail_size=100, segment_size=4 * 1024 * 1024, retain=100000, flush_interval=0.2):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.presence = {}
+        self.presence_version = 0
+        self.chat_folder = chat_folder
+        self.chat_options = (tail_size, segment_size, retain, flush_interval)
+        self.chat_logs = {}
+        self.rooms = {DEFAULT_ROOM: {'id': DEFAULT_ROOM, 'kind': 'channel', 'name': DEFAULT_ROOM, 'created_by': None}}
+        self.members = {}
+        self.stats = {'total_messages': 0, 'total_files_shared': 0}
+        os.makedirs(chat_folder, exist_ok=True)
+        self.load_rooms()
+    
+    def get_rooms_path(self):
+        return os.path.join(self.chat_folder, 'rooms.json')
+    
+    def load_rooms(self):
+        try:
+            with open(self.get_rooms_path(), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.rooms.update(data.get('rooms', {}))
+        self.members = {room_id: set(usernames) for room_id, usernames in data.get('members', {}).items()}
+    
+    def save_rooms(self):
+        # Caller holds the lock
+        path = self.get_rooms_path()
+        data = {'rooms': self.rooms, 'members': {room_id: sorted(m) for room_id, m in self.members.items()}}
+        try:
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            print(f"Error saving rooms: {e}")
+    
+    def chat_log(self, room_id):
+        with self.lock:
+            log = self.chat_logs.get(room_id)
+            if log is None:
+                folder = self.chat_folder if room_id == DEFAULT_ROOM else os.path.join(self.chat_folder, 'rooms', room_id)
+                log = self.chat_logs[room_id] = ChatLog(folder, *self.chat_options)
+            return log
+    
+    def add_session(self, sid, username, info):
+        with self.lock:
+            self.sessions[sid] = dict(info, username=username, status='active', last_seen=time.time())
+    
+    def touch_session(self, sid, status):
+        # The username when the session's status changed
+        with self.lock:
+            entry = self.sessions.get(sid)
+            if entry is None:
+                return None
+            entry['last_seen'] = time.time()
+            if entry['status'] == status:
+                return None
+            entry['status'] = status
+            return entry['username']
+    
+    def remove_session(self, sid):
+        with self.lock:
+            entry = self.sessions.pop(sid, None)
+            return entry['username'] if entry else None
+    
+    def expire_sessions(self, cutoff):
+        # Sessions that stopped heartbeating turn idle; also returns users
+        # announced as online who no longer have a session
+        with self.lock:
+            usernames = set()
+            for entry in self.sessions.values():
+                if entry['status'] == 'active' and entry['last_seen'] < cutoff:
+                    entry['status'] = 'idle'
+                    usernames.add(entry['username'])
+            online = {entry['username'] for entry in self.sessions.values()}
+            usernames.update(username for username in self.presence if username not in online)
+            return usernames
+    
+    def reconcile_presence(self, username):
+        # Brings the announced presence of `username` in line with its
+        # sessions; the diff to publish, or None if nothing changed
+        with self.lock:
+            statuses = [entry['status'] for entry in self.sessions.values() if entry['username'] == username]
+            status = ('active' if 'active' in statuses else 'idle') if statuses else None
+            current = self.presence.get(username)
+            if status == current:
+                return None
+            self.presence_version += 1
+            if status is None:
+                del self.presence[username]
+            else:
+                self.presence[username] = status
+            return {'version': self.presence_version, 'op': presence_op(current, status),
+                    'username': username, 'status': status}
+    
+    def get_presence(self):
+        with self.lock:
+            return {'version': self.presence_version,
+                    'users': [{'username': u, 'status': status} for u, status in self.presence.items()]}
+    
+    def get_users(self):
+        with self.lock:
+            users = {}
+            for entry in self.sessions.values():
+                user = users.setdefault(entry['username'], {'joined': entry['joined'], 'status': 'idle', 'sessions': 0})
+                user['sessions'] += 1
+                if entry['status'] == 'active':
+                    user['status'] = 'active'
+            return users
+    
+    def count_users(self):
+        with self.lock:
+            return len({entry['username'] for entry in self.sessions.values()})
+    
+    def user_sids(self, username):
+        with self.lock:
+            return [sid for sid, entry in self.sessions.items() if entry['username'] == username]
+    
+    def is_known_user(self, username):
+        # Connected now, or a member of some room
+        with self.lock:
+            return (any(entry['username'] == username for entry in self.sessions.values()) or
+                    any(username in members for members in self.members.values()))
+    
+    def create_room(self, room):
+        # Returns (room, created); an existing room with that id wins
+        with self.lock:
+            if room['id'] in self.rooms:
+                return self.rooms[room['id']], False
+            self.rooms[room['id']] = room
+            self.save_rooms()
+            return room, True
+    
+    def get_room(self, room_id):
+        with self.lock:
+            return self.rooms.get(room_id)
+    
+    def list_channels(self):
+        with self.lock:
+            return [dict(room, member_count=len(self.members.get(room['id'], ())))
+                    for room in self.rooms.values() if room['kind'] == 'channel']
+    
+    def add_member(self, room_id, username):
+        with self.lock:
+            members = self.members.setdefault(room_id, set())
+            if username in members:
+                return False
+            members.add(username)
+            self.save_rooms()
+            return True
+    
+    def remove_member(self, room_id, username):
+        with self.lock:
+            if username not in self.members.get(room_id, ()):
+                return False
+            self.members[room_id].discard(username)
+            self.save_rooms()
+            return True
+    
+    def is_member(self, room_id, username):
+        # Everyone is in the default room
+        with self.lock:
+            return room_id == DEFAULT_ROOM or username in self.members.get(room_id, ())
+    
+    def user_rooms(self, username):
+        with self.lock:
+            return [room for room_id, room in self.rooms.items()
+                    if room_id == DEFAULT_ROOM or username in self.members.get(room_id, ())]
+    
+    def append_message(self, room_id, message):
+        return self.chat_log(room_id).append(message)
+    
+    def get_messages(self, room_id=DEFAULT_ROOM):
+        return self.chat_log(room_id).recent()
+    
+    def messages_before(self, room_id, before, limit):
+        return self.chat_log(room_id).before(before, limit)
+    
+    def messages_after(self, room_id, after, limit):
+        return self.chat_log(room_id).after(after, limit)
+    
+    def clear_messages(self):
+        with self.lock:
+            room_ids = list(self.rooms)
+        for room_id in room_ids:
+            self.chat_log(room_id).clear()
+    
+    def incr_stat(self, name, amount=1):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + amount
+    
+    def set_stat(self, name, value):
+        with self.lock:
+            self.stats[name] = value
+    
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['active_users'] = self.count_users()
+        return stats
+    
+    def flush(self):
+        with self.lock:
+            logs = list(self.chat_logs.values())
+        for log in logs:
+            log.flush()
+    
+    def close(self):
+        with self.lock:
+            logs = list(self.chat_logs.values())
+        for log in logs:
+            log.close()
+
+class SqliteStateStore:
+    # The same state in a SQLite database (WAL mode) opened by every worker
+    # process on the host. It also holds the file catalog journal: the current
+    # entries plus a numbered change log, so all workers agree on versions.
+    FILE_LOG_SIZE = 1000
+    
+    def __init__(self, path, worker_id=0, history_size=100, history_retain=100000):
+        self.worker_id = worker_id
+        self.history_size = history_size
+        self.history_retain = history_retain
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, username TEXT, info TEXT, worker INTEGER,
+                                                 status TEXT, last_seen REAL);
+            CREATE TABLE IF NOT EXISTS presence (username TEXT PRIMARY KEY, status TEXT);
+            CREATE TABLE IF NOT EXISTS rooms (id TEXT PRIMARY KEY, data TEXT, last_seq INTEGER DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS members (room TEXT, username TEXT, PRIMARY KEY (room, username));
+            CREATE TABLE IF NOT EXISTS chat (room TEXT, seq INTEGER, data TEXT, PRIMARY KEY (room, seq));
+            CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER);
+            CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, entry TEXT);
+            CREATE TABLE IF NOT EXISTS file_log (version INTEGER PRIMARY KEY, op TEXT, entry TEXT);
+        ''')
+        self.transaction(self.migrate)
+    
+    def migrate(self, db):
+        db.execute('INSERT OR IGNORE INTO rooms (id, data) VALUES (?, ?)', (DEFAULT_ROOM, json.dumps(
+            {'id': DEFAULT_ROOM, 'kind': 'channel', 'name': DEFAULT_ROOM, 'created_by': None})))
+        if db.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages'").fetchone():
+            # History from before rooms belongs to the default room
+            db.execute('INSERT OR IGNORE INTO chat SELECT ?, seq, data FROM messages', (DEFAULT_ROOM,))
+            db.execute('UPDATE rooms SET last_seq = (SELECT COALESCE(MAX(seq), 0) FROM chat WHERE room = id)')
+            db.execute('DROP TABLE messages')
+    
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+    
+    def update(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).rowcount
+    
+    def transaction(self, work):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                result = work(self.db)
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+            return result
+    
+    def reset_presence(self):
+        # Whatever an earlier run of this worker left behind is stale
+        self.update('DELETE FROM sessions WHERE worker = ?', (self.worker_id,))
+    
+    def add_session(self, sid, username, info):
+        self.update('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?)',
+                    (sid, username, json.dumps(info), self.worker_id, 'active', time.time()))
+    
+    def touch_session(self, sid, status):
+        def work(db):
+            row = db.execute('SELECT username, status FROM sessions WHERE sid = ?', (sid,)).fetchone()
+            if row is None:
+                return None
+            db.execute('UPDATE sessions SET status = ?, last_seen = ? WHERE sid = ?', (status, time.time(), sid))
+            return row[0] if row[1] != status else None
+        return self.transaction(work)
+    
+    def remove_session(self, sid):
+        def work(db):
+            row = db.execute('SELECT username FROM sessions WHERE sid = ?', (sid,)).fetchone()
+            db.execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+            return row[0] if row else None
+        return self.transaction(work)
+    
+    def expire_sessions(self, cutoff):
+        def work(db):
+            usernames = {row[0] for row in db.execute(
+                "SELECT DISTINCT username FROM sessions WHERE status = 'active' AND last_seen < ?", (cutoff,))}
+            db.execute("UPDATE sessions SET status = 'idle' WHERE status = 'active' AND last_seen < ?", (cutoff,))
+            usernames.update(row[0] for row in db.execute(
+                'SELECT username FROM presence WHERE username NOT IN (SELECT username FROM sessions)'))
+            return usernames
+        return self.transaction(work)
+    
+    def reconcile_presence(self, username):
+        def work(db):
+            statuses = [row[0] for row in db.execute('SELECT status FROM sessions WHERE username = ?', (username,))]
+            status = ('active' if 'active' in statuses else 'idle') if statuses else None
+            row = db.execute('SELECT status FROM presence WHERE username = ?', (username,)).fetchone()
+            current = row[0] if row else None
+            if status == current:
+                return None
+            version = db.execute("SELECT COALESCE(MAX(value), 0) + 1 FROM stats WHERE name = 'presence_version'").fetchone()[0]
+            db.execute("INSERT OR REPLACE INTO stats VALUES ('presence_version', ?)", (version,))
+            if status is None:
+                db.execute('DELETE FROM presence WHERE username = ?', (username,))
+            elif current is None:
+                db.execute('INSERT INTO presence VALUES (?, ?)', (username, status))
+            else:
+                db.execute('UPDATE presence SET status = ? WHERE username = ?', (status, username))
+            return {'version': version, 'op': presence_op(current, status), 'username': username, 'status': status}
+        return self.transaction(work)
+    
+    def get_presence(self):
+        def work(db):
+            row = db.execute("SELECT value FROM stats WHERE name = 'presence_version'").fetchone()
+            users = db.execute('SELECT username, status FROM presence ORDER BY rowid').fetchall()
+            return {'version': row[0] if row else 0,
+                    'users': [{'username': username, 'status': status} for username, status in users]}
+        return self.transaction(work)
+    
+    def get_users(self):
+        users = {}
+        for username, info, status in self.query('SELECT username, info, status FROM sessions ORDER BY rowid'):
+            user = users.setdefault(username, {'joined': json.loads(info)['joined'], 'status': 'idle', 'sessions': 0})
+            user['sessions'] += 1
+            if status == 'active':
+                user['status'] = 'active'
+        return users
+    
+    def count_users(self):
+        return self.query('SELECT COUNT(DISTINCT username) FROM sessions')[0][0]
+    
+    def user_sids(self, username):
+        return [row[0] for row in self.query('SELECT sid FROM sessions WHERE username = ?', (username,))]
+    
+    def is_known_user(self, username):
+        # Connected now, or a member of some room
+        return bool(self.query('SELECT 1 FROM sessions WHERE username = ? UNION ALL '
+                               'SELECT 1 FROM members WHERE username = ? LIMIT 1', (username, username)))
+    
+    def create_room(self, room):
+        def work(db):
+            row = db.execute('SELECT data FROM rooms WHERE id = ?', (room['id'],)).fetchone()
+            if row:
+                return json.loads(row[0]), False
+            db.execute('INSERT INTO rooms (id, data) VALUES (?, ?)', (room['id'], json.dumps(room)))
+            return room, True
+        return self.transaction(work)
+    
+    def get_room(self, room_id):
+        rows = self.query('SELECT data FROM rooms WHERE id = ?', (room_id,))
+        return json.loads(rows[0][0]) if rows else None
+    
+    def list_channels(self):
+        channels = []
+        for data, member_count in self.query('SELECT data, (SELECT COUNT(*) FROM members WHERE room = id) '
+                                             'FROM rooms ORDER BY rowid'):
+            room = json.loads(data)
+            if room['kind'] == 'channel':
+                channels.append(dict(room, member_count=member_count))
+        return channels
+    
+    def add_member(self, room_id, username):
+        return self.update('INSERT OR IGNORE INTO members VALUES (?, ?)', (room_id, username)) > 0
+    
+    def remove_member(self, room_id, username):
+        return self.update('DELETE FROM members WHERE room = ? AND username = ?', (room_id, username)) > 0
+    
+    def is_member(self, room_id, username):
+        return room_id == DEFAULT_ROOM or bool(
+            self.query('SELECT 1 FROM members WHERE room = ? AND username = ?', (room_id, username)))
+    
+    def user_rooms(self, username):
+        return [json.loads(row[0]) for row in self.query(
+            'SELECT data FROM rooms WHERE id = ? OR id IN (SELECT room FROM members WHERE username = ?) ORDER BY rowid',
+            (DEFAULT_ROOM, username))]
+    
+    def append_message(self, room_id, message):
+        # Sequence numbers count up per room and survive clearing the history
+        def work(db):
+            db.execute('UPDATE rooms SET last_seq = last_seq + 1 WHERE id = ?', (room_id,))
+            seq = db.execute('SELECT last_seq FROM rooms WHERE id = ?', (room_id,)).fetchone()[0]
+            db.execute('INSERT INTO chat VALUES (?, ?, ?)', (room_id, seq, json.dumps(message)))
+            db.execute('DELETE FROM chat WHERE room = ? AND seq <= ?', (room_id, seq - self.history_retain))
+            return seq
+        message['seq'] = self.transaction(work)
+        return message['seq']
+    
+    def load_messages(self, rows):
+        messages = []
+        for seq, data in rows:
+            message = json.loads(data)
+            message['seq'] = seq
+            messages.append(message)
+        return messages
+    
+    def get_messages(self, room_id=DEFAULT_ROOM):
+        return self.load_messages(self.query(
+            'SELECT seq, data FROM (SELECT seq, data FROM chat WHERE room = ? ORDER BY seq DESC LIMIT ?) ORDER BY seq',
+            (room_id, self.history_size)))
+    
+    def messages_before(self, room_id, before, limit):
+        rows = self.query('SELECT seq, data FROM chat WHERE room = ? AND seq < ? ORDER BY seq DESC LIMIT ?',
+                          (room_id, before if before is not None else 2 ** 62, limit + 1))
+        return self.load_messages(reversed(rows[:limit])), len(rows) > limit
+    
+    def messages_after(self, room_id, after, limit):
+        # None when the gap can't be filled from here
+        rows = self.query('SELECT seq, data FROM chat WHERE room = ? AND seq > ? ORDER BY seq LIMIT ?',
+                          (room_id, after, limit + 1))
+        if len(rows) > limit or (rows and rows[0][0] > after + 1):
+            return None
+        if not rows and after > self.query('SELECT COALESCE(MAX(last_seq), 0) FROM rooms WHERE id = ?', (room_id,))[0][0]:
+            return None
+        return self.load_messages(rows)
+    
+    def clear_messages(self):
+        self.update('DELETE FROM chat')
+    
+    def incr_stat(self, name, amount=1):
+        self.update('INSERT INTO stats VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+                    (name, amount))
+    
+    def set_stat(self, name, value):
+        self.update('INSERT OR REPLACE INTO stats VALUES (?, ?)', (name, value))
+    
+    def get_stats(self):
+        stats = {'total_messages': 0, 'total_files_shared': 0}
+        stats.update(self.query("SELECT name, value FROM stats WHERE name != 'presence_version'"))
+        stats['active_users'] = self.count_users()
+        return stats
+    
+    def log_file_change(self, db, op, entry):
+        version = db.execute('SELECT COALESCE(MAX(version), 0) + 1 FROM file_log').fetchone()[0]
+        db.execute('INSERT INTO file_log VALUES (?, ?, ?)',
+                   (version, op, json.dumps(entry) if entry is not None else None))
+        db.execute('DELETE FROM file_log WHERE version <= ?', (version - self.FILE_LOG_SIZE,))
+        return version
+    
+    def append_file_change(self, op, entry, since):
+        # Returns every change after `since`, this one included
+        def work(db):
+            if op == 'removed':
+                db.execute('DELETE FROM files WHERE name = ?', (entry['name'],))
+            else:
+                db.execute('INSERT OR REPLACE INTO files VALUES (?, ?)', (entry['name'], json.dumps(entry)))
+            self.log_file_change(db, op, entry)
+            return self.read_file_log(db, since)
+        return self.transaction(work)
+    
+    def read_file_log(self, db, since):
+        return [(version, op, json.loads(entry) if entry is not None else None) for version, op, entry in
+                db.execute('SELECT version, op, entry FROM file_log WHERE version > ? ORDER BY version', (since,))]
+    
+    def file_changes_since(self, since):
+        with self.lock:
+            return self.read_file_log(self.db, since)
+    
+    def reset_files(self, entries):
+        def work(db):
+            db.execute('DELETE FROM files')
+            db.executemany('INSERT INTO files VALUES (?, ?)', [(e['name'], json.dumps(e)) for e in entries])
+            return self.log_file_change(db, 'reset', None)
+        return self.transaction(work)
+    
+    def get_files(self):
+        def work(db):
+            version = db.execute('SELECT COALESCE(MAX(version), 0) FROM file_log').fetchone()[0]
+            return [json.loads(entry) for entry, in db.execute('SELECT entry FROM files')], version
+        return self.transaction(work)
+    
+    def flush(self):
+        pass  # Every write is committed as it happens
+    
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        block = sock.recv(size - len(data))
+        if not block:
+            raise ConnectionError('Connection closed')
+        data += block
+    return data
+
+class MessageBroker:
+    # Relays length-prefixed frames between the worker processes of one host,
+    # so a multi-worker server needs no external message queue. Runs in the
+    # launcher process. A connection's first frame must be the cluster's
+    # token; anything else is dropped before it can publish or listen.
+    HANDSHAKE_TIMEOUT = 5
+    
+    def __init__(self, token, host='127.0.0.1', port=0):
+        self.token = token.encode('utf-8')
+        self.listener = socket.create_server((host, port))
+        self.address = self.listener.getsockname()
+        self.clients = {}
+        self.lock = threading.Lock()
+    
+    def get_url(self):
+        # Carries the token, so it goes to the workers but never to logs
+        return 'local://:%s@%s:%d' % ((self.token.decode('utf-8'),) + self.address)
+    
+    def start(self):
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+    
+    def accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.relay, args=(conn,), daemon=True).start()
+    
+    def authenticate(self, conn):
+        conn.settimeout(self.HANDSHAKE_TIMEOUT)
+        size = struct.unpack('!I', recv_exact(conn, 4))[0]
+        if size > 1024:
+            return False
+        token = recv_exact(conn, size)
+        conn.settimeout(None)
+        return secrets.compare_digest(token, self.token)
+    
+    def relay(self, conn):
+        try:
+            if not self.authenticate(conn):
+                return
+            with self.lock:
+                self.clients[conn] = threading.Lock()
+            while True:
+                header = recv_exact(conn, 4)
+                frame = header + recv_exact(conn, struct.unpack('!I', header)[0])
+                with self.lock:
+                    clients = list(self.clients.items())
+                for client, send_lock in clients:
+                    try:
+                        with send_lock:
+                            client.sendall(frame)
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                self.clients.pop(conn, None)
+            conn.close()
+    
+    def stop(self):
+        self.listener.close()
+
+class LocalBusManager(socketio.PubSubManager):
+    # Socket.IO pub/sub backend on top of MessageBroker (local://host:port).
+    # The broker echoes every frame back, and the base class skips our own.
+    name = 'local'
+    
+    def __init__(self, url, channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        address = urlparse(url)
+        self.address = (address.hostname or '127.0.0.1', address.port)
+        self.token = (address.password or '').encode('utf-8')
+        self.sock = None
+        self.sock_lock = threading.Lock()
+    
+    def broker_socket(self):
+        with self.sock_lock:
+            if self.sock is None:
+                sock = socket.create_connection(self.address)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                try:
+                    sock.sendall(struct.pack('!I', len(self.token)) + self.token)
+                except OSError:
+                    sock.close()
+                    raise
+                self.sock = sock
+            return self.sock
+    
+    def drop_broker_socket(self, sock):
+        with self.sock_lock:
+            if self.sock is sock:
+                self.sock = None
+        sock.close()
+    
+    def _publish(self, data):
+        frame = self.json.dumps(data).encode('utf-8')
+        for retries_left in range(1, -1, -1):
+            sock = None
+            try:
+                sock = self.broker_socket()
+                with self.sock_lock:
+                    sock.sendall(struct.pack('!I', len(frame)) + frame)
+                return
+            except OSError:
+                if sock is not None:
+                    self.drop_broker_socket(sock)
+                if retries_left == 0:
+                    self._get_logger().error('Cannot publish to the message broker, giving up')
+    
+    def _listen(self):
+        while True:
+            sock = None
+            try:
+                sock = self.broker_socket()
+                while True:
+                    header = recv_exact(sock, 4)
+                    yield recv_exact(sock, struct.unpack('!I', header)[0]).decode('utf-8')
+            except OSError:
+                self._get_logger().error('Lost the message broker connection, retrying')
+                if sock is not None:
+                    self.drop_broker_socket(sock)
+                time.sleep(1)
+
+class ClusterBusMixin:
+    # Worker-to-worker notifications over the same channel as the Socket.IO
+    # traffic. They are handed to cluster_handler and never reach clients.
+    cluster_handler = None
+    
+    def publish_cluster(self, payload):
+        self._publish({'method': 'cluster', 'host_id': self.host_id, 'payload': payload})
+    
+    def _listen(self):
+        for message in super()._listen():
+            data = message
+            if not isinstance(data, dict):
+                try:
+                    data = self.json.loads(message)
+                except ValueError:
+                    continue
+            if isinstance(data, dict) and data.get('method') == 'cluster':
+                if data.get('host_id') != self.host_id and self.cluster_handler is not None:
+                    try:
+                        self.cluster_handler(data.get('payload') or {})
+                    except Exception:
+                        self._get_logger().exception('Cluster message handler failed')
+                continue
+            yield data
+
+class LocalClusterBus(ClusterBusMixin, LocalBusManager):
+    pass
+
+class RedisClusterBus(ClusterBusMixin, socketio.RedisManager):
+    pass
+
+def make_message_bus(url):
+    # local://host:port is the launcher's built-in broker; redis:// and
+    # rediss:// go through Redis (needs the redis package)
+    if url.startswith('local://'):
+        return LocalClusterBus(url)
+    if url.startswith(('redis://', 'rediss://')):
+        return RedisClusterBus(url)
+    raise ValueError(f"Unsupported message queue: {url}")
+
+ASYNC_MODES = ('threading', 'eventlet', 'gevent')
+
+def prepare_async_mode(mode=None):
+    # Picks the Socket.IO async mode (argument, then LANSHARE_ASYNC_MODE, then
+    # threading) and patches the standard library for the cooperative modes
+    # so sockets, sleeps and locks yield. Must run before the server is built.
+    mode = mode or os.environ.get('LANSHARE_ASYNC_MODE') or 'threading'
+    if mode not in ASYNC_MODES:
+        raise ValueError(f"Unknown async mode: {mode}")
+    if mode == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+    elif mode == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+    return mode
+
+def set_config_defaults(config):
+    # LANChatServer's app.config settings; load_config checks overrides
+    # against these keys
+    config['UPLOAD_FOLDER'] = 'shared_files'
+    config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB max file size
+    config['UPLOAD_CHUNK_SIZE'] = 8 * 1024 * 1024  # 8MB per chunk request
+    config['UPLOAD_SESSION_TIMEOUT'] = 24 * 60 * 60  # Drop stale uploads after a day
+    config['STREAMING_UPLOADS'] = True  # Parse /upload bodies incrementally instead of spooling
+    config['UPLOAD_BLOCK_SIZE'] = 256 * 1024
+    config['DOWNLOAD_BLOCK_SIZE'] = 256 * 1024
+    config['CONTENT_ADDRESSED_STORAGE'] = True  # Deduplicate uploads by SHA-256
+    config['UPLOAD_CONCURRENCY_PER_USER'] = 8  # Upload requests in flight per user
+    config['UPLOAD_CONCURRENCY_TOTAL'] = 64  # ... and across all users
+    config['BANDWIDTH_LIMIT_TOTAL'] = 0  # Bytes per second, 0 = unlimited
+    config['BANDWIDTH_LIMIT_PER_IP'] = 0
+    config['BANDWIDTH_LIMIT_PER_SESSION'] = 0
+    config['CHAT_HISTORY_LIMIT'] = 100  # Messages kept in memory
+    config['CHAT_HISTORY_PAGE_SIZE'] = 50  # Messages per scrollback page
+    config['CHAT_LOG_RETAIN'] = 100000  # Messages kept on disk
+    config['CHAT_LOG_SEGMENT_SIZE'] = 4 * 1024 * 1024
+    config['CHAT_LOG_FLUSH_INTERVAL'] = 0.2  # Seconds a burst collects before one fsync
+    config['BROADCAST_WINDOW'] = 0.02  # Seconds broadcasts are coalesced for, 0 = no delay
+    config['PRESENCE_HEARTBEAT_INTERVAL'] = 30  # Seconds between client heartbeats
+    config['PRESENCE_IDLE_AFTER'] = 300  # Seconds without input before a client reports idle
+    config['PRESENCE_TIMEOUT'] = 90  # Seconds without a heartbeat before a session counts as idle
+    config['PRESENCE_GRACE'] = 5  # Seconds a user stays online after their last socket closes
+    config['PREVIEW_SIZE'] = 256  # Longest side of thumbnails, in pixels
+    config['PREVIEW_TEXT_BYTES'] = 4096  # Start of a text file shown as its preview
+    config['PREVIEW_MAX_SOURCE_SIZE'] = 100 * 1024 * 1024  # Bigger images and PDFs get no preview
+    config['PREVIEW_CACHE_SIZE'] = 64 * 1024 * 1024  # Bytes of rendered previews kept on disk
+    config['PREVIEW_WORKERS'] = 2  # Processes rendering previews
+    config['PREVIEW_WAIT'] = 10  # Seconds a request waits for a preview being rendered
+    config['COMPRESS_DOWNLOADS'] = True  # Negotiate Content-Encoding for compressible files
+    config['COMPRESS_MIN_SIZE'] = 4096  # Smaller files go out as they are
+    config['COMPRESS_MAX_RATIO'] = 0.9  # Probe result above which a file counts as incompressible
+    config['COMPRESS_CACHE_SIZE'] = 512 * 1024 * 1024  # Bytes of compressed variants kept on disk
+    config['COMPRESS_AT_REST'] = False  # Keep compressible uploads gzipped (content-addressed storage only)
+    config['ARCHIVE_MAX_FILES'] = 10000  # Files per ZIP download
+    config['SEARCH_MAX_TEXT'] = 1024 * 1024  # Characters of a file's text kept in the search index
+    config['SEARCH_MAX_SOURCE_SIZE'] = 200 * 1024 * 1024  # Bigger files are found by name only
+    config['METRICS_ENABLED'] = True  # Serve Prometheus metrics at /metrics
+
+class LANChatServer:
+    def __init__(self, async_mode='threading', message_queue=None, worker_id=0, workers=1, config=None):
         self.app = Flask(__name__)
-        self.app.secret_key = str(uuid.uuid4())
-        self.socketio = SocketIO(self.app, cors_allowed_origins="*")
+        # Workers of one cluster share the key so any of them accepts the session cookie
+        self.app.secret_key = os.environ.get('LANSHARE_SECRET_KEY') or str(uuid.uuid4())
+        self.async_mode = async_mode
+        self.worker_id = worker_id
+        self.bus = make_message_bus(message_queue) if message_queue else None
+        if self.bus is None:
+            self.socketio = SocketIO(self.app, cors_allowed_origins="*", async_mode=async_mode)
+        else:
+            # Long-polling needs sticky sessions, which SO_REUSEPORT can't
+            # give, so cluster workers only speak websocket
+            self.socketio = SocketIO(self.app, cors_allowed_origins="*", async_mode=async_mode,
+                                     client_manager=self.bus, transports=['websocket'])
+            self.bus.cluster_handler = self.handle_cluster_message
         
         # Configuration
-        self.UPLOAD_FOLDER = 'shared_files'
-        self.app.config['UPLOAD_FOLDER'] = self.UPLOAD_FOLDER
-        self.app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB max file size
+        set_config_defaults(self.app.config)
+        if config:
+            # Overrides from the config file and environment (see load_config)
+            unknown = sorted(set(config) - set(self.app.config))
+            if unknown:
+                raise ValueError(f"Unknown config keys: {', '.join(unknown)}")
+            self.app.config.update(config)
+        self.UPLOAD_FOLDER = self.app.config['UPLOAD_FOLDER']
+        if workers > 1:
+            # Limits are enforced per process, so split the server-wide ones
+            for key in ('UPLOAD_CONCURRENCY_TOTAL', 'BANDWIDTH_LIMIT_TOTAL', 'PREVIEW_WORKERS'):
+                if self.app.config[key]:
+                    self.app.config[key] = max(1, self.app.config[key] // workers)
         
         # Data storage
-        self.connected_users = {}
-        self.chat_history = []
-        self.server_stats = {
-            'total_messages': 0,
-            'total_files_shared': 0,
-            'active_users': 0
-        }
+        self.broadcasts = BroadcastQueue(self.socketio, self.app.config['BROADCAST_WINDOW'])
+        self.upload_sessions = {}
+        self.upload_sessions_lock = threading.Lock()
+        self.upload_limiter = TransferLimiter(self.app.config['UPLOAD_CONCURRENCY_PER_USER'],
+                                              self.app.config['UPLOAD_CONCURRENCY_TOTAL'])
+        self.shaper = BandwidthShaper(self.app.config['BANDWIDTH_LIMIT_TOTAL'],
+                                      self.app.config['BANDWIDTH_LIMIT_PER_IP'],
+                                      self.app.config['BANDWIDTH_LIMIT_PER_SESSION'])
         
-        # Create upload folder
-        os.makedirs(self.UPLOAD_FOLDER, exist_ok=True)
+        self.open_storage()
+        
+        # Lifecycle, see serve() and stop()
+        self.listener = None
+        self.http_server = None
+        self.accept_thread = None
+        self.draining = False
+        self.cancel_transfers = False
+        self.closed = False
+        self.stopped = threading.Event()
         
+        self.load_templates()
+        self.setup_metrics()
         self.setup_routes()
         self.setup_socket_events()
         
+    def open_storage(self):
+        # Everything kept under the upload folder; reopened when it changes
+        os.makedirs(self.UPLOAD_FOLDER, exist_ok=True)
+        
+        # Presence, rooms, chat history and stats; shared through SQLite
+        # between the workers of a cluster
+        if self.bus is None:
+            self.state = LocalStateStore(os.path.join(self.UPLOAD_FOLDER, '.chat'),
+                                         self.app.config['CHAT_HISTORY_LIMIT'],
+                                         self.app.config['CHAT_LOG_SEGMENT_SIZE'],
+                                         self.app.config['CHAT_LOG_RETAIN'],
+                                         self.app.config['CHAT_LOG_FLUSH_INTERVAL'])
+        else:
+            self.state = SqliteStateStore(os.path.join(self.UPLOAD_FOLDER, '.state.db'), self.worker_id,
+                                          self.app.config['CHAT_HISTORY_LIMIT'], self.app.config['CHAT_LOG_RETAIN'])
+            self.state.reset_presence()
+        self.presence = PresenceTracker(self.state, self.broadcasts, self.socketio,
+                                        self.app.config['PRESENCE_HEARTBEAT_INTERVAL'],
+                                        self.app.config['PRESENCE_TIMEOUT'],
+                                        self.app.config['PRESENCE_GRACE'])
+        self.presence.start()
+        
+        self.blobs = BlobStore(os.path.join(self.UPLOAD_FOLDER, '.blobs'), shared=self.bus is not None)
+        self.previews = PreviewPool(DiskCache(os.path.join(self.UPLOAD_FOLDER, '.previews'),
+                                              self.app.config['PREVIEW_CACHE_SIZE']),
+                                    self.app.config['PREVIEW_WORKERS'], self.async_mode)
+        self.encoded = DiskCache(os.path.join(self.UPLOAD_FOLDER, '.encoded'), self.app.config['COMPRESS_CACHE_SIZE'],
+                                 set(ENCODING_EXTENSIONS.values()))
+        self.probes = OrderedDict()  # Compressibility probe results by file version
+        self.probes_lock = threading.Lock()
+        if self.bus is None:
+            self.catalog = FileCatalog(self.UPLOAD_FOLDER)
+        else:
+            self.catalog = FileCatalog(self.UPLOAD_FOLDER, journal=self.state, leader=self.worker_id == 0)
+            self.catalog.on_journal_write = lambda: self.bus.publish_cluster({'kind': 'files'})
+        self.catalog.listeners.append(self.broadcast_file_change)
+        self.catalog.start_watcher()
+        
+        try:
+            self.search = SearchIndex(os.path.join(self.UPLOAD_FOLDER, '.search.db'))
+        except sqlite3.OperationalError as e:
+            print(f"Search disabled: {e}")  # SQLite built without FTS5
+            self.search = None
+        self.indexing = set()  # Names whose text is being extracted
+        self.indexing_lock = threading.Lock()
+        if self.search is not None and self.catalog.leader:
+            # One worker keeps the file side of the index in step with the catalog
+            self.catalog.listeners.append(self.index_file_change)
+            self.socketio.start_background_task(self.sync_search_index)
+    
+    def close_storage(self):
+        self.presence.stop()
+        self.previews.shutdown()
+        self.catalog.stop_watcher()
+        self.state.close()
+        if self.search is not None:
+            self.search.close()
+    
+    def set_upload_folder(self, folder):
+        # Only while stopped: requests and sockets hold on to the old stores
+        if self.listener is not None or self.http_server is not None:
+            raise RuntimeError('Stop the server before changing its folder')
+        version = self.catalog.version
+        self.close_storage()
+        with self.upload_sessions_lock:
+            self.upload_sessions.clear()
+        self.UPLOAD_FOLDER = self.app.config['UPLOAD_FOLDER'] = folder
+        self.open_storage()
+        self.catalog.continue_from(version)
+    
     def get_local_ip(self):
         try:
             # Connect to a remote address to determine local IP
@@ -47,35 +2784,923 @@ class LANChatServer:
         except:
             return "127.0.0.1"
     
+    def get_uploads_folder(self):
+        folder = os.path.join(self.UPLOAD_FOLDER, '.uploads')
+        os.makedirs(folder, exist_ok=True)
+        return folder
+    
+    def get_upload_session(self, upload_id):
+        with self.upload_sessions_lock:
+            upload = self.upload_sessions.get(upload_id)
+            if upload is None:
+                # Sessions survive a server restart through their metadata file
+                meta_path = os.path.join(self.get_uploads_folder(), secure_filename(upload_id) + '.json')
+                if not os.path.isfile(meta_path):
+                    return None
+                try:
+                    upload = UploadSession.load(meta_path)
+                except (OSError, ValueError, KeyError):
+                    return None
+                upload.shared = self.bus is not None
+                self.upload_sessions[upload_id] = upload
+            elif upload.shared:
+                with upload.lock:
+                    upload.refresh()
+            return upload
+    
+    def claim_upload_session(self, upload):
+        # Takes the session out of use so only one finalize stores it. The
+        # metadata file is renamed too, which settles races between workers.
+        with self.upload_sessions_lock:
+            if self.upload_sessions.get(upload.upload_id) is not upload:
+                return False
+            del self.upload_sessions[upload.upload_id]
+        claimed_path = upload.meta_path + '.finalizing'
+        try:
+            os.rename(upload.meta_path, claimed_path)
+        except OSError:
+            return False
+        upload.meta_path = claimed_path
+        return True
+    
+    def discard_upload_session(self, upload):
+        with self.upload_sessions_lock:
+            self.upload_sessions.pop(upload.upload_id, None)
+        for path in (upload.part_path, upload.meta_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    
+    def expire_upload_sessions(self):
+        cutoff = time.time() - self.app.config['UPLOAD_SESSION_TIMEOUT']
+        with self.upload_sessions_lock:
+            expired = [u for u in self.upload_sessions.values() if u.last_activity < cutoff]
+        for upload in expired:
+            self.discard_upload_session(upload)
+    
+    def ingest_multipart_upload(self):
+        # Parse the multipart body as it arrives and stream the 'file' part
+        # straight to disk. Memory use is bounded by the block size.
+        boundary = request.mimetype_params.get('boundary')
+        if request.mimetype != 'multipart/form-data' or not boundary:
+            return None
+        
+        decoder = MultipartDecoder(boundary.encode('latin-1'), max_form_memory_size=500 * 1024)
+        block_size = self.app.config['UPLOAD_BLOCK_SIZE']
+        writer = None
+        current = None
+        result = None
+        finished = False
+        shaping_keys = self.get_shaping_keys()
+        try:
+            while not finished:
+                if self.cancel_transfers:
+                    raise TransferCancelled()
+                block = request.stream.read(block_size)
+                self.shaper.throttle(shaping_keys, len(block))
+                decoder.receive_data(block or None)
+                event = decoder.next_event()
+                while not isinstance(event, NeedData):
+                    if isinstance(event, File) and event.name == 'file' and writer is None and event.filename:
+                        original_name = event.filename
+                        filename = secure_filename(original_name)
+                        if not filename:
+                            current = None
+                        else:
+                            filename = datetime.now().strftime('%Y%m%d_%H%M%S_') + filename
+                            part_path = os.path.join(self.get_uploads_folder(), uuid.uuid4().hex + '.part')
+                            writer = StreamingFileWriter(part_path, self.app.config['MAX_CONTENT_LENGTH'])
+                            current = writer
+                    elif isinstance(event, (File, Field)):
+                        current = None
+                    elif isinstance(event, Data):
+                        if current is not None:
+                            current.write(event.data)
+                            if not event.more_data:
+                                result = {
+                                    'filename': filename,
+                                    'original_name': original_name,
+                                    'size': writer.size,
+                                    'sha256': writer.close(),
+                                    'part_path': part_path
+                                }
+                                current = None
+                    elif isinstance(event, Epilogue):
+                        finished = True
+                        break
+                    event = decoder.next_event()
+                if not block:
+                    break
+        finally:
+            if writer is not None and result is None:
+                writer.abort()
+        
+        if result is None and writer is not None:
+            raise ValueError('Truncated upload')
+        return result
+    
+    def iter_file_range(self, path, start, end, shaping_keys=(), encoding=None):
+        with open_stored(path, encoding) as f:
+            yield from self.iter_open_file(f, start, end, shaping_keys)
+    
+    def iter_open_file(self, f, start, end, shaping_keys=()):
+        block_size = self.app.config['DOWNLOAD_BLOCK_SIZE']
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            if self.cancel_transfers:
+                raise TransferCancelled()
+            data = f.read(min(block_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            self.shaper.throttle(shaping_keys, len(data))
+            yield data
+    
+    def send_shared_file(self, path, download_name, as_attachment=True, etag=None, mtime=None,
+                         stored_encoding=None, length=None):
+        # Download engine: conditional GET, single and multi byte ranges,
+        # negotiated Content-Encoding, and zero-copy transmission through
+        # wsgi.file_wrapper where available. A file stored gzipped passes its
+        # encoding and raw length.
+        stat = os.stat(path)
+        if length is None:
+            length = stat.st_size
+        tag = etag or '%x-%x-%x' % (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        last_modified = int(mtime if mtime is not None else stat.st_mtime)
+        mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+        
+        # Each encoding is its own representation with its own ETag
+        encoding = self.choose_download_encoding(path, download_name, tag, length, stored_encoding)
+        etag = quote_etag(tag + '-' + encoding if encoding else tag)
+        headers = {
+            'ETag': etag,
+            'Last-Modified': http_date(last_modified),
+            'Accept-Ranges': 'bytes',
+            'Cache-Control': 'no-cache'
+        }
+        if self.app.config['COMPRESS_DOWNLOADS'] or stored_encoding:
+            headers['Vary'] = 'Accept-Encoding'
+        headers['Content-Disposition'] = content_disposition('attachment' if as_attachment else 'inline', download_name)
+        
+        # Conditional requests
+        if request.if_none_match:
+            if request.if_none_match.contains_weak(etag.strip('"')) or request.if_none_match.star_tag:
+                return Response(status=304, headers=headers)
+        elif request.if_modified_since and last_modified <= request.if_modified_since.timestamp():
+            return Response(status=304, headers=headers)
+        
+        if encoding is not None:
+            return self.send_encoded_file(path, stored_encoding, encoding, tag, length, headers, mimetype)
+        
+        ranges = parse_byte_ranges(request.headers.get('Range'), length)
+        if ranges is not None and 'If-Range' in request.headers:
+            if_range = request.if_range
+            if if_range.etag:
+                if if_range.etag != etag.strip('"'):
+                    ranges = None
+            elif not if_range.date or last_modified > if_range.date.timestamp():
+                ranges = None
+        
+        if ranges == []:
+            headers['Content-Range'] = 'bytes */%d' % length
+            return Response(status=416, headers=headers)
+        
+        if ranges is None or ranges == [[0, length]]:
+            status, start, end = 200, 0, length
+        elif len(ranges) == 1:
+            status, (start, end) = 206, ranges[0]
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, length)
+        else:
+            # Multiple ranges go out as multipart/byteranges
+            boundary = uuid.uuid4().hex
+            parts = []
+            body_length = 0
+            for start, end in ranges:
+                part_header = ('--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n'
+                               % (boundary, mimetype, start, end - 1, length)).encode('latin-1')
+                parts.append((part_header, start, end))
+                body_length += len(part_header) + (end - start) + 2
+            closing = ('--%s--\r\n' % boundary).encode('latin-1')
+            body_length += len(closing)
+            
+            shaping_keys = self.get_shaping_keys()
+            
+            def generate():
+                for part_header, start, end in parts:
+                    yield part_header
+                    for data in self.iter_file_range(path, start, end, shaping_keys, stored_encoding):
+                        yield data
+                    yield b'\r\n'
+                yield closing
+            
+            headers['Content-Length'] = str(body_length)
+            return Response(generate(), status=206, headers=headers,
+                            mimetype='multipart/byteranges; boundary=' + boundary, direct_passthrough=True)
+        
+        return self.send_file_body(path, start, end, status, headers, mimetype, stored_encoding)
+    
+    def send_file_body(self, path, start, end, status, headers, mimetype, stored_encoding=None):
+        headers['Content-Length'] = str(end - start)
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+        source = None
+        if file_wrapper is not None and not self.shaper.is_active() and stored_encoding is None:
+            source = FileRange(path, start, end)
+            body = file_wrapper(source, self.app.config['DOWNLOAD_BLOCK_SIZE'])
+        else:
+            # sendfile can't be paced or decompress, so those go through Python
+            body = self.iter_file_range(path, start, end, self.get_shaping_keys(), stored_encoding)
+        response = Response(body, status=status, headers=headers, mimetype=mimetype, direct_passthrough=True)
+        response.file_range = source  # Lets the metrics hook see when a zero-copy body is done
+        return response
+    
+    def iter_archive(self, files, shaping_keys=()):
+        # Streams a ZIP of (name, path, stored encoding, size, mtime, tag)
+        # files, one block at a time. Compressible files are deflated, the
+        # rest stored. zipfile switches to ZIP64 records by itself for
+        # entries, offsets or entry counts past the classic limits.
+        stream = ZipStream()
+        with zipfile.ZipFile(stream, 'w', allowZip64=True) as archive:
+            for name, path, encoding, size, mtime, tag in files:
+                # Opened before its entry is started, so a file deleted since
+                # the request came in is left out rather than cut short
+                try:
+                    f = open_stored(path, encoding)
+                except OSError:
+                    continue
+                with f:
+                    info = zipfile.ZipInfo(name, zip_date_time(mtime))
+                    info.file_size = size  # Lets zipfile pick ZIP64 for this entry up front
+                    deflate = (size >= self.app.config['COMPRESS_MIN_SIZE'] and
+                               self.is_compressible(path, name, tag, size))
+                    info.compress_type = zipfile.ZIP_DEFLATED if deflate else zipfile.ZIP_STORED
+                    with archive.open(info, 'w') as member:
+                        for data in self.iter_open_file(f, 0, size):
+                            member.write(data)
+                            data = stream.take()
+                            if data:
+                                self.shaper.throttle(shaping_keys, len(data))
+                                yield data
+                data = stream.take()
+                if data:
+                    yield data
+        data = stream.take()  # Central directory
+        self.shaper.throttle(shaping_keys, len(data))
+        yield data
+    
+    def choose_download_encoding(self, path, name, tag, length, stored_encoding):
+        # Content-Encoding for a whole-file download, or None to send it as is.
+        # Range requests always get the raw bytes, since their offsets refer
+        # to them.
+        if 'Range' in request.headers:
+            return None
+        if stored_encoding is not None:
+            return stored_encoding if request.accept_encodings[stored_encoding] else None
+        if not self.app.config['COMPRESS_DOWNLOADS'] or length < self.app.config['COMPRESS_MIN_SIZE']:
+            return None
+        encoding = request.accept_encodings.best_match(DOWNLOAD_ENCODINGS)
+        if encoding is None or not self.is_compressible(path, name, tag, length):
+            return None
+        return encoding
+    
+    def is_compressible(self, path, name, tag, length):
+        # Known formats are decided by name; anything else by compressing a
+        # sample once per file version
+        mimetype = mimetypes.guess_type(name)[0] or ''
+        if os.path.splitext(name)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+            return False
+        if mimetype.split('/')[0] in ('image', 'audio', 'video') and mimetype != 'image/svg+xml':
+            return False
+        with self.probes_lock:
+            result = self.probes.get(tag)
+        if result is None:
+            try:
+                result = compression_ratio(path, length) <= self.app.config['COMPRESS_MAX_RATIO']
+            except OSError:
+                return False
+            with self.probes_lock:
+                self.probes[tag] = result
+                if len(self.probes) > 10000:
+                    self.probes.popitem(last=False)
+        return result
+    
+    def send_encoded_file(self, path, stored_encoding, encoding, tag, length, headers, mimetype):
+        headers['Content-Encoding'] = encoding
+        if encoding == stored_encoding:
+            # Stored gzipped and the client takes gzip: send the file as it is
+            return self.send_file_body(path, 0, os.path.getsize(path), 200, headers, mimetype)
+        
+        key = hashlib.sha1(('%s:%s' % (tag, encoding)).encode('utf-8')).hexdigest()
+        ext = ENCODING_EXTENSIONS[encoding]
+        cached = self.encoded.get(key)
+        if cached is not None:
+            try:
+                return self.send_file_body(cached[0], 0, os.path.getsize(cached[0]), 200, headers, mimetype)
+            except OSError:
+                pass  # Evicted in the meantime
+        
+        # First download of this version: compress on the fly and keep the
+        # result for the next one. The length isn't known up front, so the
+        # response goes out chunked.
+        shaping_keys = self.get_shaping_keys()
+        
+        def generate():
+            compressor = StreamCompressor(encoding)
+            tmp_path = self.encoded.temp_path(key, ext)
+            complete = False
+            try:
+                with open(tmp_path, 'wb') as out:
+                    for data in self.iter_file_range(path, 0, length, (), stored_encoding):
+                        data = compressor.compress(data)
+                        if data:
+                            out.write(data)
+                            self.shaper.throttle(shaping_keys, len(data))
+                            yield data
+                    data = compressor.finish()
+                    out.write(data)
+                    self.shaper.throttle(shaping_keys, len(data))
+                    yield data
+                complete = True
+            finally:
+                try:
+                    if complete:
+                        self.encoded.put_file(key, ext, tmp_path)
+                    else:
+                        os.remove(tmp_path)
+                except OSError:
+                    pass
+        
+        return Response(generate(), status=200, headers=headers, mimetype=mimetype, direct_passthrough=True)
+    
+    def broadcast_file_change(self, change):
+        # Push one delta to the members of the file's room instead of having
+        # each refetch /files. Each cluster worker applies every change itself,
+        # so it only needs to reach its own clients.
+        if change['op'] == 'reset':
+            self.broadcasts.publish('file_list_reset', {'version': change['version']}, local=True)
+        else:
+            self.broadcasts.publish('file_' + change['op'], change, room=self.room_channel(change['file']['room']),
+                                    local=True)
+    
+    def index_file_change(self, change):
+        if change['op'] == 'reset':
+            self.socketio.start_background_task(self.sync_search_index)
+        elif change['op'] == 'removed':
+            self.search.remove_file(change['file']['name'])
+        else:
+            self.index_file_later(change['file']['name'])
+    
+    def sync_search_index(self):
+        # Catches up with files added, changed or removed while the server
+        # was down; files whose version is already indexed are skipped
+        try:
+            names = self.catalog.names()
+            for name in self.search.file_names() - set(names):
+                self.search.remove_file(name)
+            for name in names:
+                self.index_file_later(name)
+        except Exception as e:
+            print(f"Error syncing search index: {e}")
+    
+    def index_file_later(self, name):
+        # The name is indexed right away; text is extracted in the preview
+        # workers and replaces the row when it's ready
+        if self.search is None:
+            return
+        path, encoding, entry = self.resolve_shared_file(name)
+        if path is None or entry is None:
+            return
+        version = entry['sha256'] or '%d:%d' % (entry['size'], entry['mtime_ns'])
+        with self.indexing_lock:
+            if name in self.indexing or self.search.file_version(name) == version:
+                return
+            self.indexing.add(name)
+        kind = text_kind(name) if entry['size'] <= self.app.config['SEARCH_MAX_SOURCE_SIZE'] else None
+        if kind is None:
+            self.finish_indexing(name, version, entry['room'], None)
+            return
+        try:
+            future = self.previews.run(extract_text, os.path.abspath(path), name, kind, encoding,
+                                       self.app.config['SEARCH_MAX_TEXT'])
+        except Exception as e:
+            print(f"Error scheduling text extraction: {e}")
+            self.finish_indexing(name, version, entry['room'], None)
+            return
+        future.add_done_callback(lambda future: self.finish_indexing(name, version, entry['room'], future))
+    
+    def finish_indexing(self, name, version, room, future):
+        moved = False
+        try:
+            text = future.result() if future is not None else None
+        except FileNotFoundError:
+            text, moved = None, True
+        except Exception:
+            text = None  # Unreadable or not what its name says: found by name only
+        try:
+            if self.catalog.get(name) is not None and not moved:
+                self.search.add_file(name, version, room, text or '')
+        except sqlite3.Error as e:
+            print(f"Error indexing {name}: {e}")
+        finally:
+            with self.indexing_lock:
+                self.indexing.discard(name)
+        if moved:
+            # Compressed at rest while queued, say: extract from where it is now
+            path = self.resolve_shared_file(name)[0]
+            if path is not None and os.path.exists(path):
+                self.index_file_later(name)
+    
+    def handle_cluster_message(self, payload):
+        if payload.get('kind') == 'files':
+            self.catalog.follow()
+    
+    def room_channel(self, room_id):
+        # Socket.IO room holding the sockets subscribed to a chat room
+        return 'room:' + room_id
+    
+    def user_channel(self, username):
+        # ... and every socket of one user
+        return 'user:' + username
+    
+    def get_room_arg(self, data):
+        # The 'room' of a socket event payload, None unless it could be a room id
+        room_id = data.get('room') if isinstance(data, dict) else None
+        if isinstance(room_id, str) and 0 < len(room_id) <= MAX_ROOM_ID_LENGTH:
+            return room_id
+        return None
+    
+    def get_request_room(self, room_id):
+        # The room a request names if the session's user may use it, else None
+        room_id = room_id or DEFAULT_ROOM
+        if room_id == DEFAULT_ROOM:
+            return room_id
+        username = session.get('username')
+        if not isinstance(room_id, str) or not username or not self.state.is_member(room_id, username):
+            return None
+        return room_id
+    
+    def enter_room(self, username, room, opener=None):
+        # Subscribes every socket of the user, on whichever worker it is
+        for sid in self.state.user_sids(username):
+            self.socketio.server.enter_room(sid, self.room_channel(room['id']), namespace='/')
+        self.broadcasts.publish('room_joined', dict(room, opener=opener), room=self.user_channel(username))
+    
+    def exit_room(self, username, room_id):
+        for sid in self.state.user_sids(username):
+            self.socketio.server.leave_room(sid, self.room_channel(room_id), namespace='/')
+        self.broadcasts.publish('room_left', {'id': room_id}, room=self.user_channel(username))
+    
+    def resolve_shared_file(self, name):
+        # Returns (path, stored encoding, catalog entry) for a shared name,
+        # following the blob mapping for content-addressed files
+        entry = self.catalog.get(name)
+        if entry is not None and entry['blob']:
+            return self.blobs.stored(entry['blob']) + (entry,)
+        path = safe_join(self.UPLOAD_FOLDER, name)
+        if path is None or name.startswith('.') or not os.path.isfile(path):
+            return None, None, None
+        return path, None, entry
+    
+    def preview_source(self, name):
+        # Returns (path, kind, cache key, stored encoding) for a file that can
+        # have a preview. The key follows the content hash when it is known,
+        # so identical files share one preview.
+        kind = preview_kind(name)
+        path, encoding, entry = self.resolve_shared_file(name) if kind else (None, None, None)
+        if path is None or (encoding is not None and kind != 'text'):
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if kind != 'text' and stat.st_size > self.app.config['PREVIEW_MAX_SOURCE_SIZE']:
+            return None
+        if entry is not None and entry['sha256']:
+            source = entry['sha256']
+        else:
+            source = '%s:%d:%d' % (path, stat.st_size, stat.st_mtime_ns)
+        key = '%s:%s:%d:%d' % (source, kind, self.app.config['PREVIEW_SIZE'], self.app.config['PREVIEW_TEXT_BYTES'])
+        return path, kind, hashlib.sha1(key.encode('utf-8')).hexdigest(), encoding
+    
+    def render_preview_later(self, name):
+        # Rendered ahead of the first request, in the preview processes
+        source = self.preview_source(name)
+        if source is not None and self.previews.cache.get(source[2]) is None:
+            path, kind, key, encoding = source
+            try:
+                self.previews.submit(key, path, kind, self.app.config['PREVIEW_SIZE'],
+                                     self.app.config['PREVIEW_TEXT_BYTES'], encoding)
+            except Exception as e:
+                # A missing preview must not fail the upload
+                print(f"Error scheduling preview: {e}")
+    
+    def store_upload(self, part_path, filename, sha256, size, uploader, room=None):
+        if self.app.config['CONTENT_ADDRESSED_STORAGE']:
+            with self.blobs.locked():
+                self.blobs.put(part_path, sha256)
+                previous = self.catalog.add_blob(filename, sha256, size, uploader, room)
+            self.release_blob(previous)
+            if self.app.config['COMPRESS_AT_REST']:
+                self.socketio.start_background_task(self.compress_blob, sha256, filename, size)
+        else:
+            os.replace(part_path, os.path.join(self.UPLOAD_FOLDER, filename))
+            self.catalog.add(filename, uploader, sha256, room)
+    
+    def compress_blob(self, digest, name, size):
+        # Gzips a compressible blob after the upload has finished; gzip-capable
+        # clients are then sent the stored bytes as they are
+        path, encoding = self.blobs.stored(digest)
+        if encoding is not None or not self.app.config['COMPRESS_MIN_SIZE'] <= size < 1 << 32:
+            return
+        if not self.is_compressible(path, name, digest, size):
+            return
+        try:
+            self.blobs.compress(digest)
+        except OSError as e:
+            print(f"Error compressing {name}: {e}")
+    
+    def can_see_blob(self, digest):
+        # Only content the caller could already download from one of their
+        # rooms is confirmed or linked; the rest stays private to its room
+        return any(self.get_request_room(room) is not None for room in self.catalog.blob_rooms(digest))
+    
+    def release_blob(self, entry):
+        # Blobs are shared between names; drop the data with the last one.
+        # Other workers' links are read from the journal first.
+        if entry is None or not entry['blob']:
+            return
+        with self.blobs.locked():
+            self.catalog.follow()
+            if not self.catalog.blob_in_use(entry['blob']):
+                self.blobs.remove(entry['blob'])
+    
+    def delete_shared_file(self, name):
+        entry = self.catalog.remove(name)
+        if entry is not None and entry['blob']:
+            self.release_blob(entry)
+        else:
+            path = safe_join(self.UPLOAD_FOLDER, name)
+            if path is not None and os.path.isfile(path):
+                os.remove(path)
+    
+    def get_transfer_key(self):
+        return session.get('username') or request.remote_addr
+    
+    def get_shaping_keys(self):
+        return [('ip', request.remote_addr), ('session', session.get('session_id') or request.remote_addr)]
+    
+    def too_busy(self):
+        response = jsonify({'error': 'Server busy, retry shortly'})
+        response.status_code = 429
+        response.headers['Retry-After'] = '1'
+        return response
+    
+    def shutting_down(self, **extra):
+        response = jsonify(dict(extra, error='Server is shutting down'))
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+    
+    def notify_file_uploaded(self, filename, original_name, uploader, room=DEFAULT_ROOM):
+        self.state.incr_stat('total_files_shared')
+        self.render_preview_later(filename)
+        self.index_file_later(filename)
+        
+        # Notify the room the file was shared in
+        self.broadcasts.publish('file_uploaded', {
+            'filename': filename,
+            'original_name': original_name,
+            'uploader': uploader,
+            'room': room,
+            'timestamp': datetime.now().strftime('%H:%M:%S')
+        }, room=self.room_channel(room))
+    
+    def listen(self, host='0.0.0.0', port=5000, reuse_port=False):
+        # With reuse_port every cluster worker binds the port itself and the
+        # kernel spreads new connections between them
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            listener.bind((host, port))
+            listener.listen(128)
+        except OSError:
+            listener.close()
+            raise
+        return listener
+    
+    def serve(self, host='0.0.0.0', port=5000, reuse_port=False, listener=None):
+        # Blocks until stop(). The listening socket is kept so stop() can
+        # close it; pass one from listen() to see bind errors up front.
+        if listener is None:
+            listener = self.listen(host, port, reuse_port)
+        self.listener = listener
+        if self.draining:
+            listener.close()
+        elif self.async_mode == 'eventlet':
+            import eventlet
+            import eventlet.wsgi
+            from greenlet import GreenletExit
+            # Closing the listener doesn't wake eventlet's accept(), so stop()
+            # kills the accept loop instead. Connections run in our own pool
+            # so the ones still open at the deadline can be ended too.
+            self.http_server = eventlet.GreenPool()
+            self.accept_thread = eventlet.spawn(eventlet.wsgi.server, listener, self.app, log_output=False,
+                                                custom_pool=self.http_server)
+            try:
+                self.accept_thread.wait()
+            except GreenletExit:
+                pass
+        elif self.async_mode == 'gevent':
+            from gevent import pywsgi
+            try:
+                from geventwebsocket.handler import WebSocketHandler
+                options = {'handler_class': WebSocketHandler}
+            except ImportError:
+                options = {}  # websockets come from simple-websocket
+            self.http_server = pywsgi.WSGIServer(listener, self.app, log=None, **options)
+            self.http_server.serve_forever()
+        else:
+            from werkzeug.serving import make_server
+            self.http_server = make_server(host, port, self.app, threaded=True, fd=listener.fileno())
+            self.http_server.serve_forever()
+        if self.draining:
+            self.stopped.wait()
+    
+    def reopen(self):
+        # After stop(close=False) has finished, lets serve() run again
+        if self.closed:
+            raise RuntimeError('Server is closed')
+        if self.stopped.is_set():
+            self.stopped.clear()
+            self.draining = False
+            self.cancel_transfers = False
+    
+    def stop(self, timeout=30, close=True):
+        # Graceful shutdown: stop accepting connections, give uploads and
+        # downloads in flight up to timeout seconds to finish (new requests on
+        # open connections get a 503), cancel the rest, then close what is
+        # still connected and write out chat state. serve() returns once this
+        # is done. With close=False the server stays usable for another serve().
+        if self.draining:
+            self.stopped.wait()
+            return
+        self.draining = True
+        server = self.http_server
+        if self.async_mode == 'gevent' and server is not None:
+            server.close()
+        elif self.async_mode == 'threading' and server is not None:
+            server.shutdown()
+            server.server_close()
+        elif self.async_mode == 'eventlet' and server is not None:
+            self.accept_thread.kill()
+        if self.listener is not None:
+            self.listener.close()
+        
+        deadline = time.monotonic() + timeout
+        while self.active_transfers() and time.monotonic() < deadline:
+            self.socketio.sleep(0.1)
+        if self.active_transfers():
+            # Past the deadline: the transfer loops give up at their next
+            # block. Chunks already written stay in their upload session, so
+            # resumable uploads carry on from there, and downloads resume
+            # with a Range request.
+            self.cancel_transfers = True
+            deadline = time.monotonic() + 2
+            while self.active_transfers() and time.monotonic() < deadline:
+                self.socketio.sleep(0.1)
+        
+        # Every Socket.IO client; they reconnect to wherever we come back. Not
+        # waiting for their send queues, whose writers may be gone already.
+        for client in list(self.socketio.server.eio.sockets.values()):
+            client.close(wait=False)
+        if self.async_mode == 'gevent' and server is not None:
+            server.stop(timeout=1)
+        elif self.async_mode == 'eventlet' and server is not None:
+            for thread in list(server.coroutines_running):
+                thread.kill()
+        # Threading mode has no way to end a request thread; one stuck in a
+        # read from a silent client is cut off when the process exits
+        self.listener = None
+        self.http_server = None
+        self.accept_thread = None
+        if close:
+            self.close()
+        else:
+            self.flush()
+        self.stopped.set()
+    
+    def stop_on_signals(self, timeout=30):
+        # SIGTERM (and Ctrl+C) start a graceful stop
+        def handle_signal(signum, frame):
+            print(f"Stopping, waiting up to {timeout:g}s for transfers in flight...")
+            self.socketio.start_background_task(self.stop, timeout)
+        signal.signal(signal.SIGTERM, handle_signal)
+        signal.signal(signal.SIGINT, handle_signal)
+    
+    def active_transfers(self):
+        return sum(child.value for child in self.metric_transfers_active.children.values())
+    
+    def flush(self):
+        # Writes out chat messages and broadcasts still waiting for their
+        # batch, and the catalog metadata
+        try:
+            self.state.flush()
+        except OSError as e:
+            print(f"Error writing chat log: {e}")
+        self.broadcasts.flush()
+        self.catalog.save_metadata()
+    
+    def close(self):
+        # Writes out chat messages still waiting for their batch and stops the
+        # background workers
+        if self.closed:
+            return
+        self.closed = True
+        self.close_storage()
+    
+    UPLOAD_ENDPOINTS = ('upload_file', 'upload_chunk')
+    DOWNLOAD_ENDPOINTS = ('download_file', 'download_archive')
+    
+    def setup_metrics(self):
+        # Per process: in a cluster each worker reports its own series,
+        # labelled with its id
+        metrics = self.metrics = MetricsRegistry(const_labels=(('worker', self.worker_id),) if self.bus else ())
+        self.metric_request_seconds = metrics.histogram(
+            'http_request_duration_seconds', 'Time to handle a request, up to the response headers', ['endpoint'])
+        self.metric_requests = metrics.counter('http_requests_total', 'HTTP requests', ['endpoint', 'code'])
+        self.metric_received = metrics.counter('http_received_bytes_total', 'Request body bytes', ['endpoint'])
+        self.metric_sent = metrics.counter('http_sent_bytes_total', 'Response body bytes', ['endpoint'])
+        self.metric_transfer_seconds = metrics.histogram(
+            'transfer_duration_seconds', 'Whole upload requests and downloads', ['direction'], DURATION_BUCKETS)
+        self.metric_throughput = metrics.histogram(
+            'transfer_throughput_bytes_per_second', 'Upload requests and downloads', ['direction'], THROUGHPUT_BUCKETS)
+        self.metric_transfers_active = metrics.gauge('transfers_active', 'Transfers in progress', ['direction'])
+        self.metric_socket_seconds = metrics.histogram(
+            'socketio_handler_duration_seconds', 'Socket.IO event handler run time', ['event'])
+        self.broadcasts.emit_seconds = metrics.histogram(
+            'broadcast_emit_duration_seconds', 'Time to fan one broadcast frame out to its room')
+        
+        # Read at scrape time
+        for name in ('events', 'frames', 'bytes', 'frames_saved', 'bytes_saved'):
+            metrics.callback('broadcast_%s_total' % name, 'counter', 'Broadcast ' + name.replace('_', ' '),
+                             lambda name=name: self.broadcasts.get_stats()[name])
+        metrics.callback('broadcast_queue_depth', 'gauge', 'Broadcast events waiting for their batch',
+                         lambda: sum(len(events) for events in list(self.broadcasts.pending.values())))
+        metrics.callback('preview_queue_depth', 'gauge', 'Previews being rendered', lambda: len(self.previews.pending))
+        metrics.callback('search_queue_depth', 'gauge', 'Files waiting for text extraction', lambda: len(self.indexing))
+        metrics.callback('upload_sessions', 'gauge', 'Resumable uploads in progress', lambda: len(self.upload_sessions))
+        metrics.callback('upload_slots_in_use', 'gauge', 'Upload requests holding a concurrency slot',
+                         lambda: self.upload_limiter.active_total)
+        metrics.callback('socketio_connections', 'gauge', 'Socket.IO clients connected to this process',
+                         lambda: len(self.socketio.server.eio.sockets))
+        metrics.callback('users_online', 'gauge', 'Users with a connected session', lambda: self.state.count_users())
+        metrics.callback('files', 'gauge', 'Files in the catalog', lambda: len(self.catalog.names()))
+        metrics.callback('cache_bytes', 'gauge', 'Disk used by derived files', lambda: {
+            ('previews',): self.previews.cache.total, ('encoded',): self.encoded.total}, ['cache'])
+        metrics.callback('chat_messages_total', 'counter', 'Chat messages sent',
+                         lambda: self.state.get_stats().get('total_messages', 0))
+        metrics.callback('files_shared_total', 'counter', 'Files uploaded',
+                         lambda: self.state.get_stats().get('total_files_shared', 0))
+        
+        @self.app.before_request
+        def start_request_metrics():
+            g.metrics_started = time.perf_counter()
+            if request.endpoint in self.UPLOAD_ENDPOINTS:
+                self.metric_transfers_active.labels('upload').inc()
+        
+        @self.app.after_request
+        def record_request_metrics(response):
+            endpoint = request.endpoint or 'unmatched'
+            started = g.get('metrics_started')
+            if started is None:
+                return response
+            elapsed = time.perf_counter() - started
+            self.metric_request_seconds.labels(endpoint).observe(elapsed)
+            self.metric_requests.labels(endpoint, response.status_code).inc()
+            if request.content_length:
+                self.metric_received.labels(endpoint).inc(request.content_length)
+                if endpoint in self.UPLOAD_ENDPOINTS and response.status_code < 400:
+                    self.metric_transfer_seconds.labels('upload').observe(elapsed)
+                    self.metric_throughput.labels('upload').observe(request.content_length / max(elapsed, 1e-6))
+            if endpoint in self.DOWNLOAD_ENDPOINTS and response.status_code in (200, 206) and request.method != 'HEAD':
+                self.track_download(response, endpoint, started)
+            elif response.content_length:
+                self.metric_sent.labels(endpoint).inc(response.content_length)
+            return response
+        
+        @self.app.teardown_request
+        def finish_request_metrics(error=None):
+            if request.endpoint in self.UPLOAD_ENDPOINTS and 'metrics_started' in g:
+                self.metric_transfers_active.labels('upload').dec()
+    
+    def track_download(self, response, endpoint, started):
+        # Downloads are timed until the server closes the body. Werkzeug
+        # skips call_on_close for direct passthrough responses, so the hook
+        # goes on the body itself: sendfile bodies keep their file wrapper
+        # and are counted by Content-Length, everything else is counted as
+        # it streams.
+        active = self.metric_transfers_active.labels('download')
+        active.inc()
+        
+        def finish(sent):
+            active.dec()
+            elapsed = time.perf_counter() - started
+            self.metric_sent.labels(endpoint).inc(sent)
+            self.metric_transfer_seconds.labels('download').observe(elapsed)
+            if sent:
+                self.metric_throughput.labels('download').observe(sent / max(elapsed, 1e-6))
+        
+        source = getattr(response, 'file_range', None)
+        if source is not None:
+            length = response.content_length or 0
+            source.on_close = lambda: finish(length)
+        else:
+            response.response = CountingBody(response.response, finish)
+    
+    def on_socket_event(self, event):
+        # socketio.on() that also times the handler
+        timer = self.metric_socket_seconds.labels(event)
+        
+        def decorator(handler):
+            @wraps(handler)
+            def timed(*args):
+                started = time.perf_counter()
+                try:
+                    return handler(*args)
+                finally:
+                    timer.observe(time.perf_counter() - started)
+            return self.socketio.on(event)(timed)
+        return decorator
+    
     def setup_routes(self):
+        @self.app.before_request
+        def refuse_while_stopping():
+            # Keep-alive connections outlive the listener; nothing new starts on them
+            if self.draining:
+                return self.shutting_down()
+        
         @self.app.route('/')
         def index():
             if 'username' not in session:
                 return redirect(url_for('login'))
-            return render_template('index.html', username=session['username'])
+            socket_options = {'transports': ['websocket']} if self.bus is not None else {}
+            presence_options = {'heartbeat': self.app.config['PRESENCE_HEARTBEAT_INTERVAL'],
+                                'idle_after': self.app.config['PRESENCE_IDLE_AFTER']}
+            return render_template('index.html', username=session['username'], socket_options=socket_options,
+                                   presence_options=presence_options, default_room=DEFAULT_ROOM)
         
         @self.app.route('/login', methods=['GET', 'POST'])
         def login():
             if request.method == 'POST':
                 username = request.form.get('username', '').strip()
-                if username and len(username) <= 20:
+                if username and len(username) <= MAX_USERNAME_LENGTH:
                     session['username'] = username
+                    session['session_id'] = uuid.uuid4().hex
                     return redirect(url_for('index'))
                 else:
-                    return render_template('login.html', error='Please enter a valid username (1-20 characters)')
+                    return render_template('login.html', error=f'Please enter a valid username (1-{MAX_USERNAME_LENGTH} characters)')
             return render_template('login.html')
         
         @self.app.route('/logout')
         def logout():
-            username = session.get('username')
-            if username and username in self.connected_users:
-                del self.connected_users[username]
-                self.server_stats['active_users'] = len(self.connected_users)
+            # Presence follows the page's socket, which closes on the way out
             session.clear()
             return redirect(url_for('login'))
         
         @self.app.route('/upload', methods=['POST'])
         def upload_file():
+            room = self.get_request_room(request.args.get('room'))
+            if room is None:
+                return jsonify({'error': 'Unknown room'}), 403
+            
+            if self.app.config['STREAMING_UPLOADS']:
+                transfer_key = self.get_transfer_key()
+                if not self.upload_limiter.acquire(transfer_key):
+                    return self.too_busy()
+                try:
+                    upload = self.ingest_multipart_upload()
+                except RequestEntityTooLarge:
+                    return jsonify({'error': 'File too large'}), 413
+                except ValueError:
+                    return jsonify({'error': 'Malformed upload'}), 400
+                except TransferCancelled:
+                    return self.shutting_down()
+                finally:
+                    self.upload_limiter.release(transfer_key)
+                
+                if upload is None:
+                    return jsonify({'error': 'No file selected'})
+                
+                uploader = session.get('username', 'Anonymous')
+                self.store_upload(upload['part_path'], upload['filename'], upload['sha256'], upload['size'], uploader,
+                                  room)
+                self.notify_file_uploaded(upload['filename'], upload['original_name'], uploader, room)
+                
+                return jsonify({'success': True, 'filename': upload['filename'], 'sha256': upload['sha256']})
+            
             if 'file' not in request.files:
                 return jsonify({'error': 'No file selected'})
             
@@ -90,108 +3715,534 @@ class LANChatServer:
                 file_path = os.path.join(self.app.config['UPLOAD_FOLDER'], filename)
                 file.save(file_path)
                 
-                self.server_stats['total_files_shared'] += 1
-                
-                # Notify all users about new file
-                self.socketio.emit('file_uploaded', {
-                    'filename': filename,
-                    'original_name': file.filename,
-                    'uploader': session.get('username', 'Anonymous'),
-                    'timestamp': datetime.now().strftime('%H:%M:%S')
-                })
+                self.catalog.add(filename, session.get('username', 'Anonymous'), room=room)
+                self.notify_file_uploaded(filename, file.filename, session.get('username', 'Anonymous'), room)
                 
                 return jsonify({'success': True, 'filename': filename})
         
+        @self.app.route('/upload/init', methods=['POST'])
+        def upload_init():
+            data = request.get_json(silent=True) or {}
+            original_name = str(data.get('filename', ''))
+            filename = secure_filename(original_name)
+            try:
+                size = int(data.get('size', -1))
+            except (TypeError, ValueError):
+                size = -1
+            
+            if not filename:
+                return jsonify({'error': 'No file selected'}), 400
+            if size < 0:
+                return jsonify({'error': 'Invalid file size'}), 400
+            if size > self.app.config['MAX_CONTENT_LENGTH']:
+                return jsonify({'error': 'File too large'}), 413
+            room = self.get_request_room(data.get('room'))
+            if room is None:
+                return jsonify({'error': 'Unknown room'}), 403
+            
+            self.expire_upload_sessions()
+            
+            upload_id = uuid.uuid4().hex
+            filename = datetime.now().strftime('%Y%m%d_%H%M%S_') + filename
+            uploads_folder = self.get_uploads_folder()
+            part_path = os.path.join(uploads_folder, upload_id + '.part')
+            meta_path = os.path.join(uploads_folder, upload_id + '.json')
+            
+            # Preallocate so parallel chunks can be written in place at their offsets
+            with open(part_path, 'wb') as f:
+                if size:
+                    try:
+                        os.posix_fallocate(f.fileno(), 0, size)
+                    except (AttributeError, OSError):
+                        f.truncate(size)
+            
+            upload = UploadSession(upload_id, filename, original_name, size,
+                                   session.get('username', 'Anonymous'), part_path, meta_path)
+            upload.shared = self.bus is not None
+            upload.room = room
+            upload.save()
+            with self.upload_sessions_lock:
+                self.upload_sessions[upload_id] = upload
+            
+            response = upload.to_dict()
+            response['chunk_size'] = self.app.config['UPLOAD_CHUNK_SIZE']
+            return jsonify(response)
+        
+        @self.app.route('/upload/<upload_id>', methods=['GET'])
+        def upload_status(upload_id):
+            upload = self.get_upload_session(upload_id)
+            if upload is None:
+                return jsonify({'error': 'Unknown upload'}), 404
+            response = upload.to_dict()
+            response['chunk_size'] = self.app.config['UPLOAD_CHUNK_SIZE']
+            return jsonify(response)
+        
+        @self.app.route('/upload/<upload_id>', methods=['PUT'])
+        def upload_chunk(upload_id):
+            upload = self.get_upload_session(upload_id)
+            if upload is None:
+                return jsonify({'error': 'Unknown upload'}), 404
+            
+            offset = request.args.get('offset', type=int)
+            length = request.content_length
+            if offset is None or length is None or offset < 0 or offset + length > upload.size:
+                return jsonify({'error': 'Invalid chunk range'}), 416
+            
+            transfer_key = self.get_transfer_key()
+            if not self.upload_limiter.acquire(transfer_key):
+                return self.too_busy()
+            
+            # Stream the body straight into the part file at its offset
+            shaping_keys = self.get_shaping_keys()
+            written = 0
+            block_size = self.app.config['UPLOAD_BLOCK_SIZE']
+            fd = os.open(upload.part_path, os.O_WRONLY)
+            try:
+                while written < length and not self.cancel_transfers:
+                    block = request.stream.read(min(block_size, length - written))
+                    if not block:
+                        break
+                    os.pwrite(fd, block, offset + written)
+                    written += len(block)
+                    self.shaper.throttle(shaping_keys, len(block))
+            finally:
+                os.close(fd)
+                self.upload_limiter.release(transfer_key)
+            
+            if written:
+                upload.add_range(offset, offset + written)
+                upload.advance_hash()
+            if written < length and self.cancel_transfers:
+                # What arrived is kept; the client resumes from 'received'
+                return self.shutting_down(received=upload.received)
+            if written < length:
+                return jsonify({'error': 'Incomplete chunk', 'received': upload.received}), 400
+            return jsonify({'success': True, 'received': upload.received})
+        
+        @self.app.route('/upload/<upload_id>/finalize', methods=['POST'])
+        def upload_finalize(upload_id):
+            upload = self.get_upload_session(upload_id)
+            if upload is None:
+                return jsonify({'error': 'Unknown upload'}), 404
+            if not upload.is_complete():
+                return jsonify({'error': 'Upload incomplete', 'received': upload.received}), 409
+            if not self.claim_upload_session(upload):
+                return jsonify({'error': 'Upload already finalized'}), 409
+            
+            self.store_upload(upload.part_path, upload.filename, upload.hexdigest(), upload.size, upload.uploader,
+                              upload.room)
+            self.discard_upload_session(upload)
+            
+            self.notify_file_uploaded(upload.filename, upload.original_name, upload.uploader, upload.room)
+            
+            return jsonify({'success': True, 'filename': upload.filename})
+        
+        @self.app.route('/upload/<upload_id>', methods=['DELETE'])
+        def upload_abort(upload_id):
+            upload = self.get_upload_session(upload_id)
+            if upload is None:
+                return jsonify({'error': 'Unknown upload'}), 404
+            self.discard_upload_session(upload)
+            return jsonify({'success': True})
+        
+        @self.app.route('/blobs/<digest>')
+        def blob_exists(digest):
+            # Lets a client ask "do you already have this content?" before uploading
+            digest = digest.lower()
+            if not re.fullmatch('[0-9a-f]{64}', digest):
+                return jsonify({'error': 'Invalid hash'}), 400
+            return jsonify({'exists': self.blobs.has(digest) and self.can_see_blob(digest)})
+        
+        @self.app.route('/upload/precheck', methods=['POST'])
+        def upload_precheck():
+            # Cheap first pass: size plus sampled-block hash. A match only means
+            # the client should send the full hash to /upload/link.
+            data = request.get_json(silent=True) or {}
+            sample = str(data.get('sample', '')).lower()
+            try:
+                size = int(data.get('size', -1))
+            except (TypeError, ValueError):
+                size = -1
+            if size < 0 or not re.fullmatch('[0-9a-f]{64}', sample):
+                return jsonify({'error': 'Invalid fingerprint'}), 400
+            
+            candidate = False
+            for digest in self.catalog.blobs_with_size(size):
+                if not self.can_see_blob(digest):
+                    continue
+                try:
+                    if self.blobs.sample(digest, size) == sample:
+                        candidate = True
+                        break
+                except OSError:
+                    continue
+            return jsonify({'candidate': candidate})
+        
+        @self.app.route('/upload/link', methods=['POST'])
+        def upload_link():
+            # Share already-stored content under a new name without any transfer
+            data = request.get_json(silent=True) or {}
+            original_name = str(data.get('filename', ''))
+            filename = secure_filename(original_name)
+            digest = str(data.get('sha256', '')).lower()
+            if not filename:
+                return jsonify({'error': 'No file selected'}), 400
+            if not re.fullmatch('[0-9a-f]{64}', digest):
+                return jsonify({'error': 'Unknown content'}), 404
+            room = self.get_request_room(data.get('room'))
+            if room is None:
+                return jsonify({'error': 'Unknown room'}), 403
+            
+            filename = datetime.now().strftime('%Y%m%d_%H%M%S_') + filename
+            uploader = session.get('username', 'Anonymous')
+            with self.blobs.locked():
+                # Checked under the lock so the content can't go between the
+                # check and the link
+                self.catalog.follow()
+                if not self.blobs.has(digest) or not self.can_see_blob(digest):
+                    return jsonify({'error': 'Unknown content'}), 404
+                previous = self.catalog.add_blob(filename, digest, self.blobs.size(digest), uploader, room)
+            self.release_blob(previous)
+            self.notify_file_uploaded(filename, original_name, uploader, room)
+            
+            return jsonify({'success': True, 'filename': filename, 'linked': True})
+        
         @self.app.route('/download/<filename>')
         def download_file(filename):
-            try:
-                return send_file(os.path.join(self.UPLOAD_FOLDER, filename), as_attachment=True)
-            except:
+            file_path, encoding, entry = self.resolve_shared_file(filename)
+            if file_path is None:
+                return "File not found", 404
+            if entry is not None and self.get_request_room(entry['room']) is None:
+                # Files in a room's area are only there for its members
+                return "File not found", 404
+            etag = mtime = None
+            if entry is not None and entry['blob']:
+                etag, mtime = entry['blob'], entry['mtime']
+            # ?inline=1 lets the browser play or seek media in place
+            return self.send_shared_file(file_path, filename, as_attachment=not request.args.get('inline'),
+                                         etag=etag, mtime=mtime, stored_encoding=encoding,
+                                         length=entry['size'] if encoding else None)
+        
+        @self.app.route('/download', methods=['GET', 'POST'])
+        def download_archive():
+            # Several files as one ZIP, built while it streams: the names
+            # given in `files`, or every file of the room matching q/prefix
+            room = self.get_request_room(request.values.get('room'))
+            if room is None:
+                return jsonify({'error': 'Unknown room'}), 403
+            limit = self.app.config['ARCHIVE_MAX_FILES']
+            names = request.values.getlist('files')
+            if not names:
+                entries, next_key, total, version = self.catalog.page('name', False, None, limit,
+                                                                      request.values.get('q'),
+                                                                      request.values.get('prefix'), room)
+                if next_key is not None:
+                    return jsonify({'error': f'At most {limit} files per archive'}), 400
+                names = [e['name'] for e in entries]
+            elif len(names) > limit:
+                return jsonify({'error': f'At most {limit} files per archive'}), 400
+            
+            files = []
+            for name in dict.fromkeys(names):
+                file_path, encoding, entry = self.resolve_shared_file(name)
+                if file_path is None or (entry['room'] if entry is not None else DEFAULT_ROOM) != room:
+                    continue  # Gone since the list was loaded, or not this room's
+                if entry is not None and entry['blob']:
+                    files.append((name, file_path, encoding, entry['size'], entry['mtime'], entry['blob']))
+                else:
+                    try:
+                        stat = os.stat(file_path)
+                    except OSError:
+                        continue  # Deleted after it was resolved
+                    files.append((name, file_path, None, stat.st_size, stat.st_mtime,
+                                  '%x-%x-%x' % (stat.st_ino, stat.st_size, stat.st_mtime_ns)))
+            if not files:
+                return "File not found", 404
+            
+            archive_name = '%s_%s.zip' % (room, datetime.now().strftime('%Y%m%d_%H%M%S'))
+            headers = {'Content-Disposition': content_disposition('attachment', archive_name), 'Cache-Control': 'no-cache'}
+            return Response(self.iter_archive(files, self.get_shaping_keys()), headers=headers,
+                            mimetype='application/zip', direct_passthrough=True)
+        
+        @self.app.route('/preview/<filename>')
+        def preview_file(filename):
+            # Thumbnail, first PDF page or start of a text file; previews are
+            # keyed by content, so the ETag holds until the file changes
+            file_path, encoding, entry = self.resolve_shared_file(filename)
+            if file_path is None or (entry is not None and self.get_request_room(entry['room']) is None):
                 return "File not found", 404
+            source = self.preview_source(filename)
+            if source is None:
+                return "No preview available", 404
+            path, kind, key, encoding = source
+            headers = {'ETag': quote_etag(key), 'Cache-Control': 'private, max-age=3600'}
+            if request.if_none_match.contains(key):
+                return Response(status=304, headers=headers)
+            
+            cached = self.previews.cache.get(key)
+            data = None
+            if cached is not None:
+                try:
+                    with open(cached[0], 'rb') as f:
+                        ext, data = cached[1], f.read()
+                except OSError:
+                    pass  # Evicted in the meantime, render it again
+            if data is None:
+                future = self.previews.submit(key, path, kind, self.app.config['PREVIEW_SIZE'],
+                                              self.app.config['PREVIEW_TEXT_BYTES'], encoding)
+                if future is None:
+                    return "No preview available", 404
+                deadline = time.time() + self.app.config['PREVIEW_WAIT']
+                while not future.done() and time.time() < deadline:
+                    self.socketio.sleep(0.05)
+                if not future.done():
+                    return Response('Preview not ready', status=503, headers={'Retry-After': '1'})
+                try:
+                    result = future.result()
+                except Exception:
+                    result = None
+                if result is None:
+                    return "No preview available", 404
+                ext, data = result
+            return Response(data, content_type=PREVIEW_TYPES[ext], headers=headers)
         
         @self.app.route('/files')
         def list_files():
-            try:
-                files = []
-                for filename in os.listdir(self.UPLOAD_FOLDER):
-                    file_path = os.path.join(self.UPLOAD_FOLDER, filename)
-                    if os.path.isfile(file_path):
-                        file_stat = os.stat(file_path)
-                        files.append({
-                            'name': filename,
-                            'size': file_stat.st_size,
-                            'modified': datetime.fromtimestamp(file_stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S')
-                        })
-                return jsonify(files)
-            except:
-                return jsonify([])
+            if not request.args:
+                return Response(self.catalog.json_payload(), mimetype='application/json')
+            
+            sort = request.args.get('sort', 'name')
+            order = request.args.get('order', 'asc')
+            if sort not in FileCatalog.SORT_KEYS or order not in ('asc', 'desc'):
+                return jsonify({'error': 'Invalid sort order'}), 400
+            limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+            room = self.get_request_room(request.args.get('room'))
+            if room is None:
+                return jsonify({'error': 'Unknown room'}), 403
+            
+            after = None
+            if request.args.get('cursor'):
+                try:
+                    after = decode_cursor(request.args['cursor'], sort, order)
+                except ValueError as e:
+                    return jsonify({'error': str(e)}), 400
+            
+            entries, next_key, total, version = self.catalog.page(sort, order == 'desc', after, limit,
+                                                         request.args.get('q'), request.args.get('prefix'), room)
+            response = jsonify({
+                'files': [self.catalog.public_entry(e) for e in entries],
+                'next_cursor': encode_cursor(sort, order, next_key) if next_key is not None else None,
+                'total': total,
+                'version': version
+            })
+            response.headers['X-Total-Count'] = str(total)
+            return response
+    
+        @self.app.route('/metrics')
+        def metrics():
+            if not self.app.config['METRICS_ENABLED']:
+                return "Not found", 404
+            return Response(self.metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+        
+        @self.app.route('/search')
+        def search():
+            # Ranked chat and file hits with snippets, across the rooms the
+            # user is in (or just ?room=)
+            if self.search is None:
+                return jsonify({'error': 'Search is not available'}), 503
+            query = fts_query(request.args.get('q', ''))
+            if query is None:
+                return jsonify({'error': 'Nothing to search for'}), 400
+            limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+            if request.args.get('room'):
+                room = self.get_request_room(request.args['room'])
+                if room is None:
+                    return jsonify({'error': 'Unknown room'}), 403
+                rooms = [room]
+            elif session.get('username'):
+                rooms = [room['id'] for room in self.state.user_rooms(session['username'])]
+            else:
+                rooms = [DEFAULT_ROOM]
+            
+            started = time.perf_counter()
+            messages = self.search.search_messages(query, rooms, limit)
+            for hit in messages:
+                hit['date'] = datetime.fromtimestamp(hit['posted']).strftime('%Y-%m-%d %H:%M')
+            files = []
+            for hit in self.search.search_files(query, rooms, limit):
+                entry = self.catalog.get(hit['name'])
+                if entry is not None:
+                    files.append(dict(self.catalog.public_entry(entry), snippet=hit['snippet'],
+                                      name_snippet=hit['name_snippet']))
+            return jsonify({
+                'messages': messages,
+                'files': files,
+                'took_ms': round((time.perf_counter() - started) * 1000, 2)
+            })
     
     def setup_socket_events(self):
-        @self.socketio.on('connect')
-        def handle_connect():
+        @self.on_socket_event('connect')
+        def handle_connect(auth=None):
             username = session.get('username')
             if username:
-                self.connected_users[username] = {
-                    'sid': request.sid,
-                    'joined': datetime.now().strftime('%H:%M:%S')
-                }
-                self.server_stats['active_users'] = len(self.connected_users)
-                
+                # main_room reaches everyone (presence); a socket also joins its
+                # user's own room and the rooms the user is subscribed to
                 join_room('main_room')
+                join_room(self.user_channel(username))
+                rooms = self.state.user_rooms(username)
+                for room in rooms:
+                    join_room(self.room_channel(room['id']))
+                self.presence.connect(request.sid, username, {
+                    'joined': datetime.now().strftime('%H:%M:%S')
+                })
                 
-                # Send chat history to new user
-                emit('chat_history', self.chat_history)
-                
-                # Notify others
-                emit('user_joined', {
-                    'username': username,
-                    'timestamp': datetime.now().strftime('%H:%M:%S'),
-                    'total_users': len(self.connected_users)
-                }, room='main_room')
+                # Chat history is fetched by the client through load_history;
+                # who is online comes as a snapshot, then as diffs
+                emit('rooms', {'rooms': rooms})
+                emit('presence_snapshot', self.presence.snapshot())
+        
+        @self.on_socket_event('disconnect')
+        def handle_disconnect(reason=None):
+            self.presence.disconnect(request.sid)
         
-        @self.socketio.on('disconnect')
-        def handle_disconnect():
+        @self.on_socket_event('presence_heartbeat')
+        def handle_presence_heartbeat(data):
+            active = data.get('active', True) if isinstance(data, dict) else True
+            self.presence.heartbeat(request.sid, bool(active))
+        
+        @self.on_socket_event('presence_sync')
+        def handle_presence_sync():
+            # A client that missed a diff starts over from a snapshot
+            if session.get('username'):
+                emit('presence_snapshot', self.presence.snapshot())
+        
+        @self.on_socket_event('room_create')
+        def handle_room_create(data):
             username = session.get('username')
-            if username and username in self.connected_users:
-                del self.connected_users[username]
-                self.server_stats['active_users'] = len(self.connected_users)
-                
-                emit('user_left', {
-                    'username': username,
-                    'timestamp': datetime.now().strftime('%H:%M:%S'),
-                    'total_users': len(self.connected_users)
-                }, room='main_room')
+            if not username:
+                return
+            room_id = channel_id(data.get('name', '')) if isinstance(data, dict) else None
+            if room_id is None:
+                emit('room_error', {'error': 'Channel names are 1-32 letters, digits, - or _'})
+                return
+            room, created = self.state.create_room({'id': room_id, 'kind': 'channel', 'name': room_id,
+                                                    'created_by': username})
+            if room['kind'] != 'channel':
+                emit('room_error', {'error': 'Unknown channel'})
+                return
+            self.state.add_member(room_id, username)
+            self.enter_room(username, room, request.sid)
+        
+        @self.on_socket_event('room_join')
+        def handle_room_join(data):
+            username = session.get('username')
+            room_id = self.get_room_arg(data)
+            room = self.state.get_room(room_id) if username and room_id else None
+            if room is None or room['kind'] != 'channel':
+                emit('room_error', {'error': 'Unknown channel'})
+                return
+            self.state.add_member(room['id'], username)
+            self.enter_room(username, room, request.sid)
+        
+        @self.on_socket_event('room_leave')
+        def handle_room_leave(data):
+            username = session.get('username')
+            room_id = self.get_room_arg(data)
+            if username and room_id and room_id != DEFAULT_ROOM and self.state.remove_member(room_id, username):
+                self.exit_room(username, room_id)
+        
+        @self.on_socket_event('room_list')
+        def handle_room_list():
+            if session.get('username'):
+                emit('room_list', {'rooms': self.state.list_channels()})
+        
+        @self.on_socket_event('dm_open')
+        def handle_dm_open(data):
+            username = session.get('username')
+            other = data.get('username') if isinstance(data, dict) else None
+            if not username or not isinstance(other, str) or not other or other == username:
+                return
+            if len(other) > MAX_USERNAME_LENGTH or not self.state.is_known_user(other):
+                emit('room_error', {'error': 'Unknown user'})
+                return
+            members = sorted([username, other])
+            room, created = self.state.create_room({'id': dm_room_id(username, other), 'kind': 'dm', 'name': None,
+                                                    'created_by': username, 'members': members})
+            for member in members:
+                if self.state.add_member(room['id'], member) or member == username:
+                    self.enter_room(member, room, request.sid if member == username else None)
         
-        @self.socketio.on('send_message')
+        @self.on_socket_event('send_message')
         def handle_message(data):
             username = session.get('username')
-            if username:
+            if not isinstance(data, dict) or not isinstance(data.get('message'), str):
+                return
+            room_id = self.get_room_arg(data) if data.get('room') else DEFAULT_ROOM
+            if username and room_id and self.get_request_room(room_id):
                 message_data = {
                     'username': username,
                     'message': data['message'][:500],  # Limit message length
                     'timestamp': datetime.now().strftime('%H:%M:%S'),
-                    'id': str(uuid.uuid4())
+                    'id': str(uuid.uuid4()),
+                    'room': room_id
                 }
                 
-                self.chat_history.append(message_data)
-                if len(self.chat_history) > 100:  # Keep only last 100 messages
-                    self.chat_history.pop(0)
+                if room_id != DEFAULT_ROOM:
+                    room = self.state.get_room(room_id)
+                    # A direct message brings the conversation back for a
+                    # participant who closed it
+                    for member in room.get('members', ()):
+                        if self.state.add_member(room_id, member):
+                            self.enter_room(member, room)
                 
-                self.server_stats['total_messages'] += 1
+                self.state.append_message(room_id, message_data)
+                self.state.incr_stat('total_messages')
+                if self.search is not None:
+                    self.search.add_message(message_data)
                 
-                emit('new_message', message_data, room='main_room')
+                self.broadcasts.publish('new_message', message_data, room=self.room_channel(room_id))
         
-        @self.socketio.on('request_user_list')
-        def handle_user_list():
-            emit('user_list', {
-                'users': list(self.connected_users.keys()),
-                'total': len(self.connected_users)
-            })
-    
-    def create_templates(self):
-        # Create templates directory
-        os.makedirs('templates', exist_ok=True)
+        @self.on_socket_event('load_history')
+        def handle_load_history(data):
+            # Scrollback: {} for the newest page, {'before': seq} for older
+            # ones, {'after': seq} for what a reconnecting client missed
+            data = data if isinstance(data, dict) else {}
+            room_id = self.get_request_room(data.get('room'))
+            if not session.get('username') or room_id is None:
+                return
+            limit = data.get('limit')
+            if not isinstance(limit, int):
+                limit = self.app.config['CHAT_HISTORY_PAGE_SIZE']
+            limit = max(1, min(limit, 200))
+            
+            after = data.get('after')
+            if is_chat_seq(after):
+                messages = self.state.messages_after(room_id, after, limit)
+                if messages is not None:
+                    emit('chat_history', {'room': room_id, 'messages': messages, 'after': after})
+                    return
+                # Missed more than a page: start over from the newest one
+            
+            before = data.get('before')
+            if not is_chat_seq(before) or is_chat_seq(after):
+                before = None
+            messages, has_more = self.state.messages_before(room_id, before, limit)
+            emit('chat_history', {'room': room_id, 'messages': messages, 'before': before, 'has_more': has_more})
         
+        @self.on_socket_event('file_sync')
+        def handle_file_sync(data):
+            data = data if isinstance(data, dict) else {}
+            room_id = self.get_request_room(data.get('room'))
+            if room_id is None:
+                return
+            changes, version = self.catalog.changes_since(data.get('since'), room_id)
+            if changes is None:
+                emit('file_changes', {'room': room_id, 'version': version, 'reset': True})
+            else:
+                emit('file_changes', {'room': room_id, 'version': version, 'changes': changes})
+    
+    def load_templates(self):
+        # The pages are served from memory; nothing is written to disk
         # Login page template
         login_html = '''<!DOCTYPE html>
 <html lang="en">
@@ -527,6 +4578,23 @@ class LANChatServer:
             margin: 5px;
         }
         
+        .file-controls {
+            display: flex;
+            gap: 5px;
+            padding: 0 10px;
+        }
+        
+        .file-controls input, .file-controls select {
+            padding: 4px;
+            border: 2px inset #cccccc;
+            border-radius: 3px;
+            font-size: 12px;
+        }
+        
+        .file-controls input {
+            flex: 1;
+        }
+        
         .file-item {
             background: #f8f8f8;
             border: 1px solid #ddd;
@@ -540,6 +4608,65 @@ class LANChatServer:
             background: #e8e8e8;
         }
         
+        .file-thumb {
+            display: block;
+            max-width: 100%;
+            max-height: 128px;
+            margin-bottom: 5px;
+            border: 1px solid #ccc;
+        }
+        
+        .search-bar {
+            display: flex;
+            padding: 5px 5px 0 5px;
+        }
+        
+        .search-bar input {
+            flex: 1;
+            padding: 4px;
+            border: 2px inset #cccccc;
+            border-radius: 3px;
+            font-size: 12px;
+        }
+        
+        .search-results {
+            display: none;
+            max-height: 40%;
+            overflow-y: auto;
+            margin: 5px;
+            padding: 5px;
+            background: #ffffee;
+            border: 1px solid #cccc99;
+            font-size: 12px;
+        }
+        
+        .search-hit {
+            padding: 3px;
+            border-bottom: 1px solid #eeeecc;
+            cursor: pointer;
+        }
+        
+        .search-hit:hover {
+            background: #ffffcc;
+        }
+        
+        .search-hit .meta {
+            color: #666;
+            font-size: 11px;
+        }
+        
+        .file-snippet {
+            max-height: 150px;
+            overflow: auto;
+            background: #fff;
+            border: 1px inset #cccccc;
+            padding: 5px;
+            margin: 5px 0 0 0;
+            font-size: 11px;
+            white-space: pre-wrap;
+            word-break: break-word;
+        }
+        
         .file-name {
             font-weight: bold;
             color: #333;
@@ -571,6 +4698,50 @@ class LANChatServer:
             color: #555;
         }
         
+        .user-link {
+            color: #1976d2;
+            cursor: pointer;
+        }
+        
+        .rooms {
+            background: #f3f8ee;
+            border: 1px solid #a5d6a7;
+            border-radius: 5px;
+            padding: 10px;
+            margin: 10px;
+            font-size: 12px;
+        }
+        
+        .rooms h4 {
+            margin: 0 0 8px 0;
+            color: #388e3c;
+            font-size: 13px;
+        }
+        
+        .room-item {
+            padding: 3px 5px;
+            cursor: pointer;
+            border-radius: 3px;
+        }
+        
+        .room-item.active {
+            background: #c8e6c9;
+            font-weight: bold;
+        }
+        
+        .room-unread {
+            color: #fff;
+            background: #e53935;
+            border-radius: 8px;
+            padding: 0 5px;
+            margin-left: 4px;
+            font-size: 10px;
+        }
+        
+        .room-actions {
+            margin-top: 5px;
+        }
+        
         .status-bar {
             background: #f0f0f0;
             border-top: 1px solid #ccc;
@@ -591,6 +4762,24 @@ class LANChatServer:
             color: #856404;
         }
         
+        .upload-row {
+            margin-bottom: 5px;
+            word-break: break-word;
+        }
+        
+        .upload-bar {
+            height: 6px;
+            background: #fff;
+            border: 1px inset #cccccc;
+            margin-top: 2px;
+        }
+        
+        .upload-bar div {
+            height: 100%;
+            width: 0;
+            background: #4CAF50;
+        }
+        
         @media (max-width: 768px) {
             .main-container {
                 flex-direction: column;
@@ -616,7 +4805,11 @@ class LANChatServer:
     
     <div class="main-container">
         <div class="chat-panel">
-            <div class="panel-header">Chat Room</div>
+            <div class="panel-header" id="roomTitle">Chat Room</div>
+            <div class="search-bar">
+                <input type="text" id="searchInput" placeholder="Search messages and files...">
+            </div>
+            <div class="search-results" id="searchResults"></div>
             <div class="chat-messages" id="chatMessages"></div>
             <div class="chat-input">
                 <input type="text" id="messageInput" placeholder="Type your message..." maxlength="500">
@@ -625,7 +4818,7 @@ class LANChatServer:
         </div>
         
         <div class="file-panel">
-            <div class="panel-header">File Sharing</div>
+            <div class="panel-header">File Sharing (<span id="fileCount">0</span> files)</div>
             
             <div class="file-upload">
                 <div class="file-input">
@@ -635,9 +4828,31 @@ class LANChatServer:
                 <div class="upload-progress" id="uploadProgress">Uploading...</div>
             </div>
             
+            <div class="rooms">
+                <h4>Rooms</h4>
+                <div id="roomList"></div>
+                <div class="room-actions">
+                    <button class="btn btn-secondary" style="font-size: 11px;" onclick="createChannel()">New Channel</button>
+                    <button class="btn btn-secondary" style="font-size: 11px;" onclick="browseChannels()">Browse</button>
+                </div>
+            </div>
+            
             <div class="online-users">
                 <h4>Online Users (<span id="userCount">0</span>)</h4>
-                <div class="user-list" id="userList">Loading...</div>
+                <div class="user-list" id="userList" title="Click a name to send a direct message">Loading...</div>
+            </div>
+            
+            <div class="file-controls">
+                <input type="text" id="fileFilter" placeholder="Filter files...">
+                <select id="fileSort">
+                    <option value="mtime:desc">Newest first</option>
+                    <option value="mtime:asc">Oldest first</option>
+                    <option value="name:asc">Name</option>
+                    <option value="size:desc">Largest first</option>
+                    <option value="uploader:asc">Uploader</option>
+                </select>
+                <button class="btn btn-secondary" id="archiveButton" style="font-size: 11px;" onclick="downloadArchive()"
+                        title="Download the checked files, or every file shown, as one ZIP">Download all</button>
             </div>
             
             <div class="file-list" id="fileList">Loading files...</div>
@@ -649,65 +4864,325 @@ class LANChatServer:
     </div>
     
     <script>
-        const socket = io();
+        const socket = io({{ socket_options|tojson }});
         let username = "{{ username }}";
         
         // Socket event handlers
         socket.on('connect', function() {
             document.getElementById('connectionStatus').textContent = 'Connected to server';
-            socket.emit('request_user_list');
-            loadFiles();
+            sendHeartbeat();
+            // After a reconnect only the messages and changes we missed are fetched
+            loadHistory();
+            requestFileSync();
         });
         
         socket.on('disconnect', function() {
             document.getElementById('connectionStatus').textContent = 'Disconnected from server';
+            fileSyncPending = false;
         });
         
-        socket.on('chat_history', function(history) {
+        socket.on('chat_history', function(page) {
+            if (page.room !== currentRoom) return;  // Answer for a room we already left
             const messagesDiv = document.getElementById('chatMessages');
-            messagesDiv.innerHTML = '';
-            history.forEach(msg => addMessage(msg));
+            if (page.after !== undefined) {
+                page.messages.forEach(msg => addMessage(msg));
+            } else if (page.before === null) {
+                // Newest page: start over
+                messagesDiv.innerHTML = '';
+                chatState = { oldest: null, newest: null, hasMore: page.has_more, loading: false, seen: new Set() };
+                page.messages.forEach(msg => addMessage(msg));
+            } else {
+                // An older page goes on top without moving what the user is reading
+                chatState.loading = false;
+                chatState.hasMore = page.has_more;
+                const previousHeight = messagesDiv.scrollHeight;
+                page.messages.slice().reverse().forEach(msg => {
+                    if (trackMessage(msg)) {
+                        messagesDiv.insertBefore(renderMessage(msg), messagesDiv.firstChild);
+                    }
+                });
+                messagesDiv.scrollTop += messagesDiv.scrollHeight - previousHeight;
+            }
+        });
+        
+        // Broadcasts that arrive together are coalesced into one frame
+        socket.on('batch', function(runs) {
+            runs.forEach(([event, items]) => {
+                const listeners = socket.listeners(event);
+                items.forEach(data => listeners.forEach(listener => listener(data)));
+            });
         });
         
         socket.on('new_message', function(data) {
+            if (data.room !== currentRoom) {
+                unread.set(data.room, (unread.get(data.room) || 0) + 1);
+                renderRooms();
+                return;
+            }
             addMessage(data);
         });
         
-        socket.on('user_joined', function(data) {
-            addSystemMessage(data.username + " joined the chat", data.timestamp);
-            updateUserCount(data.total_users);
-            socket.emit('request_user_list');
+        socket.on('rooms', function(data) {
+            rooms = new Map(data.rooms.map(room => [room.id, room]));
+            if (!rooms.has(currentRoom)) {
+                switchRoom(DEFAULT_ROOM);
+            }
+            renderRooms();
+        });
+        
+        socket.on('room_joined', function(room) {
+            rooms.set(room.id, room);
+            if (room.opener === socket.id) {
+                switchRoom(room.id);
+            } else {
+                renderRooms();
+            }
+        });
+        
+        socket.on('room_left', function(data) {
+            rooms.delete(data.id);
+            unread.delete(data.id);
+            if (data.id === currentRoom) {
+                switchRoom(DEFAULT_ROOM);
+            } else {
+                renderRooms();
+            }
+        });
+        
+        socket.on('room_list', function(data) {
+            const names = data.rooms.filter(room => !rooms.has(room.id))
+                .map(room => room.name + ' (' + room.member_count + ')');
+            if (names.length === 0) {
+                alert('No other channels yet');
+                return;
+            }
+            const name = prompt('Join a channel:\\n' + names.join('\\n'));
+            if (name) {
+                socket.emit('room_join', { room: name.trim().replace(/^#/, '').toLowerCase() });
+            }
+        });
+        
+        socket.on('room_error', function(data) {
+            alert(data.error);
+        });
+        
+        socket.on('presence_snapshot', function(data) {
+            presence.version = data.version;
+            presence.users = new Map(data.users.map(user => [user.username, user.status]));
+            renderPresence();
+        });
+        
+        socket.on('presence', function(diff) {
+            if (presence.version === null || diff.version <= presence.version) return;
+            if (diff.version !== presence.version + 1) {
+                // Missed a diff: start over from a snapshot
+                presence.version = null;
+                socket.emit('presence_sync');
+                return;
+            }
+            presence.version = diff.version;
+            if (diff.op === 'remove') {
+                presence.users.delete(diff.username);
+                addSystemMessage(diff.username + " left the chat", diff.timestamp);
+            } else {
+                if (diff.op === 'add') {
+                    addSystemMessage(diff.username + " joined the chat", diff.timestamp);
+                }
+                presence.users.set(diff.username, diff.status);
+            }
+            renderPresence();
+        });
+        
+        socket.on('file_uploaded', function(data) {
+            if (data.room !== currentRoom) return;
+            addSystemMessage(data.uploader + " shared a file: " + data.original_name, data.timestamp);
+        });
+        
+        socket.on('file_added', onFileChange);
+        socket.on('file_removed', onFileChange);
+        socket.on('file_changed', onFileChange);
+        socket.on('file_list_reset', function() {
+            loadFiles();
+        });
+        
+        socket.on('file_changes', function(data) {
+            if (data.room !== currentRoom) return;
+            fileSyncPending = false;
+            if (fileVersion === null) return;
+            if (data.reset) {
+                loadFiles();
+                return;
+            }
+            data.changes.forEach(change => {
+                if (change.version > fileVersion) {
+                    applyFileChange(change);
+                }
+            });
+            fileVersion = Math.max(fileVersion, data.version);
         });
         
-        socket.on('user_left', function(data) {
-            addSystemMessage(data.username + " left the chat", data.timestamp);
-            updateUserCount(data.total_users);
-            socket.emit('request_user_list');
+        // Presence: a snapshot on connect, then versioned diffs. Heartbeats
+        // tell the server whether this user is active or idle.
+        const PRESENCE = {{ presence_options|tojson }};
+        let presence = { version: null, users: new Map() };
+        let lastInput = Date.now();
+        let reportedActive = true;
+        
+        function isActive() {
+            return !document.hidden && Date.now() - lastInput < PRESENCE.idle_after * 1000;
+        }
+        
+        function sendHeartbeat() {
+            reportedActive = isActive();
+            if (socket.connected) {
+                socket.emit('presence_heartbeat', { active: reportedActive });
+            }
+        }
+        
+        ['mousemove', 'mousedown', 'keydown', 'touchstart', 'wheel'].forEach(type => {
+            document.addEventListener(type, function() {
+                lastInput = Date.now();
+                if (!reportedActive) sendHeartbeat();
+            }, { passive: true });
         });
+        document.addEventListener('visibilitychange', sendHeartbeat);
+        setInterval(sendHeartbeat, PRESENCE.heartbeat * 1000);
+        
+        function renderPresence() {
+            updateUserList(Array.from(presence.users, ([name, status]) => [name, status === 'idle' ? name + ' (idle)' : name]));
+            updateUserCount(presence.users.size);
+        }
+        
+        // Rooms: the chat and the file list show one room at a time; the
+        // others only count unread messages
+        const DEFAULT_ROOM = "{{ default_room }}";
+        let rooms = new Map();
+        let currentRoom = DEFAULT_ROOM;
+        let unread = new Map();
+        
+        function roomLabel(room) {
+            if (room.kind === 'dm') {
+                return '@' + (room.members.find(member => member !== username) || username);
+            }
+            return '#' + room.name;
+        }
+        
+        function renderRooms() {
+            const roomList = document.getElementById('roomList');
+            roomList.innerHTML = '';
+            rooms.forEach(room => {
+                const item = document.createElement('div');
+                item.className = 'room-item' + (room.id === currentRoom ? ' active' : '');
+                item.textContent = roomLabel(room);
+                const count = unread.get(room.id);
+                if (count) {
+                    const badge = document.createElement('span');
+                    badge.className = 'room-unread';
+                    badge.textContent = count;
+                    item.appendChild(badge);
+                }
+                if (room.id !== DEFAULT_ROOM) {
+                    item.title = 'Double-click to leave';
+                    item.ondblclick = () => {
+                        if (confirm('Leave ' + roomLabel(room) + '?')) {
+                            socket.emit('room_leave', { room: room.id });
+                        }
+                    };
+                }
+                item.onclick = () => switchRoom(room.id);
+                roomList.appendChild(item);
+            });
+            const current = rooms.get(currentRoom);
+            document.getElementById('roomTitle').textContent = current ? 'Chat Room - ' + roomLabel(current) : 'Chat Room';
+        }
+        
+        function switchRoom(roomId) {
+            unread.delete(roomId);
+            if (roomId !== currentRoom) {
+                currentRoom = roomId;
+                document.getElementById('chatMessages').innerHTML = '';
+                chatState = { oldest: null, newest: null, hasMore: false, loading: false, seen: new Set() };
+                loadHistory();
+                loadFiles();
+            }
+            renderRooms();
+        }
+        
+        function createChannel() {
+            const name = prompt('Channel name (letters, digits, - or _):');
+            if (name) {
+                socket.emit('room_create', { name: name });
+            }
+        }
+        
+        function browseChannels() {
+            socket.emit('room_list');
+        }
+        
+        function openDirectMessage(other) {
+            if (other !== username) {
+                socket.emit('dm_open', { username: other });
+            }
+        }
+        
+        // Chat functions
+        // History comes a page at a time: the newest page on connect, older
+        // pages as the user scrolls up, and only what was missed on reconnect
+        const CHAT_PAGE_SIZE = 50;
+        let chatState = { oldest: null, newest: null, hasMore: false, loading: false, seen: new Set() };
+        
+        function loadHistory() {
+            if (chatState.newest !== null) {
+                socket.emit('load_history', { room: currentRoom, after: chatState.newest, limit: CHAT_PAGE_SIZE });
+            } else {
+                socket.emit('load_history', { room: currentRoom, limit: CHAT_PAGE_SIZE });
+            }
+        }
         
-        socket.on('user_list', function(data) {
-            updateUserList(data.users);
-            updateUserCount(data.total);
-        });
+        function loadOlderMessages() {
+            if (chatState.loading || !chatState.hasMore || chatState.oldest === null) return;
+            chatState.loading = true;
+            socket.emit('load_history', { room: currentRoom, before: chatState.oldest, limit: CHAT_PAGE_SIZE });
+        }
         
-        socket.on('file_uploaded', function(data) {
-            addSystemMessage(data.uploader + " shared a file: " + data.original_name, data.timestamp);
-            loadFiles();
-        });
+        function trackMessage(data) {
+            // Returns false for a message that is already shown
+            if (data.seq === undefined) return true;
+            if (chatState.seen.has(data.seq)) return false;
+            chatState.seen.add(data.seq);
+            chatState.oldest = chatState.oldest === null ? data.seq : Math.min(chatState.oldest, data.seq);
+            chatState.newest = chatState.newest === null ? data.seq : Math.max(chatState.newest, data.seq);
+            return true;
+        }
         
-        // Chat functions
-        function addMessage(data) {
-            const messagesDiv = document.getElementById('chatMessages');
+        function renderMessage(data) {
             const messageDiv = document.createElement('div');
             messageDiv.className = 'message';
+            if (data.seq !== undefined) {
+                messageDiv.dataset.seq = data.seq;
+            }
             
             messageDiv.innerHTML = `
                 <div class="message-header">${data.username} - ${data.timestamp}</div>
                 <div class="message-content">${escapeHtml(data.message)}</div>
             `;
+            return messageDiv;
+        }
+        
+        function addMessage(data) {
+            if (!trackMessage(data)) return;
+            const messagesDiv = document.getElementById('chatMessages');
             
-            messagesDiv.appendChild(messageDiv);
-            messagesDiv.scrollTop = messagesDiv.scrollHeight;
+            // Messages fetched after a reconnect can arrive after newer live ones
+            let next = null;
+            for (let node = messagesDiv.lastChild; node && node.dataset && node.dataset.seq && Number(node.dataset.seq) > data.seq; node = node.previousSibling) {
+                next = node;
+            }
+            
+            messagesDiv.insertBefore(renderMessage(data), next);
+            if (next === null) {
+                messagesDiv.scrollTop = messagesDiv.scrollHeight;
+            }
         }
         
         function addSystemMessage(message, timestamp) {
@@ -729,15 +5204,38 @@ class LANChatServer:
             const message = input.value.trim();
             
             if (message) {
-                socket.emit('send_message', { message: message });
+                socket.emit('send_message', { message: message, room: currentRoom });
                 input.value = '';
             }
         }
         
         // File functions
+        // Upload scheduler: several files at once, sharing a small pool of
+        // request slots, each with its own progress row
+        const FILE_CONCURRENCY = 3;
+        const MAX_PARALLEL_REQUESTS = 6;
+        const uploadSlots = { free: MAX_PARALLEL_REQUESTS, waiting: [] };
+        
+        function acquireUploadSlot() {
+            if (uploadSlots.free > 0) {
+                uploadSlots.free--;
+                return Promise.resolve();
+            }
+            return new Promise(resolve => uploadSlots.waiting.push(resolve));
+        }
+        
+        function releaseUploadSlot() {
+            const next = uploadSlots.waiting.shift();
+            if (next) {
+                next();
+            } else {
+                uploadSlots.free++;
+            }
+        }
+        
         function uploadFile() {
             const fileInput = document.getElementById('fileInput');
-            const files = fileInput.files;
+            const files = Array.from(fileInput.files);
             
             if (files.length === 0) {
                 alert('Please select files to upload');
@@ -745,83 +5243,647 @@ class LANChatServer:
             }
             
             const progress = document.getElementById('uploadProgress');
+            progress.innerHTML = '';
             progress.style.display = 'block';
+            fileInput.value = '';
+            
+            const room = currentRoom;  // Files go to the room they were picked in
+            const queue = files.slice();
+            const failures = [];
+            let active = 0;
+            let finished = 0;
+            
+            function next() {
+                while (active < FILE_CONCURRENCY && queue.length > 0) {
+                    const file = queue.shift();
+                    const row = addUploadRow(progress, file);
+                    active++;
+                    uploadOneFile(file, row, room)
+                    .catch(error => {
+                        failures.push(file.name + ': ' + (error.message || error));
+                        row.setStatus('failed', 0);
+                    })
+                    .then(() => {
+                        active--;
+                        finished++;
+                        if (finished === files.length) {
+                            setTimeout(() => { progress.style.display = 'none'; }, 1500);
+                            if (failures.length > 0) {
+                                alert('Upload failed:\\n' + failures.join('\\n'));
+                            }
+                        } else {
+                            next();
+                        }
+                    });
+                }
+            }
             
-            // Upload files one by one
-            uploadNextFile(files, 0, progress);
+            next();
         }
         
-        function uploadNextFile(files, index, progressDiv) {
-            if (index >= files.length) {
-                progressDiv.style.display = 'none';
-                document.getElementById('fileInput').value = '';
-                return;
+        function addUploadRow(container, file) {
+            const row = document.createElement('div');
+            row.className = 'upload-row';
+            row.innerHTML = `
+                <div><span class="upload-name">${escapeHtml(file.name)}</span> - <span class="upload-status">queued</span></div>
+                <div class="upload-bar"><div></div></div>
+            `;
+            container.appendChild(row);
+            return {
+                setStatus: function(status, percent) {
+                    row.querySelector('.upload-status').textContent = status;
+                    if (percent !== undefined) {
+                        row.querySelector('.upload-bar div').style.width = percent + '%';
+                    }
+                }
+            };
+        }
+        
+        function uploadOneFile(file, row, room) {
+            return linkExistingContent(file, room, status => row.setStatus(status))
+            .then(linked => linked || chunkedUpload(file, room, function(sent) {
+                const percent = file.size ? Math.floor(sent * 100 / file.size) : 100;
+                row.setStatus(percent + '%', percent);
+            }))
+            .then(data => {
+                if (data.error) {
+                    throw new Error(data.error);
+                }
+                row.setStatus(data.linked ? 'done (already on server)' : 'done', 100);
+                return data;
+            });
+        }
+        
+        // Incremental SHA-256 (crypto.subtle is unavailable on plain-http LAN pages)
+        const SHA256_K = new Int32Array([
+            0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+            0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+            0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+            0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+            0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+            0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+            0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+            0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+        ]);
+        
+        function Sha256() {
+            this.h = new Int32Array([0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a,
+                                     0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19]);
+            this.w = new Int32Array(64);
+            this.buffer = new Uint8Array(64);
+            this.bufferLength = 0;
+            this.length = 0;
+        }
+        
+        Sha256.prototype.update = function(data) {
+            let i = 0;
+            this.length += data.length;
+            if (this.bufferLength > 0) {
+                i = Math.min(64 - this.bufferLength, data.length);
+                this.buffer.set(data.subarray(0, i), this.bufferLength);
+                this.bufferLength += i;
+                if (this.bufferLength < 64) return this;
+                this.block(this.buffer, 0);
+                this.bufferLength = 0;
             }
-            
-            const file = files[index];
-            const formData = new FormData();
-            formData.append('file', file);
-            
-            progressDiv.textContent = `Uploading ${file.name} (${index + 1}/${files.length})...`;
-            
-            fetch('/upload', {
+            for (; i + 64 <= data.length; i += 64) {
+                this.block(data, i);
+            }
+            if (i < data.length) {
+                this.buffer.set(data.subarray(i), 0);
+                this.bufferLength = data.length - i;
+            }
+            return this;
+        };
+        
+        Sha256.prototype.block = function(p, offset) {
+            const w = this.w;
+            const h = this.h;
+            for (let t = 0; t < 16; t++) {
+                const j = offset + t * 4;
+                w[t] = (p[j] << 24) | (p[j + 1] << 16) | (p[j + 2] << 8) | p[j + 3];
+            }
+            for (let t = 16; t < 64; t++) {
+                const x = w[t - 15];
+                const y = w[t - 2];
+                const s0 = ((x >>> 7) | (x << 25)) ^ ((x >>> 18) | (x << 14)) ^ (x >>> 3);
+                const s1 = ((y >>> 17) | (y << 15)) ^ ((y >>> 19) | (y << 13)) ^ (y >>> 10);
+                w[t] = (w[t - 16] + s0 + w[t - 7] + s1) | 0;
+            }
+            let a = h[0], b = h[1], c = h[2], d = h[3], e = h[4], f = h[5], g = h[6], k = h[7];
+            for (let t = 0; t < 64; t++) {
+                const S1 = ((e >>> 6) | (e << 26)) ^ ((e >>> 11) | (e << 21)) ^ ((e >>> 25) | (e << 7));
+                const t1 = (k + S1 + ((e & f) ^ (~e & g)) + SHA256_K[t] + w[t]) | 0;
+                const S0 = ((a >>> 2) | (a << 30)) ^ ((a >>> 13) | (a << 19)) ^ ((a >>> 22) | (a << 10));
+                const t2 = (S0 + ((a & b) ^ (a & c) ^ (b & c))) | 0;
+                k = g; g = f; f = e; e = (d + t1) | 0;
+                d = c; c = b; b = a; a = (t1 + t2) | 0;
+            }
+            h[0] = (h[0] + a) | 0; h[1] = (h[1] + b) | 0; h[2] = (h[2] + c) | 0; h[3] = (h[3] + d) | 0;
+            h[4] = (h[4] + e) | 0; h[5] = (h[5] + f) | 0; h[6] = (h[6] + g) | 0; h[7] = (h[7] + k) | 0;
+        };
+        
+        Sha256.prototype.hex = function() {
+            const bits = this.length * 8;
+            const pad = new Uint8Array((this.bufferLength < 56 ? 64 : 128) - this.bufferLength);
+            const n = pad.length;
+            pad[0] = 0x80;
+            const high = Math.floor(bits / 0x100000000);
+            const low = bits >>> 0;
+            pad[n - 8] = high >>> 24; pad[n - 7] = (high >>> 16) & 0xff; pad[n - 6] = (high >>> 8) & 0xff; pad[n - 5] = high & 0xff;
+            pad[n - 4] = low >>> 24; pad[n - 3] = (low >>> 16) & 0xff; pad[n - 2] = (low >>> 8) & 0xff; pad[n - 1] = low & 0xff;
+            this.update(pad);
+            return Array.from(this.h, v => (v >>> 0).toString(16).padStart(8, '0')).join('');
+        };
+        
+        function hashFileRanges(file, ranges, onProgress) {
+            const hasher = new Sha256();
+            const total = ranges.reduce((sum, r) => sum + r[1] - r[0], 0);
+            let done = 0;
+            let chain = Promise.resolve();
+            ranges.forEach(range => {
+                for (let start = range[0]; start < range[1]; start += HASH_READ_SIZE) {
+                    const end = Math.min(start + HASH_READ_SIZE, range[1]);
+                    chain = chain
+                    .then(() => file.slice(start, end).arrayBuffer())
+                    .then(buffer => {
+                        hasher.update(new Uint8Array(buffer));
+                        done += end - start;
+                        if (onProgress) onProgress(done, total);
+                    });
+                }
+            });
+            return chain.then(() => hasher.hex());
+        }
+        
+        // Instant re-uploads: if the server already holds this content, link
+        // the new name to it instead of transferring the bytes again
+        const HASH_READ_SIZE = 4 * 1024 * 1024;
+        const SAMPLE_BLOCK_SIZE = 64 * 1024;
+        const PRECHECK_MIN_SIZE = 256 * 1024;
+        
+        function sampleRanges(size) {
+            if (size <= 3 * SAMPLE_BLOCK_SIZE) {
+                return [[0, size]];
+            }
+            const middle = Math.floor((size - SAMPLE_BLOCK_SIZE) / 2);
+            return [[0, SAMPLE_BLOCK_SIZE], [middle, middle + SAMPLE_BLOCK_SIZE], [size - SAMPLE_BLOCK_SIZE, size]];
+        }
+        
+        function linkExistingContent(file, room, onStatus) {
+            if (file.size < PRECHECK_MIN_SIZE) {
+                return Promise.resolve(null);
+            }
+            onStatus('checking');
+            return hashFileRanges(file, sampleRanges(file.size))
+            .then(sample => fetch('/upload/precheck', {
                 method: 'POST',
-                body: formData
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ size: file.size, sample: sample })
+            }))
+            .then(jsonOrError)
+            .then(data => {
+                if (!data.candidate) {
+                    return null;
+                }
+                return hashFileRanges(file, [[0, file.size]], function(done, total) {
+                    onStatus('verifying ' + Math.floor(done * 100 / total) + '%');
+                })
+                .then(sha256 => fetch('/upload/link', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ filename: file.name, sha256: sha256, room: room })
+                }))
+                .then(jsonOrError)
+                .then(linked => linked.error ? null : linked);
             })
-            .then(response => response.json())
+            .catch(() => null);  // Any hiccup just falls back to a normal upload
+        }
+        
+        // Resumable chunked uploads: several chunks in flight, resume after reconnects
+        const CHUNK_CONCURRENCY = 4;
+        const CHUNK_RETRIES = 8;
+        
+        function jsonOrError(response) {
+            return response.json().then(data => {
+                if (!response.ok && !data.error) {
+                    data.error = 'HTTP ' + response.status;
+                }
+                data.status = response.status;
+                return data;
+            });
+        }
+        
+        function startUploadSession(file, room, resumeKey) {
+            const savedId = localStorage.getItem(resumeKey);
+            const init = () => fetch('/upload/init', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ filename: file.name, size: file.size, room: room })
+            })
+            .then(jsonOrError)
             .then(data => {
-                if (data.error) {
-                    alert('Upload failed: ' + data.error);
+                if (!data.error) {
+                    localStorage.setItem(resumeKey, data.upload_id);
                 }
-                uploadNextFile(files, index + 1, progressDiv);
+                return data;
+            });
+            
+            if (!savedId) {
+                return init();
+            }
+            return fetch('/upload/' + savedId)
+            .then(jsonOrError)
+            .then(data => data.error ? init() : data);
+        }
+        
+        function rangeCovered(ranges, start, end) {
+            return ranges.some(r => r[0] <= start && r[1] >= end);
+        }
+        
+        function sleep(ms) {
+            return new Promise(resolve => setTimeout(resolve, ms));
+        }
+        
+        function putChunk(uploadId, file, start, end, attempt, onChunkProgress) {
+            // XHR rather than fetch so upload progress events are available
+            return new Promise((resolve, reject) => {
+                const xhr = new XMLHttpRequest();
+                xhr.open('PUT', `/upload/${uploadId}?offset=${start}`);
+                xhr.upload.onprogress = event => onChunkProgress(event.loaded);
+                xhr.onload = function() {
+                    let data = {};
+                    try {
+                        data = JSON.parse(xhr.responseText);
+                    } catch (e) {}
+                    if (xhr.status >= 200 && xhr.status < 300) {
+                        resolve(data);
+                    } else {
+                        reject({
+                            status: xhr.status,
+                            retryAfter: parseFloat(xhr.getResponseHeader('Retry-After')) || 0,
+                            message: data.error || 'HTTP ' + xhr.status
+                        });
+                    }
+                };
+                xhr.onerror = () => reject({ status: 0, retryAfter: 0, message: 'Network error' });
+                xhr.send(file.slice(start, end));
             })
             .catch(error => {
-                alert('Upload failed: ' + error);
-                uploadNextFile(files, index + 1, progressDiv);
+                onChunkProgress(0);
+                const busy = error.status === 429 || error.status === 503;
+                if ([404, 413, 416].includes(error.status) || (!busy && attempt >= CHUNK_RETRIES)) {
+                    throw new Error(error.message);
+                }
+                // Back off with jitter and retry; the server keeps everything
+                // received so far. "Busy" answers don't use up the retry budget.
+                const delay = Math.max(error.retryAfter * 1000, Math.min(500 * Math.pow(2, attempt), 15000));
+                return sleep(delay * (0.5 + Math.random() / 2))
+                    .then(() => putChunk(uploadId, file, start, end, busy ? attempt : attempt + 1, onChunkProgress));
+            });
+        }
+        
+        function chunkedUpload(file, room, onProgress) {
+            const resumeKey = `upload:${room}:${file.name}:${file.size}:${file.lastModified}`;
+            let upload;
+            
+            return startUploadSession(file, room, resumeKey)
+            .then(data => {
+                if (data.error) {
+                    throw new Error(data.error);
+                }
+                upload = data;
+                
+                const pending = [];
+                for (let start = 0; start < file.size; start += upload.chunk_size) {
+                    const end = Math.min(start + upload.chunk_size, file.size);
+                    if (!rangeCovered(upload.received, start, end)) {
+                        pending.push([start, end]);
+                    }
+                }
+                let sent = file.size - pending.reduce((total, r) => total + r[1] - r[0], 0);
+                const inFlight = new Map();
+                const report = () => onProgress(sent + Array.from(inFlight.values()).reduce((a, b) => a + b, 0));
+                report();
+                
+                return new Promise((resolve, reject) => {
+                    let active = 0;
+                    let failed = false;
+                    
+                    function pump() {
+                        if (failed) return;
+                        if (pending.length === 0 && active === 0) {
+                            resolve();
+                            return;
+                        }
+                        while (active < CHUNK_CONCURRENCY && pending.length > 0) {
+                            const range = pending.shift();
+                            active++;
+                            acquireUploadSlot()
+                            .then(() => putChunk(upload.upload_id, file, range[0], range[1], 0, function(loaded) {
+                                inFlight.set(range[0], loaded);
+                                report();
+                            }))
+                            .finally(releaseUploadSlot)
+                            .then(() => {
+                                active--;
+                                inFlight.delete(range[0]);
+                                sent += range[1] - range[0];
+                                report();
+                                pump();
+                            })
+                            .catch(error => {
+                                failed = true;
+                                reject(error);
+                            });
+                        }
+                    }
+                    
+                    pump();
+                });
+            })
+            .then(() => fetch(`/upload/${upload.upload_id}/finalize`, { method: 'POST' }))
+            .then(jsonOrError)
+            .then(data => {
+                if (!data.error || data.status === 404) {
+                    localStorage.removeItem(resumeKey);
+                }
+                return data;
             });
         }
         
+        // File list is fetched a page at a time as the user scrolls
+        const FILE_PAGE_SIZE = 100;
+        let fileListState = { cursor: null, loading: false, done: true, files: new Map() };
+        let fileVersion = null;
+        let fileSyncPending = false;
+        let fileTotal = 0;
+        
         function loadFiles() {
-            fetch('/files')
+            fileVersion = null;
+            fileSyncPending = false;
+            fileListState = { cursor: null, loading: false, done: false, files: new Map() };
+            selectedFiles.clear();
+            updateArchiveButton();
+            document.getElementById('fileList').innerHTML = '';
+            loadMoreFiles();
+        }
+        
+        function loadMoreFiles() {
+            const state = fileListState;
+            if (state.loading || state.done) return;
+            state.loading = true;
+            
+            const sort = document.getElementById('fileSort').value.split(':');
+            const params = new URLSearchParams({ room: currentRoom, sort: sort[0], order: sort[1], limit: FILE_PAGE_SIZE });
+            const filter = document.getElementById('fileFilter').value.trim();
+            if (filter) params.set('q', filter);
+            if (state.cursor) params.set('cursor', state.cursor);
+            
+            fetch('/files?' + params.toString())
             .then(response => response.json())
-            .then(files => {
+            .then(page => {
+                if (state !== fileListState) return;  // Superseded by a newer query
+                state.loading = false;
+                state.cursor = page.next_cursor;
+                state.done = !page.next_cursor;
+                if (fileVersion === null) {
+                    // Deltas newer than the first page are applied from here on
+                    fileVersion = page.version;
+                    requestFileSync();
+                }
+                
                 const fileList = document.getElementById('fileList');
-                if (files.length === 0) {
-                    fileList.innerHTML = '<div style="text-align: center; color: #666; padding: 20px;">No files shared yet</div>';
+                if (!filter) {
+                    setFileTotal(page.total);
+                }
+                if (page.total === 0) {
+                    const empty = filter ? 'No matching files' : 'No files shared yet';
+                    fileList.innerHTML = `<div style="text-align: center; color: #666; padding: 20px;">${empty}</div>`;
                     return;
                 }
                 
-                fileList.innerHTML = '';
-                files.forEach(file => {
-                    const fileDiv = document.createElement('div');
-                    fileDiv.className = 'file-item';
-                    
-                    const displayName = file.name.substring(16); // Remove timestamp prefix
-                    const fileSize = formatFileSize(file.size);
-                    
-                    fileDiv.innerHTML = `
-                        <div class="file-name">${escapeHtml(displayName)}</div>
-                        <div class="file-info">Size: ${fileSize} | Modified: ${file.modified}</div>
-                        <button class="btn btn-secondary" style="margin-top: 5px; font-size: 11px;" 
-                                onclick="downloadFile('${file.name}')">Download</button>
-                    `;
-                    
-                    fileList.appendChild(fileDiv);
+                page.files.forEach(file => {
+                    if (!state.files.has(file.name)) {
+                        state.files.set(file.name, file);
+                        fileList.appendChild(renderFileItem(file));
+                    }
                 });
+                
+                // Keep going until the panel is filled so scrolling is possible
+                if (!state.done && fileList.scrollHeight <= fileList.clientHeight) {
+                    loadMoreFiles();
+                }
+            })
+            .catch(() => {
+                state.loading = false;
+            });
+        }
+        
+        function requestFileSync() {
+            if (fileVersion !== null && !fileSyncPending) {
+                fileSyncPending = true;
+                socket.emit('file_sync', { room: currentRoom, since: fileVersion });
+            }
+        }
+        
+        function onFileChange(change) {
+            if (change.file.room !== currentRoom) return;
+            if (fileVersion === null || fileSyncPending || change.version <= fileVersion) return;
+            if (change.prev > fileVersion) {
+                // Missed a delta in this room: ask for everything since our version
+                requestFileSync();
+                return;
+            }
+            applyFileChange(change);
+        }
+        
+        function applyFileChange(change) {
+            fileVersion = change.version;
+            if (change.op === 'added') {
+                setFileTotal(fileTotal + 1);
+            } else if (change.op === 'removed') {
+                setFileTotal(fileTotal - 1);
+            }
+            if (change.op === 'removed' || change.op === 'changed') {
+                removeFileItem(change.file.name);
+            }
+            if (change.op === 'added' || change.op === 'changed') {
+                insertFileItem(change.file);
+            }
+        }
+        
+        function setFileTotal(total) {
+            fileTotal = Math.max(0, total);
+            document.getElementById('fileCount').textContent = fileTotal;
+        }
+        
+        function fileSortKey(file, sort) {
+            if (sort === 'size') return [file.size, file.name];
+            if (sort === 'mtime') return [file.modified, file.name];
+            if (sort === 'uploader') return [(file.uploader || '').toLowerCase(), file.name];
+            return [file.name];
+        }
+        
+        function compareFiles(a, b) {
+            const sort = document.getElementById('fileSort').value.split(':');
+            const direction = sort[1] === 'desc' ? -1 : 1;
+            const keyA = fileSortKey(a, sort[0]);
+            const keyB = fileSortKey(b, sort[0]);
+            for (let i = 0; i < keyA.length; i++) {
+                if (keyA[i] < keyB[i]) return -direction;
+                if (keyA[i] > keyB[i]) return direction;
+            }
+            return 0;
+        }
+        
+        function insertFileItem(file) {
+            const filter = document.getElementById('fileFilter').value.trim().toLowerCase();
+            if (filter && !file.name.toLowerCase().includes(filter)) return;
+            
+            const fileList = document.getElementById('fileList');
+            const items = fileList.querySelectorAll('.file-item');
+            if (items.length === 0) {
+                fileList.innerHTML = '';
+            }
+            for (const item of items) {
+                const other = fileListState.files.get(item.dataset.name);
+                if (other && compareFiles(file, other) < 0) {
+                    fileListState.files.set(file.name, file);
+                    fileList.insertBefore(renderFileItem(file), item);
+                    return;
+                }
+            }
+            // Past the last loaded row: a later page will bring it in
+            if (fileListState.done) {
+                fileListState.files.set(file.name, file);
+                fileList.appendChild(renderFileItem(file));
+            }
+        }
+        
+        function removeFileItem(name) {
+            fileListState.files.delete(name);
+            if (selectedFiles.delete(name)) updateArchiveButton();
+            document.querySelectorAll('#fileList .file-item').forEach(item => {
+                if (item.dataset.name === name) {
+                    item.remove();
+                }
             });
         }
         
+        function renderFileItem(file) {
+            const fileDiv = document.createElement('div');
+            fileDiv.className = 'file-item';
+            fileDiv.dataset.name = file.name;
+            
+            const displayName = file.name.substring(16); // Remove timestamp prefix
+            const fileSize = formatFileSize(file.size);
+            
+            // The version parameter gives a changed file a new preview URL
+            const previewUrl = '/preview/' + encodeURIComponent(file.name) + '?v=' + encodeURIComponent(file.size + '-' + file.modified);
+            let preview = '';
+            if (file.preview === 'image' || file.preview === 'pdf') {
+                preview = `<img class="file-thumb" loading="lazy" src="${previewUrl}" alt="" onerror="this.remove()">`;
+            }
+            
+            fileDiv.innerHTML = `
+                ${preview}
+                <div class="file-name"><input type="checkbox" class="file-select"${selectedFiles.has(file.name) ? ' checked' : ''}> ${escapeHtml(displayName)}</div>
+                <div class="file-info">Size: ${fileSize} | Modified: ${file.modified}${file.uploader ? ' | By: ' + escapeHtml(file.uploader) : ''}</div>
+                <button class="btn btn-secondary" style="margin-top: 5px; font-size: 11px;" 
+                        onclick="downloadFile('${file.name}')">Download</button>
+            `;
+            fileDiv.querySelector('.file-select').onchange = function() {
+                if (this.checked) {
+                    selectedFiles.add(file.name);
+                } else {
+                    selectedFiles.delete(file.name);
+                }
+                updateArchiveButton();
+            };
+            if (file.preview === 'text') {
+                const button = document.createElement('button');
+                button.className = 'btn btn-secondary';
+                button.style.cssText = 'margin-top: 5px; margin-left: 5px; font-size: 11px;';
+                button.textContent = 'Preview';
+                button.onclick = () => toggleTextPreview(fileDiv, previewUrl);
+                fileDiv.appendChild(button);
+            }
+            return fileDiv;
+        }
+        
+        function toggleTextPreview(fileDiv, previewUrl) {
+            const existing = fileDiv.querySelector('.file-snippet');
+            if (existing) {
+                existing.remove();
+                return;
+            }
+            fetch(previewUrl)
+            .then(response => response.ok ? response.text() : Promise.reject())
+            .then(text => {
+                const snippet = document.createElement('pre');
+                snippet.className = 'file-snippet';
+                snippet.textContent = text;
+                fileDiv.appendChild(snippet);
+            })
+            .catch(() => alert('No preview available'));
+        }
+        
         function downloadFile(filename) {
             window.open('/download/' + encodeURIComponent(filename), '_blank');
         }
         
+        const selectedFiles = new Set();
+        
+        function updateArchiveButton() {
+            const count = selectedFiles.size;
+            document.getElementById('archiveButton').textContent = count ? `Download ${count} as ZIP` : 'Download all';
+        }
+        
+        function downloadArchive() {
+            // A form POST, so hundreds of names fit and the browser saves
+            // the streamed ZIP like any other download
+            const form = document.createElement('form');
+            form.method = 'POST';
+            form.action = '/download';
+            const fields = [['room', currentRoom]];
+            if (selectedFiles.size) {
+                selectedFiles.forEach(name => fields.push(['files', name]));
+            } else {
+                const filter = document.getElementById('fileFilter').value.trim();
+                if (filter) fields.push(['q', filter]);
+            }
+            fields.forEach(([name, value]) => {
+                const input = document.createElement('input');
+                input.type = 'hidden';
+                input.name = name;
+                input.value = value;
+                form.appendChild(input);
+            });
+            document.body.appendChild(form);
+            form.submit();
+            form.remove();
+        }
+        
         function updateUserList(users) {
             const userList = document.getElementById('userList');
             if (users.length === 0) {
                 userList.textContent = 'No users online';
-            } else {
-                userList.textContent = users.join(', ');
+                return;
             }
+            userList.innerHTML = '';
+            users.forEach(([name, label], i) => {
+                const item = document.createElement('span');
+                item.textContent = label;
+                if (name !== username) {
+                    item.className = 'user-link';
+                    item.onclick = () => openDirectMessage(name);
+                }
+                userList.appendChild(item);
+                if (i < users.length - 1) {
+                    userList.appendChild(document.createTextNode(', '));
+                }
+            });
         }
         
         function updateUserCount(count) {
@@ -850,6 +5912,92 @@ class LANChatServer:
             }
         });
         
+        document.getElementById('chatMessages').addEventListener('scroll', function() {
+            if (this.scrollTop < 100) {
+                loadOlderMessages();
+            }
+        });
+        
+        document.getElementById('fileList').addEventListener('scroll', function() {
+            if (this.scrollTop + this.clientHeight >= this.scrollHeight - 200) {
+                loadMoreFiles();
+            }
+        });
+        
+        let filterTimer = null;
+        document.getElementById('fileFilter').addEventListener('input', function() {
+            clearTimeout(filterTimer);
+            filterTimer = setTimeout(loadFiles, 250);
+        });
+        
+        document.getElementById('fileSort').addEventListener('change', loadFiles);
+        
+        let searchTimer = null;
+        let searchSeq = 0;
+        document.getElementById('searchInput').addEventListener('input', function() {
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(runSearch, 250);
+        });
+        document.getElementById('searchInput').addEventListener('keydown', function(e) {
+            if (e.key === 'Escape') {
+                this.value = '';
+                runSearch();
+            }
+        });
+        
+        function runSearch() {
+            const query = document.getElementById('searchInput').value.trim();
+            const results = document.getElementById('searchResults');
+            const seq = ++searchSeq;
+            if (!query) {
+                results.style.display = 'none';
+                return;
+            }
+            fetch('/search?' + new URLSearchParams({ q: query, limit: 20 }).toString())
+            .then(response => response.json())
+            .then(data => {
+                if (seq !== searchSeq) return;  // A newer query is on its way
+                renderSearchResults(data);
+            })
+            .catch(() => {});
+        }
+        
+        function highlightSnippet(text) {
+            // Matched terms come wrapped in \\x02 and \\x03
+            return escapeHtml(text || '').replace(/\\x02/g, '<mark>').replace(/\\x03/g, '</mark>');
+        }
+        
+        function renderSearchResults(data) {
+            const results = document.getElementById('searchResults');
+            results.innerHTML = '';
+            results.style.display = 'block';
+            if (data.error) {
+                results.textContent = data.error;
+                return;
+            }
+            (data.messages || []).forEach(hit => {
+                const room = rooms.get(hit.room);
+                const item = document.createElement('div');
+                item.className = 'search-hit';
+                item.innerHTML = `<div class="meta">${escapeHtml(room ? roomLabel(room) : hit.room)} | ${escapeHtml(hit.username)} | ${hit.date}</div>
+                    <div>${highlightSnippet(hit.snippet)}</div>`;
+                item.onclick = () => switchRoom(hit.room);
+                results.appendChild(item);
+            });
+            (data.files || []).forEach(file => {
+                const item = document.createElement('div');
+                item.className = 'search-hit';
+                item.innerHTML = `<div>&#128196; ${highlightSnippet(file.name_snippet)}</div>
+                    <div class="meta">${formatFileSize(file.size)} | ${file.modified}</div>
+                    ${file.snippet ? '<div>' + highlightSnippet(file.snippet) + '</div>' : ''}`;
+                item.onclick = () => downloadFile(file.name);
+                results.appendChild(item);
+            });
+            if (!results.children.length) {
+                results.textContent = 'No matches';
+            }
+        }
+        
         // Load files on page load
         document.addEventListener('DOMContentLoaded', function() {
             loadFiles();
@@ -858,71 +6006,118 @@ class LANChatServer:
 </body>
 </html>'''
         
-        # Write templates
-        with open('templates/login.html', 'w', encoding='utf-8') as f:
-            f.write(login_html)
-        
-        with open('templates/index.html', 'w', encoding='utf-8') as f:
-            f.write(main_html)
+        self.app.jinja_loader = DictLoader({'login.html': login_html, 'index.html': main_html})
     
-    def run_gui(self):
+    def run_gui(self, host='0.0.0.0', port=5000, drain_timeout=30):
+        # Imported here so headless servers never load Tk
+        import tkinter as tk
+        from tkinter import ttk, scrolledtext, filedialog, messagebox
+        
+        running = False
+        after_stop = []  # Run once the server has stopped: a restart, or closing the window
+        
         def start_server():
+            nonlocal running
             try:
-                host = self.get_local_ip()
                 port = int(port_var.get())
-                
-                # Update server info
-                server_url = f"http://{host}:{port}"
-                url_label.config(text=f"Server URL: {server_url}")
-                
-                # Start server in separate thread
-                server_thread = threading.Thread(
-                    target=lambda: self.socketio.run(self.app, host='0.0.0.0', port=port, debug=False),
-                    daemon=True
-                )
-                server_thread.start()
-                
-                start_btn.config(state='disabled')
-                stop_btn.config(state='normal')
-                status_label.config(text="Server Status: Running", fg="green")
-                
-                # Start stats update
-                update_stats()
-                
+                self.reopen()
+                # Bound here so a port in use is reported right away
+                listener = self.listen(host, port)
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to start server: {str(e)}")
+                return
+            
+            # Update server info
+            server_url = f"http://{self.get_local_ip()}:{port}"
+            url_label.config(text=f"Server URL: {server_url}")
+            
+            # Start server in separate thread
+            server_thread = threading.Thread(
+                target=lambda: self.serve(host, port, listener=listener),
+                daemon=True
+            )
+            server_thread.start()
+            running = True
+            
+            start_btn.config(state='disabled')
+            stop_btn.config(state='normal')
+            restart_btn.config(state='normal')
+            folder_btn.config(state='disabled')
+            status_label.config(text="Server Status: Running", foreground="green")
+            
+            # Start stats update
+            update_stats()
         
         def stop_server():
+            # New connections are refused at once; transfers in flight get up
+            # to the drain timeout, then the chat state is written out. The
+            # process and its state stay, so the server can start again.
+            if not running or self.draining:
+                return
             try:
-                start_btn.config(state='normal')
-                stop_btn.config(state='disabled')
-                status_label.config(text="Server Status: Stopped", fg="red")
-                url_label.config(text="Server URL: Not running")
-                messagebox.showinfo("Server", "Server stopped. Note: You may need to restart the application to start the server again.")
-            except Exception as e:
-                messagebox.showerror("Error", f"Error stopping server: {str(e)}")
+                timeout = max(0, float(drain_var.get()))
+            except ValueError:
+                timeout = drain_timeout
+            start_btn.config(state='disabled')
+            stop_btn.config(state='disabled')
+            restart_btn.config(state='disabled')
+            self.socketio.start_background_task(self.stop, timeout, False)
+            wait_for_stop()
+        
+        def wait_for_stop():
+            nonlocal running
+            if not self.stopped.is_set():
+                status_label.config(text=f"Server Status: Stopping ({self.active_transfers()} transfers in progress)...",
+                                    foreground="orange")
+                root.after(200, wait_for_stop)
+                return
+            running = False
+            start_btn.config(state='normal')
+            folder_btn.config(state='normal')
+            status_label.config(text="Server Status: Stopped", foreground="red")
+            url_label.config(text="Server URL: Not running")
+            while after_stop:
+                after_stop.pop(0)()
+        
+        def restart_server():
+            # Picks up the port entry, so this is also how to move to another port
+            after_stop.append(start_server)
+            stop_server()
+        
+        def close_window():
+            if running:
+                after_stop.append(root.destroy)
+                stop_server()
+            else:
+                root.destroy()
         
         def update_stats():
             if status_label.cget("text") == "Server Status: Running":
                 # Update statistics
                 stats_text.delete(1.0, tk.END)
+                stats = self.state.get_stats()
+                users = self.state.get_users()
+                history = self.state.get_messages()
+                broadcasts = self.broadcasts.get_stats()
                 stats_content = f"""=== SERVER STATISTICS ===
-Active Users: {self.server_stats['active_users']}
-Total Messages Sent: {self.server_stats['total_messages']}
-Files Shared: {self.server_stats['total_files_shared']}
+Active Users: {stats['active_users']}
+Total Messages Sent: {stats['total_messages']}
+Files Shared: {stats['total_files_shared']}
+Transfers in Progress: {self.active_transfers()}
+Broadcast Frames: {broadcasts['frames']} ({broadcasts['frames_saved']} saved by batching, {broadcasts['bytes_saved'] // 1024} KB)
 Server Uptime: {datetime.now().strftime('%H:%M:%S')}
 
 === CONNECTED USERS ===
 """
-                if self.connected_users:
-                    for username, info in self.connected_users.items():
-                        stats_content += f"• {username} (joined: {info['joined']})\n"
+                if users:
+                    for username, info in users.items():
+                        stats_content += f"• {username} (joined: {info['joined']}, {info['status']})\n"
                 else:
                     stats_content += "No users connected\n"
                 
                 stats_content += f"\n=== RECENT CHAT ACTIVITY ===\n"
-                if self.chat_history:
-                    for msg in self.chat_history[-5:]:  # Last 5 messages
+                if history:
+                    for msg in history[-5:]:  # Last 5 messages
                         stats_content += f"[{msg['timestamp']}] {msg['username']}: {msg['message'][:50]}{'...' if len(msg['message']) > 50 else ''}\n"
                 else:
                     stats_content += "No recent messages\n"
@@ -935,24 +6130,38 @@ Server Uptime: {datetime.now().strftime('%H:%M:%S')}
         def select_upload_folder():
             folder = filedialog.askdirectory(title="Select Upload Folder")
             if folder:
-                self.UPLOAD_FOLDER = folder
-                self.app.config['UPLOAD_FOLDER'] = folder
+                try:
+                    self.set_upload_folder(folder)
+                except Exception as e:
+                    messagebox.showerror("Error", f"Failed to change folder: {str(e)}")
+                    return
                 upload_folder_label.config(text=f"Upload Folder: {folder}")
         
+        def apply_bandwidth_limits():
+            try:
+                limits = [int(var.get() or 0) * 1024 for var in (limit_total_var, limit_ip_var, limit_session_var)]
+                if any(limit < 0 for limit in limits):
+                    raise ValueError("limits can't be negative")
+                self.shaper.set_limits(*limits)
+                messagebox.showinfo("Bandwidth", "Bandwidth limits applied.")
+            except ValueError as e:
+                messagebox.showerror("Error", f"Invalid bandwidth limit: {str(e)}")
+        
         def clear_chat_history():
             if messagebox.askyesno("Clear Chat", "Are you sure you want to clear all chat history?"):
-                self.chat_history.clear()
-                self.server_stats['total_messages'] = 0
+                self.state.clear_messages()
+                if self.search is not None:
+                    self.search.clear_messages()
+                self.state.set_stat('total_messages', 0)
                 messagebox.showinfo("Chat Cleared", "Chat history has been cleared.")
         
         def clear_files():
             if messagebox.askyesno("Clear Files", "Are you sure you want to delete all shared files?"):
                 try:
-                    for filename in os.listdir(self.UPLOAD_FOLDER):
-                        file_path = os.path.join(self.UPLOAD_FOLDER, filename)
-                        if os.path.isfile(file_path):
-                            os.remove(file_path)
-                    self.server_stats['total_files_shared'] = 0
+                    self.catalog.rescan()
+                    for filename in self.catalog.names():
+                        self.delete_shared_file(filename)
+                    self.state.set_stat('total_files_shared', 0)
                     messagebox.showinfo("Files Cleared", "All shared files have been deleted.")
                 except Exception as e:
                     messagebox.showerror("Error", f"Failed to clear files: {str(e)}")
@@ -964,7 +6173,11 @@ Server Uptime: {datetime.now().strftime('%H:%M:%S')}
         root.configure(bg="#f0f0f0")
         
         # Variables
-        port_var = tk.StringVar(value="5000")
+        port_var = tk.StringVar(value=str(port))
+        drain_var = tk.StringVar(value=f"{drain_timeout:g}")
+        limit_total_var = tk.StringVar(value=str(self.shaper.rates['total'] // 1024))
+        limit_ip_var = tk.StringVar(value=str(self.shaper.rates['ip'] // 1024))
+        limit_session_var = tk.StringVar(value=str(self.shaper.rates['session'] // 1024))
         
         # Main frame
         main_frame = ttk.Frame(root, padding="10")
@@ -984,11 +6197,17 @@ Server Uptime: {datetime.now().strftime('%H:%M:%S')}
         stop_btn = ttk.Button(control_frame, text="Stop Server", command=stop_server, state='disabled')
         stop_btn.grid(row=0, column=3, padx=5)
         
+        restart_btn = ttk.Button(control_frame, text="Restart", command=restart_server, state='disabled')
+        restart_btn.grid(row=0, column=4, padx=5)
+        
+        ttk.Label(control_frame, text="Drain timeout (s):").grid(row=0, column=5, padx=(10, 0))
+        ttk.Entry(control_frame, textvariable=drain_var, width=6).grid(row=0, column=6, padx=(5, 0))
+        
         status_label = ttk.Label(control_frame, text="Server Status: Stopped", foreground="red")
-        status_label.grid(row=1, column=0, columnspan=4, sticky=tk.W, pady=(10, 0))
+        status_label.grid(row=1, column=0, columnspan=7, sticky=tk.W, pady=(10, 0))
         
         url_label = ttk.Label(control_frame, text="Server URL: Not running", foreground="blue")
-        url_label.grid(row=2, column=0, columnspan=4, sticky=tk.W, pady=(5, 0))
+        url_label.grid(row=2, column=0, columnspan=7, sticky=tk.W, pady=(5, 0))
         
         # Configuration Section
         config_frame = ttk.LabelFrame(main_frame, text="Configuration", padding="10")
@@ -997,7 +6216,21 @@ Server Uptime: {datetime.now().strftime('%H:%M:%S')}
         upload_folder_label = ttk.Label(config_frame, text=f"Upload Folder: {self.UPLOAD_FOLDER}")
         upload_folder_label.grid(row=0, column=0, sticky=tk.W)
         
-        ttk.Button(config_frame, text="Change Folder", command=select_upload_folder).grid(row=0, column=1, padx=(10, 0))
+        # Only while stopped, see set_upload_folder()
+        folder_btn = ttk.Button(config_frame, text="Change Folder", command=select_upload_folder)
+        folder_btn.grid(row=0, column=1, padx=(10, 0))
+        
+        # Bandwidth limits, applied live to transfers in progress
+        bandwidth_frame = ttk.Frame(config_frame)
+        bandwidth_frame.grid(row=1, column=0, columnspan=3, sticky=tk.W, pady=(10, 0))
+        
+        ttk.Label(bandwidth_frame, text="Bandwidth limits in KB/s (0 = unlimited)  Total:").grid(row=0, column=0, sticky=tk.W)
+        ttk.Entry(bandwidth_frame, textvariable=limit_total_var, width=8).grid(row=0, column=1, padx=(5, 10))
+        ttk.Label(bandwidth_frame, text="Per IP:").grid(row=0, column=2)
+        ttk.Entry(bandwidth_frame, textvariable=limit_ip_var, width=8).grid(row=0, column=3, padx=(5, 10))
+        ttk.Label(bandwidth_frame, text="Per session:").grid(row=0, column=4)
+        ttk.Entry(bandwidth_frame, textvariable=limit_session_var, width=8).grid(row=0, column=5, padx=(5, 10))
+        ttk.Button(bandwidth_frame, text="Apply", command=apply_bandwidth_limits).grid(row=0, column=6)
         
         # Management Section
         mgmt_frame = ttk.LabelFrame(main_frame, text="Management", padding="10")
@@ -1018,7 +6251,7 @@ Server Uptime: {datetime.now().strftime('%H:%M:%S')}
         root.rowconfigure(0, weight=1)
         main_frame.columnconfigure(0, weight=1)
         main_frame.rowconfigure(3, weight=1)
-        control_frame.columnconfigure(4, weight=1)
+        control_frame.columnconfigure(7, weight=1)
         config_frame.columnconfigure(2, weight=1)
         mgmt_frame.columnconfigure(2, weight=1)
         stats_frame.columnconfigure(0, weight=1)
@@ -1040,31 +6273,219 @@ Server Uptime: {datetime.now().strftime('%H:%M:%S')}
         stats_text.insert(tk.END, "3. Everyone can chat and share files!\n\n")
         stats_text.insert(tk.END, "Server ready to start...\n")
         
+        # Closing the window drains transfers in flight first
+        root.protocol("WM_DELETE_WINDOW", close_window)
+        
         return root
 
-def main():
-    # Create server instance
-    server = LANChatServer()
+def run_worker(worker_id, workers, host, port, async_mode, message_queue, config=None, drain_timeout=30):
+    # Entry point of one cluster worker process
+    async_mode = prepare_async_mode(async_mode)
+    server = LANChatServer(async_mode=async_mode, message_queue=message_queue, worker_id=worker_id, workers=workers,
+                           config=config)
+    server.stop_on_signals(drain_timeout)
+    server.serve(host, port, reuse_port=True)
+
+WORKER_QUICK_EXIT = 10  # Seconds; a worker exiting sooner after its start failed to start
+WORKER_MAX_FAILURES = 5  # Failed starts in a row before the cluster gives up
+
+def run_cluster(workers, host='0.0.0.0', port=5000, async_mode=None, message_queue=None, config=None,
+                drain_timeout=30):
+    # Runs several worker processes on one port. Socket.IO emits go through
+    # the message queue (Redis, or a broker in this process when none is
+    # given); presence, history, stats and the file catalog through SQLite.
+    async_mode = async_mode or os.environ.get('LANSHARE_ASYNC_MODE') or 'threading'
+    if async_mode not in ASYNC_MODES:
+        raise ValueError(f"Unknown async mode: {async_mode}")
+    os.environ.setdefault('LANSHARE_SECRET_KEY', uuid.uuid4().hex)
+    broker = None
+    if not message_queue:
+        broker = MessageBroker(secrets.token_hex(16))
+        broker.start()
+        message_queue = broker.get_url()
+    
+    context = multiprocessing.get_context('spawn')
     
-    # Create templates
-    server.create_templates()
+    def start_worker(worker_id):
+        # Not daemonic: workers start preview processes of their own. They are
+        # terminated below on the way out.
+        process = context.Process(target=run_worker,
+                                  args=(worker_id, workers, host, port, async_mode, message_queue, config,
+                                        drain_timeout))
+        process.start()
+        return process
+    
+    queue_name = 'built-in broker on %s:%d' % broker.address if broker is not None else message_queue
+    print(f"Starting {workers} {async_mode} workers on {host}:{port} (message queue: {queue_name})")
+    processes = [start_worker(i) for i in range(workers)]
+    started = [time.monotonic()] * workers
+    failures = [0] * workers  # Quick exits in a row, per worker
+    restart_at = [None] * workers
+    exit_code = 0
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while not exit_code:
+            time.sleep(1)
+            now = time.monotonic()
+            for i, process in enumerate(processes):
+                if restart_at[i] is None and not process.is_alive():
+                    # A worker that keeps dying on startup (bad config, a broken
+                    # folder) is retried with a doubling delay, then given up on
+                    failures[i] = failures[i] + 1 if now - started[i] < WORKER_QUICK_EXIT else 0
+                    if failures[i] >= WORKER_MAX_FAILURES:
+                        print(f"Worker {i} failed to start {failures[i]} times in a row, giving up")
+                        exit_code = 1
+                        break
+                    delay = 2 ** (failures[i] - 1) if failures[i] else 0
+                    print(f"Worker {i} exited with code {process.exitcode}, restarting in {delay}s")
+                    restart_at[i] = now + delay
+                if restart_at[i] is not None and now >= restart_at[i]:
+                    processes[i] = start_worker(i)
+                    started[i] = now
+                    restart_at[i] = None
+    except (KeyboardInterrupt, SystemExit):
+        print("\nShutting down workers...")
+    finally:
+        # Workers drain their transfers on SIGTERM, so they get that long
+        for process in processes:
+            process.terminate()
+        deadline = time.monotonic() + drain_timeout + 5
+        for process in processes:
+            process.join(timeout=max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+        if broker is not None:
+            broker.stop()
+    if exit_code:
+        sys.exit(exit_code)
+
+SERVER_SETTINGS = {
+    'host': '0.0.0.0',
+    'port': 5000,
+    'async_mode': None,  # threading, eventlet or gevent
+    'workers': 1,
+    'message_queue': None,  # Redis URL for a cluster; a built-in broker otherwise
+    'headless': False,  # No control panel; serve right away
+    'drain_timeout': 30  # Seconds transfers get to finish on SIGTERM
+}
+
+def parse_setting(value):
+    # Environment values that parse as JSON (numbers, booleans) are taken as such
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+def load_config(path=None, environ=None):
+    # Process settings and Flask config overrides from a JSON file, then
+    # LANSHARE_* environment variables. Lower-case keys are SERVER_SETTINGS,
+    # upper-case ones override LANChatServer's app.config:
+    #     {"port": 8080, "headless": true, "BANDWIDTH_LIMIT_TOTAL": 10485760}
+    #     LANSHARE_PORT=8080 LANSHARE_BANDWIDTH_LIMIT_TOTAL=10485760
+    environ = os.environ if environ is None else environ
+    settings = dict(SERVER_SETTINGS)
+    config = {}
+    known_config = dict(Flask.default_config)
+    set_config_defaults(known_config)
+    path = path or environ.get('LANSHARE_CONFIG')
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            values = json.load(f)
+        if not isinstance(values, dict):
+            raise ValueError(f"{path} must hold a JSON object")
+        for key, value in values.items():
+            if key in settings:
+                settings[key] = value
+            elif key in known_config:
+                config[key] = value
+            else:
+                raise ValueError(f"Unknown setting in {path}: {key}")
+    for name, value in environ.items():
+        if not name.startswith('LANSHARE_') or name in ('LANSHARE_CONFIG', 'LANSHARE_SECRET_KEY'):
+            continue
+        key = name[len('LANSHARE_'):]
+        if key.lower() in settings:
+            settings[key.lower()] = parse_setting(value)
+        elif key in known_config:
+            config[key] = parse_setting(value)
+        else:
+            raise ValueError(f"Unknown setting in environment variable {name}")
+    return settings, config
+
+def run_headless(settings, config):
+    async_mode = prepare_async_mode(settings['async_mode'])
+    server = LANChatServer(async_mode=async_mode, config=config)
+    server.stop_on_signals(settings['drain_timeout'])
+    print(f"LAN Chat & File Share serving on http://{settings['host']}:{settings['port']} ({async_mode})")
+    server.serve(settings['host'], settings['port'])
+    print("Server stopped")
+
+def run_control_panel(settings, config):
+    import tkinter as tk
+    
+    async_mode = prepare_async_mode(settings['async_mode'])
+    
+    # Create server instance
+    server = LANChatServer(async_mode=async_mode, config=config)
     
     print("=" * 60)
     print("LAN CHAT & FILE SHARE SERVER")
     print("=" * 60)
     print("Setting up server...")
-    print("Creating web templates...")
     print("Initializing chat system...")
+    print(f"Async mode: {async_mode}")
     print("Ready to start!")
     print("=" * 60)
     
     # Run GUI
-    root = server.run_gui()
+    root = server.run_gui(settings['host'], settings['port'], settings['drain_timeout'])
     
     try:
-        root.mainloop()
+        if async_mode == 'threading':
+            root.mainloop()
+        else:
+            # Cooperative modes: pump Tk from the event loop so the server's
+            # green threads keep running (a modal dialog pauses them while open)
+            while True:
+                try:
+                    root.update()
+                except tk.TclError:
+                    break
+                server.socketio.sleep(0.02)
     except KeyboardInterrupt:
         print("\nShutting down server...")
+    finally:
+        # Write out chat messages still waiting for their batch
+        server.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='LAN Chat & File Share server')
+    parser.add_argument('--config', help='JSON config file (default: $LANSHARE_CONFIG)')
+    parser.add_argument('--headless', action='store_true', default=None, help='Serve without the control panel')
+    parser.add_argument('--host')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--async-mode', choices=ASYNC_MODES)
+    parser.add_argument('--workers', type=int, help='Worker processes sharing the port (always headless)')
+    parser.add_argument('--message-queue', help='Redis URL connecting the workers')
+    parser.add_argument('--drain-timeout', type=float, help='Seconds transfers get to finish on SIGTERM')
+    args = parser.parse_args()
+    try:
+        settings, config = load_config(args.config)
+    except (OSError, ValueError) as e:
+        parser.error(f"Invalid config: {e}")
+    for key in SERVER_SETTINGS:
+        if getattr(args, key) is not None:
+            settings[key] = getattr(args, key)
+    
+    if settings['workers'] > 1:
+        # The control panel drives a single in-process server, so a cluster
+        # runs without it
+        run_cluster(settings['workers'], settings['host'], settings['port'], settings['async_mode'],
+                    settings['message_queue'], config, settings['drain_timeout'])
+    elif settings['headless']:
+        run_headless(settings, config)
+    else:
+        run_control_panel(settings, config)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,38 @@
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import file2
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    # A server on a fresh shared_files folder under the test's temp dir
+    monkeypatch.chdir(tmp_path)
+    server = file2.LANChatServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def login(server):
+    def login(username='alice'):
+        client = server.app.test_client()
+        client.post('/login', data={'username': username})
+        return client
+    return login
+
+
+@pytest.fixture
+def upload():
+    # Plain form upload; returns the stored (timestamped) name
+    def upload(client, name, data, room=None):
+        response = client.post('/upload', query_string={'room': room} if room else None,
+                               data={'file': (io.BytesIO(data), name)}, content_type='multipart/form-data')
+        assert response.status_code == 200, response.get_json()
+        return response.get_json()['filename']
+    return upload
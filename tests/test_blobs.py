@@ -0,0 +1,80 @@
+import hashlib
+import os
+import threading
+import time
+
+
+def test_same_content_stored_once(server, login, upload):
+    client = login()
+    data = os.urandom(50000)
+    digest = hashlib.sha256(data).hexdigest()
+    first = upload(client, 'a.bin', data)
+    second = upload(client, 'b.bin', data)
+    assert server.catalog.get(first)['blob'] == server.catalog.get(second)['blob'] == digest
+    assert client.get('/download/' + second).data == data
+
+    # The blob goes with the last name that refers to it
+    server.delete_shared_file(first)
+    assert server.blobs.has(digest)
+    assert client.get('/download/' + second).data == data
+    server.delete_shared_file(second)
+    assert not server.blobs.has(digest)
+
+
+def test_link_existing_content(server, login, upload):
+    client = login()
+    data = os.urandom(50000)
+    digest = hashlib.sha256(data).hexdigest()
+    upload(client, 'a.bin', data)
+    assert client.get('/blobs/' + digest).get_json() == {'exists': True}
+
+    response = client.post('/upload/link', json={'filename': 'copy.bin', 'sha256': digest})
+    assert response.status_code == 200
+    assert client.get('/download/' + response.get_json()['filename']).data == data
+    assert client.post('/upload/link', json={'filename': 'x.bin', 'sha256': '0' * 64}).status_code == 404
+
+
+def test_link_needs_a_visible_copy(server, login, upload):
+    # Content only in a room the caller isn't in can't be probed or linked
+    alice = login('alice')
+    socket = server.socketio.test_client(server.app, flask_test_client=alice)
+    socket.emit('room_create', {'name': '#dev'})
+    data = os.urandom(50000)
+    digest = hashlib.sha256(data).hexdigest()
+    upload(alice, 'plan.bin', data, room='dev')
+
+    bob = login('bob')
+    assert bob.get('/blobs/' + digest).get_json() == {'exists': False}
+    assert bob.post('/upload/link', json={'filename': 'x.bin', 'sha256': digest}).status_code == 404
+    assert alice.get('/blobs/' + digest).get_json() == {'exists': True}
+    socket.disconnect()
+
+
+def test_upload_racing_delete_keeps_blob(server, monkeypatch):
+    # A second upload of the same content lands while the only name for it is
+    # deleted; the new name must still have its blob afterwards
+    data = os.urandom(100000)
+    digest = hashlib.sha256(data).hexdigest()
+
+    def part():
+        path = os.path.join(server.get_uploads_folder(), os.urandom(4).hex() + '.part')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    server.store_upload(part(), 'a.bin', digest, len(data), 'alice')
+    add_blob = server.catalog.add_blob
+
+    def slow_add_blob(*args, **kwargs):
+        time.sleep(0.3)
+        return add_blob(*args, **kwargs)
+
+    monkeypatch.setattr(server.catalog, 'add_blob', slow_add_blob)
+    thread = threading.Thread(target=server.store_upload, args=(part(), 'b.bin', digest, len(data), 'alice'))
+    thread.start()
+    time.sleep(0.1)
+    server.delete_shared_file('a.bin')
+    thread.join()
+
+    assert server.catalog.names() == ['b.bin']
+    assert server.blobs.has(digest)
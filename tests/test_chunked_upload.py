@@ -0,0 +1,64 @@
+import hashlib
+import os
+
+
+def start(client, data, name='data.bin'):
+    response = client.post('/upload/init', json={'filename': name, 'size': len(data)})
+    assert response.status_code == 200
+    return response.get_json()['upload_id']
+
+
+def put(client, upload_id, data, offset):
+    return client.put('/upload/%s' % upload_id, query_string={'offset': offset}, data=data)
+
+
+def test_chunks_out_of_order(server, login):
+    client = login()
+    data = os.urandom(300000)
+    upload_id = start(client, data)
+    chunks = [(offset, data[offset:offset + 100000]) for offset in range(0, len(data), 100000)]
+    for offset, chunk in reversed(chunks):
+        assert put(client, upload_id, chunk, offset).status_code == 200
+    assert client.get('/upload/%s' % upload_id).get_json()['received'] == [[0, len(data)]]
+
+    response = client.post('/upload/%s/finalize' % upload_id)
+    assert response.status_code == 200
+    filename = response.get_json()['filename']
+    assert client.get('/download/' + filename).data == data
+    assert server.catalog.get(filename)['sha256'] == hashlib.sha256(data).hexdigest()
+
+
+def test_finalize_incomplete(server, login):
+    client = login()
+    data = os.urandom(200000)
+    upload_id = start(client, data)
+    put(client, upload_id, data[100000:], 100000)
+
+    response = client.post('/upload/%s/finalize' % upload_id)
+    assert response.status_code == 409
+    assert response.get_json()['received'] == [[100000, 200000]]
+
+    put(client, upload_id, data[:100000], 0)
+    assert client.post('/upload/%s/finalize' % upload_id).status_code == 200
+
+
+def test_finalize_twice(server, login):
+    client = login()
+    data = b'x' * 1000
+    upload_id = start(client, data)
+    put(client, upload_id, data, 0)
+    assert client.post('/upload/%s/finalize' % upload_id).status_code == 200
+    assert client.post('/upload/%s/finalize' % upload_id).status_code == 404
+    assert len(server.catalog.names()) == 1
+
+
+def test_unknown_upload(server, login):
+    client = login()
+    assert client.post('/upload/%s/finalize' % ('0' * 32)).status_code == 404
+    assert put(client, '0' * 32, b'x', 0).status_code == 404
+
+
+def test_chunk_past_end(server, login):
+    client = login()
+    upload_id = start(client, b'x' * 10)
+    assert put(client, upload_id, b'x' * 5, 8).status_code == 416
@@ -0,0 +1,74 @@
+def test_file_list_cursor(server, login, upload):
+    client = login()
+    for i in range(7):
+        upload(client, 'f%d.txt' % i, b'x' * i)
+
+    names = []
+    cursor = None
+    while True:
+        query = {'limit': 3, 'sort': 'name'}
+        if cursor:
+            query['cursor'] = cursor
+        page = client.get('/files', query_string=query).get_json()
+        assert page['total'] == 7
+        names += [f['name'] for f in page['files']]
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert names == sorted(server.catalog.names())
+
+
+def test_file_list_cursor_survives_inserts(server, login, upload):
+    client = login()
+    for i in range(4):
+        upload(client, 'f%d.txt' % i, b'x')
+    before = sorted(server.catalog.names())
+    page = client.get('/files', query_string={'limit': 2, 'sort': 'name'}).get_json()
+    upload(client, 'a.txt', b'x')
+    rest = client.get('/files', query_string={'limit': 10, 'sort': 'name', 'cursor': page['next_cursor']}).get_json()
+    # Nothing listed twice or skipped, wherever the new name sorts
+    listed = [f['name'] for f in page['files'] + rest['files']]
+    assert [name for name in listed if name in before] == before
+
+
+def test_bad_cursor(server, login):
+    client = login()
+    assert client.get('/files', query_string={'cursor': 'nonsense'}).status_code == 400
+    assert client.get('/files', query_string={'sort': 'color'}).status_code == 400
+
+
+def history(socket, **query):
+    socket.emit('load_history', query)
+    pages = [e['args'][0] for e in socket.get_received() if e['name'] == 'chat_history']
+    assert len(pages) == 1
+    return pages[0]
+
+
+def test_chat_history_pages(server, login):
+    socket = server.socketio.test_client(server.app, flask_test_client=login())
+    for i in range(5):
+        socket.emit('send_message', {'message': 'm%d' % i})
+    socket.get_received()
+
+    page = history(socket, limit=2)
+    assert [m['message'] for m in page['messages']] == ['m3', 'm4'] and page['has_more']
+    page = history(socket, limit=2, before=page['messages'][0]['seq'])
+    assert [m['message'] for m in page['messages']] == ['m1', 'm2'] and page['has_more']
+    page = history(socket, limit=2, before=page['messages'][0]['seq'])
+    assert [m['message'] for m in page['messages']] == ['m0'] and not page['has_more']
+
+    page = history(socket, after=2)
+    assert [m['message'] for m in page['messages']] == ['m2', 'm3', 'm4']
+    socket.disconnect()
+
+
+def test_chat_history_out_of_range_cursor(server, login):
+    # Taken as no cursor, the same for both state stores
+    socket = server.socketio.test_client(server.app, flask_test_client=login())
+    socket.emit('send_message', {'message': 'hello'})
+    socket.get_received()
+    for query in ({'before': 2 ** 64}, {'after': 2 ** 64}, {'before': -1}, {'after': True}):
+        page = history(socket, **query)
+        assert [m['message'] for m in page['messages']] == ['hello']
+        assert page['before'] is None
+    socket.disconnect()
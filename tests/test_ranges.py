@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def stored(login, upload):
+    client = login()
+    data = os.urandom(100000)
+    return client, upload(client, 'clip.mp4', data), data
+
+
+def test_single_range(stored):
+    client, filename, data = stored
+    response = client.get('/download/' + filename, headers={'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 100-199/%d' % len(data)
+    assert response.data == data[100:200]
+
+
+def test_suffix_range(stored):
+    client, filename, data = stored
+    response = client.get('/download/' + filename, headers={'Range': 'bytes=-10'})
+    assert response.status_code == 206
+    assert response.data == data[-10:]
+
+
+def test_multiple_ranges(stored):
+    client, filename, data = stored
+    response = client.get('/download/' + filename, headers={'Range': 'bytes=0-1,10-11'})
+    assert response.status_code == 206
+    assert response.mimetype == 'multipart/byteranges'
+    boundary = response.mimetype_params['boundary'].encode()
+    parts = response.data.split(b'--' + boundary)
+    assert parts[-1].strip() == b'--'
+    assert b'Content-Range: bytes 0-1/%d' % len(data) in parts[1]
+    assert parts[1].endswith(b'\r\n\r\n' + data[0:2] + b'\r\n')
+    assert b'Content-Range: bytes 10-11/%d' % len(data) in parts[2]
+    assert parts[2].endswith(b'\r\n\r\n' + data[10:12] + b'\r\n')
+
+
+def test_unsatisfiable_range(stored):
+    client, filename, data = stored
+    response = client.get('/download/' + filename, headers={'Range': 'bytes=%d-' % len(data)})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */%d' % len(data)
+
+
+def test_if_range_mismatch(stored):
+    # A stale validator gets the whole file rather than a range of the new one
+    client, filename, data = stored
+    response = client.get('/download/' + filename, headers={'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+    assert response.status_code == 200
+    assert response.data == data